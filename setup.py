@@ -6,19 +6,23 @@ setup(
     name='themis',
     version=themis.__version__,
     packages=['themis'],
+    python_requires='>=3.9',
     entry_points={
         'console_scripts': ['themis=themis.main:main'],
     },
     install_requires=[
-        'nltk',
         'beautifulsoup4',
         'watson_developer_cloud',
         'solrpy',
-        'numpy',
+        'numpy >= 1.17',
         'matplotlib',
         'requests',
+        'pyyaml',
         'pandas >= 0.17.0',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     url='https://github.ibm.com/WatsonTooling/data-science',
     license='Apache Software License',
     author='W.P. McNeill',
@@ -1,12 +1,30 @@
 from __future__ import print_function
 
+import argparse
+import gzip
+import importlib
+import io
+import itertools
 import json
 import logging
+import lzma
+import multiprocessing
 import os
 import sys
 
+try:
+    from html import unescape
+except ImportError:
+    # noinspection PyCompatibility
+    from HTMLParser import HTMLParser
+
+    unescape = HTMLParser().unescape
+
+import numpy
 import pandas
 
+from themis.profiling import stage
+
 __version__= "2.4.0"
 
 logger = logging.getLogger(__name__)
@@ -24,31 +42,322 @@ CORRECT = "Correct"
 IN_PURVIEW = "In Purview"
 
 
+# Compression formats of files, by file name extension.
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".xz": "xz", ".zst": "zstd"}
+
+
+def compression(filename):
+    """
+    :param filename: file name
+    :type filename: str
+    :return: compression format of the file, or None if it is not compressed
+    :rtype: str
+    """
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+def open_file(filename, mode="r"):
+    """
+    Open a file, compressing or decompressing it if its name ends in .gz, .xz, or .zst.
+
+    Text is encoded as UTF-8. Appending to a compressed file adds a new compressed stream to the end of it and reading
+    a compressed file decompresses all its streams, so compressed files can be written in segments, each of which is
+    complete once it is closed. Zstandard compression requires the zstandard package.
+
+    :param filename: file name
+    :type filename: str
+    :param mode: 'r', 'w', or 'a', followed by 'b' to open the file in binary mode
+    :type mode: str
+    :return: file object
+    :rtype: file
+    """
+    binary = "b" in mode
+    mode = mode.replace("b", "").replace("t", "")
+    # Leave line endings alone, as the csv module and pandas expect.
+    text = {} if binary else {"encoding": "utf-8", "newline": ""}
+    file_compression = compression(filename)
+    if file_compression is None:
+        return io.open(filename, mode + ("b" if binary else ""), **text)
+    if file_compression == "gzip":
+        return gzip.open(filename, mode + ("b" if binary else "t"), **text)
+    if file_compression == "xz":
+        return lzma.open(filename, mode + ("b" if binary else "t"), **text)
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The zstandard package is required to read and write %s" % filename)
+    if mode == "r":
+        f = zstandard.ZstdDecompressor().stream_reader(io.open(filename, "rb"), read_across_frames=True)
+    else:
+        f = zstandard.ZstdCompressor().stream_writer(io.open(filename, mode + "b"))
+    return f if binary else io.TextIOWrapper(f, **text)
+
+
+# Cache of parsed CSV files, set by the server so that files are only parsed again when they change.
+csv_cache = None
+
+# Separates the name of a workspace database from the artifact in it in a file name, as in WORKSPACE::ARTIFACT/LABEL.
+WORKSPACE_SEPARATOR = "::"
+
+
+def workspace_reference(file):
+    """
+    :param file: file name or file object
+    :type file: object
+    :return: whether the file is an artifact in a workspace
+    :rtype: bool
+    """
+    return isinstance(file, str) and WORKSPACE_SEPARATOR in file
+
+
+@stage("load inputs")
 def from_csv(file, **kwargs):
+    if workspace_reference(file):
+        from themis.workspace import read_reference
+        return read_reference(file, **kwargs)
+    if csv_cache is not None and csv_cache.cacheable(file, **kwargs):
+        return csv_cache.read(file, **kwargs)
+    return parse_csv(file, **kwargs)
+
+
+def parse_csv(file, **kwargs):
+    if isinstance(file, str) and compression(file) is not None:
+        with open_file(file) as f:
+            return pandas.read_csv(f, **kwargs)
     return pandas.read_csv(file, encoding="utf-8", **kwargs)
 
 
+@stage("write")
 def to_csv(filename, dataframe, **kwargs):
-    dataframe.to_csv(filename, encoding="utf-8", **kwargs)
+    if workspace_reference(filename):
+        from themis.workspace import write_reference
+        write_reference(filename, dataframe, kwargs.get("index", True))
+    elif isinstance(filename, str) and compression(filename) is not None:
+        with open_file(filename, "w") as f:
+            dataframe.to_csv(f, **kwargs)
+    else:
+        dataframe.to_csv(filename, encoding="utf-8", **kwargs)
+
+
+# Workspace artifact in which to store output instead of printing it, set by the --store option.
+output_artifact = None
+
+
+def store_output(reference):
+    """
+    Store the output of commands that print CSV in a workspace instead of printing it.
+
+    :param reference: WORKSPACE::ARTIFACT or WORKSPACE::ARTIFACT/LABEL
+    :type reference: str
+    """
+    global output_artifact
+    output_artifact = reference
 
 
+@stage("write")
 def print_csv(dataframe, **kwargs):
-    print(dataframe.to_csv(encoding="utf-8", **kwargs))
+    if output_artifact is not None:
+        to_csv(output_artifact, dataframe, **kwargs)
+        return
+    # Pandas writes to a file in chunks of rows, whereas without a file it renders the entire CSV as a single string.
+    to_csv(sys.stdout, dataframe, **kwargs)
+    # This used to print the rendered string, which added a blank line.
+    print()
+
+
+class StringInterner(object):
+    """
+    A shared dictionary that maps strings to integer ids.
+
+    Interned columns are categoricals whose codes are ids in this dictionary, so a string that appears in many rows or
+    many files is only stored once. Ids are never reassigned, so columns interned before the dictionary grew can be
+    realigned to its current contents without being re-interned.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def __repr__(self):
+        return "%s: %d strings" % (self.__class__.__name__, len(self.strings))
+
+    def intern(self, values):
+        """
+        :param values: strings to intern, null values are kept as missing values
+        :type values: pandas.Series
+        :return: categorical column of interned strings
+        :rtype: pandas.Categorical
+        """
+        codes, uniques = pandas.factorize(values)
+        # The last id is used for null values, which factorize codes as -1.
+        ids = numpy.full(len(uniques) + 1, -1, dtype="int64")
+        for i, s in enumerate(uniques):
+            if s not in self.ids:
+                self.ids[s] = len(self.strings)
+                self.strings.append(s)
+            ids[i] = self.ids[s]
+        return pandas.Categorical.from_codes(ids[codes], self.strings)
+
+    def align(self, values):
+        """
+        :param values: column previously interned by this dictionary
+        :type values: pandas.Series
+        :return: the same column with the dictionary's current strings as its categories
+        :rtype: pandas.Categorical
+        """
+        return pandas.Categorical.from_codes(values.cat.codes, self.strings)
+
+
+# Shared question and answer dictionaries, set when compact loading is enabled.
+interners = None
+
+# Whether output_format methods sort their rows, cleared when output sorting is disabled.
+sort_output = True
+
+
+def disable_output_sorting():
+    """
+    Write the rows of output files in the order in which they were produced instead of sorting them.
+
+    Sorting a large output takes time and a copy of it in memory, which is wasted when whatever reads the output does
+    not need its rows in order.
+    """
+    global sort_output
+    sort_output = False
+
+
+def sort_for_output(frame, by, **kwargs):
+    """
+    :param frame: data frame about to be written by an output_format method
+    :type frame: pandas.DataFrame
+    :param by: columns to sort by
+    :type by: str or list of str
+    :return: the data frame sorted by the specified columns, unless output sorting is disabled
+    :rtype: pandas.DataFrame
+    """
+    if not sort_output:
+        return frame
+    columns = [by] if isinstance(by, str) else list(by)
+    categorical = [column for column in columns if hasattr(frame[column], "cat")]
+    if not categorical:
+        return frame.sort_values(by, **kwargs)
+    # Categoricals sort in the order of their categories, which for interned strings is the order in which they were
+    # first seen, so sort by keys whose categories are in string order instead.
+    keys = frame[columns].reset_index(drop=True)
+    for column in categorical:
+        values = keys[column].cat.remove_unused_categories()
+        keys[column] = values.cat.reorder_categories(sorted(values.cat.categories))
+    return frame.iloc[keys.sort_values(by, **kwargs).index]
+
+
+def enable_compact_loading():
+    """
+    Load question and answer strings in collated, judgment and answer files into shared dictionaries.
+
+    This greatly reduces the memory used by files that repeat long question and answer strings, such as collated
+    files, which repeat them for every system. Nullable boolean types require pandas 1.0 or later.
+    """
+    global interners
+    interners = {QUESTION: StringInterner(), ANSWER: StringInterner()}
+
+
+def compact(frame, categorical=(), boolean=()):
+    """
+    If compact loading is enabled, intern a data frame's question and answer columns and convert other columns to
+    compact types.
+
+    :param frame: data frame to modify in place
+    :type frame: pandas.DataFrame
+    :param categorical: names of columns to make categorical
+    :type categorical: list of str
+    :param boolean: names of columns to make nullable booleans
+    :type boolean: list of str
+    :return: the data frame
+    :rtype: pandas.DataFrame
+    """
+    if interners is not None:
+        for column, interner in interners.items():
+            if column in frame:
+                frame[column] = interner.intern(frame[column])
+        for column in categorical:
+            frame[column] = frame[column].astype("category")
+        for column in boolean:
+            frame[column] = frame[column].astype("boolean")
+    return frame
+
+
+def align_compact(frames):
+    """
+    Give the categorical columns of compactly loaded data frames the same categories so that they can be concatenated
+    and joined without being converted back to strings.
+
+    :param frames: data frames or lists of data frames, other values are ignored
+    :type frames: iterable
+    """
+    if interners is None:
+        return
+    frames = [frame for frame in itertools.chain.from_iterable(f if isinstance(f, list) else [f] for f in frames)
+              if isinstance(frame, pandas.DataFrame)]
+    categories = {}
+    for frame in frames:
+        for column in frame.columns:
+            if column not in interners and hasattr(frame[column], "cat"):
+                categories.setdefault(column, set()).update(frame[column].cat.categories)
+    for frame in frames:
+        for column in frame.columns:
+            if hasattr(frame[column], "cat"):
+                if column in interners:
+                    frame[column] = interners[column].align(frame[column])
+                else:
+                    frame[column] = frame[column].cat.set_categories(sorted(categories[column]))
 
 
 class CsvFileType(object):
     """Pandas CSV file type used with argparse
 
-    This allows you to specify the columns you wish to use and optionally rename them.
+    This allows you to specify the columns you wish to use and optionally rename them and set their types.
+
+    When used as an argparse type, a file name argument is returned as a CsvFile that is parsed the first time it is
+    used, so that parsing all the command line arguments does not read any files.
     """
 
-    def __init__(self, columns=None, rename=None):
+    def __init__(self, columns=None, rename=None, dtype=None):
         self.columns = columns
         self.rename = rename
+        self.dtype = dtype
+
+    def __eq__(self, other):
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(type(self))
 
     def __call__(self, filename):
+        path = filename.partition(WORKSPACE_SEPARATOR)[0] if workspace_reference(filename) else filename
+        if not os.path.isfile(path):
+            raise argparse.ArgumentTypeError("no such file: '%s'" % path)
+        return CsvFile(self, filename)
+
+    def read(self, filename, csv=None):
+        """
+        Read a data frame from a CSV file.
+
+        :param filename: name of the CSV file
+        :type filename: str
+        :param csv: data frame already parsed from the file containing at least this file type's columns, if None
+            parse the file
+        :type csv: pandas.DataFrame
+        :return: data frame with this file type's columns
+        :rtype: pandas.DataFrame
+        """
         try:
-            csv = from_csv(filename, usecols=self.columns)
+            if csv is None:
+                csv = from_csv(filename, usecols=self.columns, dtype=self.dtype)
+            elif self.columns is not None:
+                csv = csv[[column for column in csv.columns if column in self.columns]]
             if self.rename is not None:
                 csv = csv.rename(columns=self.rename)
             csv.filename = filename
@@ -58,10 +367,154 @@ class CsvFileType(object):
             raise e
 
 
+# CSV files named on the command line, indexed by their absolute paths.
+csv_files = {}
+
+
+class CsvFile(object):
+    """
+    A CSV file named on the command line that is parsed the first time it is used.
+
+    A file named in several arguments is only parsed once. The columns of all the file types it was named with are
+    read together, with their types, and each argument gets its own columns from the result. Arguments naming the same
+    file with the same file type share a single data frame.
+    """
+
+    def __init__(self, file_type, filename):
+        self.file_type = file_type
+        self.filename = filename
+        self.csv = None
+        csv_files.setdefault(os.path.abspath(filename), []).append(self)
+
+    def __repr__(self):
+        return "%s: %s" % (self.__class__.__name__, self.filename)
+
+    @stage("load inputs")
+    def load(self):
+        """
+        Parse the file if it has not already been parsed.
+
+        :return: data frame read by the file type
+        :rtype: pandas.DataFrame
+        """
+        if self.csv is None:
+            files = csv_files[os.path.abspath(self.filename)]
+            file_types = []
+            for csv_file in files:
+                if csv_file.file_type not in file_types:
+                    file_types.append(csv_file.file_type)
+            if any(file_type.columns is None for file_type in file_types):
+                columns = None
+            else:
+                columns = set(itertools.chain.from_iterable(file_type.columns for file_type in file_types))
+            dtype = {}
+            for file_type in file_types:
+                dtype.update(file_type.dtype or {})
+            logger.debug("Read %s for %d file types" % (self.filename, len(file_types)))
+            try:
+                csv = from_csv(self.filename, usecols=columns, dtype=dtype or None)
+            except ValueError as e:
+                print("Invalid format for %s: %s" % (self.filename, e), file=sys.stderr)
+                raise e
+            frames = {}
+            for i, file_type in enumerate(file_types):
+                # File types may modify the data frame they read. Selecting columns makes a copy, but a file type that
+                # reads all the columns only gets the parsed data frame itself if no other file type reads it.
+                if file_type.columns is None and i < len(file_types) - 1:
+                    frames[file_type] = file_type.read(self.filename, csv.copy())
+                else:
+                    frames[file_type] = file_type.read(self.filename, csv)
+            for csv_file in files:
+                csv_file.csv = frames[csv_file.file_type]
+        return self.csv
+
+
+def load_csv_files(value):
+    """
+    :param value: command line argument value, which may be a CSV file or a list of them
+    :type value: object
+    :return: the value with CSV files replaced by their data frames
+    :rtype: object
+    """
+    if isinstance(value, CsvFile):
+        return value.load()
+    if isinstance(value, list) and any(isinstance(v, CsvFile) for v in value):
+        return [load_csv_files(v) for v in value]
+    return value
+
+
+def lazy_file_type(module, name):
+    """
+    Refer to a CSV file type class without importing the module that defines it.
+
+    This returns a factory that may be used in place of the class when declaring command line arguments. Calling it
+    with the class's constructor arguments returns an argparse type that only imports the module and creates the file
+    type when an argument is parsed, so declaring a command's arguments does not import its implementation.
+
+    :param module: name of the module that defines the file type
+    :type module: str
+    :param name: name of the file type class
+    :type name: str
+    :return: factory for lazily created file types
+    :rtype: func
+    """
+
+    def factory(*args, **kwargs):
+        return LazyFileType(module, name, args, kwargs)
+
+    return factory
+
+
+class LazyFileType(object):
+    """
+    An argparse type that imports and creates a CSV file type when an argument is parsed.
+    """
+
+    def __init__(self, module, name, args=(), kwargs=None):
+        self.module = module
+        # Argparse uses the type's name in error messages.
+        self.__name__ = name
+        self.args = args
+        self.kwargs = kwargs or {}
+
+    def __repr__(self):
+        return "%s.%s" % (self.module, self.__name__)
+
+    def __call__(self, filename):
+        file_type = getattr(importlib.import_module(self.module), self.__name__)(*self.args, **self.kwargs)
+        return file_type(filename)
+
+
 def percent_complete_message(msg, n, total):
     return "%s %d of %d (%0.3f%%)" % (msg, n, total, 100.0 * n / total)
 
 
+def parallel_map(function, arguments, processes=None):
+    """
+    Apply a function to a list of arguments in a pool of worker processes.
+
+    The function must be a module-level function that can be pickled.
+
+    :param function: function to apply
+    :type function: func
+    :param arguments: arguments to apply the function to
+    :type arguments: list
+    :param processes: number of worker processes, if None use one per CPU, if 1 do not start any processes
+    :type processes: int
+    :return: function results in argument order
+    :rtype: list
+    """
+    if processes == 1 or len(arguments) < 2:
+        return [function(argument) for argument in arguments]
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(function, arguments, max(1, len(arguments) // (4 * processes)))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def pretty_print_json(j):
     return json.dumps(j, indent=2)
 
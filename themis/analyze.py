@@ -1,39 +1,122 @@
 import functools
+import heapq
+import hashlib
 import itertools
 import math, os
+import re
 
 import pandas
 import numpy as np
-from bs4 import BeautifulSoup
-from nltk import word_tokenize, FreqDist
 
-from themis import CsvFileType, QUESTION, ANSWER, CONFIDENCE, IN_PURVIEW, CORRECT, FREQUENCY, logger, ANSWER_ID
+from themis import CsvFileType, QUESTION, ANSWER, CONFIDENCE, IN_PURVIEW, CORRECT, FREQUENCY, logger, ANSWER_ID, \
+    unescape, parallel_map, to_csv, compact, sort_for_output
+from themis.profiling import stage
 
 SYSTEM = "System"
 ANSWERING_SYSTEM = "Answering System"
+ANSWER_HASH = "Answer Hash"
+PLAIN_TEXT = "Plain Text"
+TOKENS = "Tokens"
+FREQUENCY_BUCKET = "Frequency Bucket"
 
+HTML_TAG = re.compile(r"<[^>]*>")
+# Largest number of combinations of systems that oracle_search scores exhaustively, and the beam width it uses instead.
+EXHAUSTIVE_SEARCH_LIMIT = 2 ** 20
+DEFAULT_BEAM_WIDTH = 100
 
-def corpus_statistics(corpus):
+# Number of set bits in each byte value.
+BIT_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype="int64")
+
+# Words, possibly containing internal hyphens, apostrophes, or periods, and individual punctuation marks.
+TOKEN = re.compile(r"\w+(?:[-'.]\w+)*|[^\w\s]", re.UNICODE)
+
+
+def corpus_statistics(corpus, plaintext_filename=None, processes=None):
     """
     Generate statistics for the corpus.
 
     :param corpus: corpus generated by 'xmgr corpus' command
     :type corpus: pandas.DataFrame
+    :param plaintext_filename: optional plain text cache file, see corpus_plaintext
+    :type plaintext_filename: str
+    :param processes: number of processes extracting plain text in parallel, if None use one per CPU
+    :type processes: int
     :return: answers in corpus, tokens in the corpus, histogram of answer length in tokens
     :rtype: (int, int, dict(int, int))
     """
     answers = len(corpus)
-    token_frequency = FreqDist([len(word_tokenize(BeautifulSoup(answer, "lxml").text)) for answer in corpus[ANSWER]])
-    histogram = {}
-    for frequency, count in token_frequency.items():
-        histogram[frequency] = histogram.get(frequency, 0) + count
-    tokens = sum(token_frequency.keys())
+    plaintext = corpus_plaintext(corpus, plaintext_filename, processes)
+    histogram = dict((int(length), int(count)) for length, count in plaintext[TOKENS].value_counts().items())
+    tokens = int(plaintext[TOKENS].sum())
     n = sum(corpus.duplicated(ANSWER_ID))
     if n:
         logger.warning("%d duplicated answer IDs (%0.3f%%)" % (n, 100.0 * n / answers))
     return answers, tokens, histogram
 
 
+def corpus_plaintext(corpus, plaintext_filename=None, processes=None):
+    """
+    Get the plain text and number of tokens of every answer in the corpus.
+
+    Extracting plain text from the HTML answers is expensive, so the results may be cached in a file. Cache entries
+    are keyed by answer ID and a hash of the answer text, so only new or modified answers are extracted. The cache file
+    is rewritten with just the entries for the current corpus.
+
+    :param corpus: corpus generated by 'xmgr corpus' command
+    :type corpus: pandas.DataFrame
+    :param plaintext_filename: optional plain text cache file, if None do not cache
+    :type plaintext_filename: str
+    :param processes: number of processes extracting plain text in parallel, if None use one per CPU
+    :type processes: int
+    :return: answer ID, answer hash, plain text and number of tokens for each answer in the corpus
+    :rtype: pandas.DataFrame
+    """
+    answers = corpus[[ANSWER_ID, ANSWER]].fillna({ANSWER: ""})
+    answers[ANSWER_HASH] = [answer_hash(answer) for answer in answers[ANSWER]]
+    if plaintext_filename is not None and os.path.isfile(plaintext_filename):
+        cache = PlaintextFileType().read(plaintext_filename)
+    else:
+        cache = PlaintextFileType.create_empty()
+    key = [ANSWER_ID, ANSWER_HASH]
+    plaintext = pandas.merge(answers[key], cache, on=key, how="left")
+    missing = answers[plaintext[TOKENS].isnull().values].drop_duplicates(key)
+    if len(missing):
+        n = len(answers)
+        m = len(missing)
+        logger.info("Extract plain text from %d of %d answers (%0.3f%%)" % (m, n, 100.0 * m / n))
+        extracted = parallel_map(plaintext_token_count, list(missing[ANSWER]), processes)
+        missing = missing[key]
+        missing[PLAIN_TEXT] = [text for text, _ in extracted]
+        missing[TOKENS] = [tokens for _, tokens in extracted]
+        cache = pandas.concat([cache, missing])
+        plaintext = pandas.merge(answers[key], cache, on=key, how="left")
+    # Rewrite the cache if answers were added to it or it contains answers that are no longer in the corpus.
+    if plaintext_filename is not None and (len(missing) or not len(plaintext.drop_duplicates(key)) == len(cache)):
+        try:
+            to_csv(plaintext_filename, PlaintextFileType.output_format(plaintext))
+        except (IOError, OSError) as e:
+            logger.warning("Cannot write plain text cache %s: %s" % (plaintext_filename, e))
+    plaintext[TOKENS] = plaintext[TOKENS].astype("int")
+    return plaintext
+
+
+def answer_hash(answer):
+    return hashlib.sha1(answer.encode("utf-8")).hexdigest()
+
+
+def plaintext_token_count(html):
+    """
+    Strip markup from HTML text and count the tokens in it.
+
+    :param html: HTML text
+    :type html: str
+    :return: plain text and number of tokens
+    :rtype: (str, int)
+    """
+    text = unescape(HTML_TAG.sub("", html))
+    return text, len(TOKEN.findall(text))
+
+
 def truth_statistics(truth):
     """
     Generate statistics for the truth.
@@ -61,21 +144,7 @@ def system_similarity(systems_data):
     :rtype: pandas.DataFrame
     """
     systems_data = drop_missing(systems_data)
-    systems = systems_data[SYSTEM].drop_duplicates().sort_values()
-    columns = ["System 1", "System 2", "Same Answer", "Same Answer %"]
-    results = pandas.DataFrame(columns=columns)
-    for x, y in itertools.combinations(systems, 2):
-        data_x = systems_data[systems_data[SYSTEM] == x]
-        data_y = systems_data[systems_data[SYSTEM] == y]
-        m = pandas.merge(data_x, data_y, on=QUESTION)
-        n = len(m)
-        logger.info("%d question/answer pairs in common for %s and %s" % (n, x, y))
-        same_answer = sum(m["%s_x" % ANSWER] == m["%s_y" % ANSWER])
-        same_answer_pct = 100.0 * same_answer / n
-        results = results.append(
-            pandas.DataFrame([[x, y, same_answer, same_answer_pct]], columns=columns))
-    results["Same Answer"] = results["Same Answer"].astype("int64")
-    return results.set_index(["System 1", "System 2"])
+    return SystemMatrix(systems_data).similarity()
 
 
 def compare_systems(systems_data, x, y, comparison_type):
@@ -100,27 +169,31 @@ def compare_systems(systems_data, x, y, comparison_type):
         return type + " " + system
 
     systems_data = drop_missing(systems_data)
-    systems_data = systems_data[systems_data[IN_PURVIEW]]
-    data_x = systems_data[systems_data[SYSTEM] == x]
-    data_y = systems_data[systems_data[SYSTEM] == y][[QUESTION, ANSWER, CONFIDENCE, CORRECT]]
-    questions = pandas.merge(data_x, data_y, on=QUESTION, how="left", suffixes=(" " + x, " " + y)).dropna()
-    n = len(questions)
+    matrix = SystemMatrix(systems_data)
+    i = matrix.system_index(x)
+    j = matrix.system_index(y)
+    in_purview = matrix.in_purview == 1
+    shared = matrix.complete[:, i] & matrix.complete[:, j] & in_purview[:, i] & in_purview[:, j]
+    n = sum(shared)
     logger.info("%d shared question/answer pairs between %s and %s" % (n, x, y))
-    x_correct = col_name(CORRECT, x)
-    y_correct = col_name(CORRECT, y)
+    correct = matrix.correct == 1
     if comparison_type == "better":
-        a = questions[x_correct] == True
-        b = questions[y_correct] == False
+        d = shared & correct[:, i] & ~correct[:, j]
     elif comparison_type == "worse":
-        a = questions[x_correct] == False
-        b = questions[y_correct] == True
+        d = shared & ~correct[:, i] & correct[:, j]
     else:
         raise ValueError("Invalid comparison type %s" % comparison_type)
-    d = questions[a & b]
-    m = len(d)
-    logger.info("%d %s (%0.3f%%)" % (m, comparison_type, 100.0 * m / n))
-    d = d[[QUESTION, FREQUENCY,
-           col_name(ANSWER, x), col_name(CONFIDENCE, x), col_name(ANSWER, y), col_name(CONFIDENCE, y)]]
+    m = sum(d)
+    logger.info("%d %s (%0.3f%%)" % (m, comparison_type, 100.0 * m / n if n else 0))
+    columns = [QUESTION, FREQUENCY,
+               col_name(ANSWER, x), col_name(CONFIDENCE, x), col_name(ANSWER, y), col_name(CONFIDENCE, y)]
+    d = pandas.DataFrame(dict(zip(columns, [matrix.questions[d],
+                                            matrix.frequency[d, i].astype(systems_data[FREQUENCY].dtype),
+                                            matrix.answer_values[matrix.answers[d, i]],
+                                            matrix.confidence[d, i],
+                                            matrix.answer_values[matrix.answers[d, j]],
+                                            matrix.confidence[d, j]])),
+                         columns=columns)
     d = d.sort_values([col_name(CONFIDENCE, x), FREQUENCY, QUESTION], ascending=(False, False, True))
     return d.set_index(QUESTION)
 
@@ -138,16 +211,29 @@ def analyze_answers(systems_data, freq_le, freq_gr):
     :return: answer summary statistics
     :rtype: pandas.DataFrame
     """
-    total = "Total"
-    in_purview_percent = IN_PURVIEW + " %"
-    correct_percent = CORRECT + " %"
-    unique = "Unique"
     systems_data = pandas.concat(systems_data).dropna()
     if freq_le is not None:
         systems_data = systems_data[systems_data[FREQUENCY] <= freq_le]
     if freq_gr is not None:
         systems_data = systems_data[systems_data[FREQUENCY] > freq_gr]
-    systems = systems_data.groupby(SYSTEM)
+    return answer_summary(systems_data)
+
+
+@stage("aggregate")
+def answer_summary(systems_data):
+    """
+    Statistics about answered questions broken down by system.
+
+    :param systems_data: collated results for all systems with no missing values
+    :type systems_data: pandas.DataFrame
+    :return: answer summary statistics
+    :rtype: pandas.DataFrame
+    """
+    total = "Total"
+    in_purview_percent = IN_PURVIEW + " %"
+    correct_percent = CORRECT + " %"
+    unique = "Unique"
+    systems = systems_data.groupby(SYSTEM, observed=True)
     summary = systems[[IN_PURVIEW, CORRECT]].sum()
     summary[[IN_PURVIEW, CORRECT]] = summary[[IN_PURVIEW, CORRECT]].astype("int")
     summary[total] = systems.count()[QUESTION]
@@ -171,21 +257,39 @@ def truth_coverage(corpus, truth, systems_data):
     :return: truth coverage summary statistics
     :rtype: pandas.DataFrame
     """
+    systems_data = pandas.concat(systems_data).dropna()
+    return truth_summary(corpus, truth, systems_data)
+
+
+@stage("aggregate")
+def truth_summary(corpus, truth, systems_data):
+    """
+    Statistics about which answers came from the truth set broken down by system.
+
+    :param corpus: corpus generated by 'xmgr corpus' command
+    :type corpus: pandas.DataFrame
+    :param truth: question to answer mapping used in training
+    :type truth: pandas.DataFrame
+    :param systems_data: collated results for all systems with no missing values
+    :type systems_data: pandas.DataFrame
+    :return: truth coverage summary statistics
+    :rtype: pandas.DataFrame
+    """
     truth_answers = pandas.merge(corpus, truth, on=ANSWER_ID)[ANSWER].drop_duplicates()
     n = len(corpus)
     m = len(truth_answers)
     logger.info("%d answers out of %d possible answers in truth (%0.3f%%)" % (m, n, 100.0 * m / n))
-    systems_data = pandas.concat(systems_data).dropna()
-    answers = systems_data.groupby(SYSTEM)[[CORRECT]].count()
-    answers_in_truth = systems_data[systems_data[ANSWER].isin(truth_answers)].groupby(SYSTEM)[[ANSWER]]
+    answers = systems_data.groupby(SYSTEM, observed=True)[[CORRECT]].count()
+    answers_in_truth = \
+        systems_data[systems_data[ANSWER].isin(truth_answers)].groupby(SYSTEM, observed=True)[[ANSWER]]
     summary = answers_in_truth.count()
     summary["Answers"] = answers
     summary = summary.rename(columns={ANSWER: "Answers in Truth"})
     summary["Answers in Truth %"] = 100 * summary["Answers in Truth"] / summary["Answers"]
     correct_answers = systems_data[systems_data[CORRECT]]
     correct_answers_in_truth = correct_answers[correct_answers[ANSWER].isin(truth_answers)]
-    summary["Correct Answers"] = correct_answers.groupby(SYSTEM)[CORRECT].count()
-    summary["Correct Answers in Truth"] = correct_answers_in_truth.groupby(SYSTEM)[CORRECT].count()
+    summary["Correct Answers"] = correct_answers.groupby(SYSTEM, observed=True)[CORRECT].count()
+    summary["Correct Answers in Truth"] = correct_answers_in_truth.groupby(SYSTEM, observed=True)[CORRECT].count()
     summary["Correct Answers in Truth %"] = 100 * summary["Correct Answers in Truth"] / summary["Correct Answers"]
     return summary[
         ["Answers", "Correct Answers",
@@ -208,11 +312,112 @@ def long_tail_fat_head(frequency_cutoff, systems_data):
     :return: truth coverage summary statistics for the fat head and long tail
     :rtype: (pandas.DataFrame, pandas.DataFrame)
     """
-    fat_head = analyze_answers(systems_data, None, frequency_cutoff)
-    long_tail = analyze_answers(systems_data, frequency_cutoff, None)
+    systems_data = pandas.concat(systems_data).dropna()
+    return fat_head_long_tail_summaries(systems_data, frequency_cutoff)
+
+
+@stage("aggregate")
+def fat_head_long_tail_summaries(systems_data, frequency_cutoff):
+    """
+    Fat head and long tail answer summaries computed in a single pass.
+
+    :param systems_data: collated results for all systems with no missing values
+    :type systems_data: pandas.DataFrame
+    :param frequency_cutoff: question frequency dividing fat head from long tail
+    :type frequency_cutoff: int
+    :return: answer summary statistics for the fat head and long tail
+    :rtype: (pandas.DataFrame, pandas.DataFrame)
+    """
+    summary = frequency_bucket_summary(systems_data, [frequency_cutoff])
+    long_tail, fat_head = [bucket_summary(summary, bucket) for bucket in summary.index.levels[0]]
     return fat_head, long_tail
 
 
+def long_tail_buckets(systems_data, cut_points=None, quantiles=None, frequency_weighted=False):
+    """
+    Accuracy statistics broken down by question frequency buckets.
+
+    Buckets are delimited either by frequency cut points or by quantiles of the frequencies of the distinct questions.
+    Each bucket contains the questions with frequencies greater than its lower cut point and less than or equal to its
+    upper one.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame
+    :param cut_points: frequencies dividing the buckets
+    :type cut_points: list of float
+    :param quantiles: number of quantile buckets, used instead of cut points
+    :type quantiles: int
+    :param frequency_weighted: count each question as many times as it was asked
+    :type frequency_weighted: bool
+    :return: answer summary statistics for each bucket and system
+    :rtype: pandas.DataFrame
+    """
+    systems_data = pandas.concat(systems_data).dropna()
+    if quantiles is not None:
+        questions = systems_data.drop_duplicates(QUESTION)[FREQUENCY]
+        _, edges = pandas.qcut(questions, quantiles, retbins=True, duplicates="drop")
+        cut_points = edges[1:-1]
+    return frequency_bucket_summary(systems_data, cut_points, frequency_weighted)
+
+
+@stage("aggregate")
+def frequency_bucket_summary(systems_data, cut_points, frequency_weighted=False):
+    """
+    Answer summary statistics for each question frequency bucket and system in a single grouped aggregation.
+
+    :param systems_data: collated results for all systems with no missing values
+    :type systems_data: pandas.DataFrame
+    :param cut_points: frequencies dividing the buckets
+    :type cut_points: list of float
+    :param frequency_weighted: count each question as many times as it was asked
+    :type frequency_weighted: bool
+    :return: answer summary statistics indexed by bucket and system
+    :rtype: pandas.DataFrame
+    """
+    total = "Total"
+    in_purview_percent = IN_PURVIEW + " %"
+    correct_percent = CORRECT + " %"
+    unique = "Unique"
+    edges = [-np.inf] + sorted(cut_points) + [np.inf]
+    labels = [frequency_bucket_label(lower, upper) for lower, upper in zip(edges[:-1], edges[1:])]
+    buckets = pandas.cut(systems_data[FREQUENCY], edges, labels=labels).rename(FREQUENCY_BUCKET)
+    weight = systems_data[FREQUENCY] if frequency_weighted else pandas.Series(1, index=systems_data.index)
+    values = pandas.DataFrame({total: weight,
+                               IN_PURVIEW: weight * systems_data[IN_PURVIEW].astype("int"),
+                               CORRECT: weight * systems_data[CORRECT].astype("int"),
+                               unique: systems_data[ANSWER]})
+    summary = values.groupby([buckets, systems_data[SYSTEM]], observed=True).agg(
+        {total: "sum", IN_PURVIEW: "sum", CORRECT: "sum", unique: "nunique"})
+    summary[in_purview_percent] = summary[IN_PURVIEW] / summary[total] * 100.0
+    summary[correct_percent] = summary[CORRECT] / summary[IN_PURVIEW] * 100.0
+    summary = summary.reset_index().sort_values([FREQUENCY_BUCKET, correct_percent], ascending=(True, False))
+    summary[FREQUENCY_BUCKET] = summary[FREQUENCY_BUCKET].cat.set_categories(labels)
+    return summary.set_index([FREQUENCY_BUCKET, SYSTEM])[
+        [total, unique, IN_PURVIEW, in_purview_percent, CORRECT, correct_percent]]
+
+
+def frequency_bucket_label(lower, upper):
+    if np.isinf(lower):
+        return "%s <= %g" % (FREQUENCY, upper)
+    elif np.isinf(upper):
+        return "%s > %g" % (FREQUENCY, lower)
+    else:
+        return "%g < %s <= %g" % (lower, FREQUENCY, upper)
+
+
+def bucket_summary(summary, bucket):
+    """
+    :param summary: answer summary statistics indexed by bucket and system
+    :type summary: pandas.DataFrame
+    :param bucket: bucket label
+    :type bucket: str
+    :return: answer summary statistics for the systems in the bucket
+    :rtype: pandas.DataFrame
+    """
+    in_bucket = summary.index.get_level_values(FREQUENCY_BUCKET) == bucket
+    return summary[in_bucket].reset_index(FREQUENCY_BUCKET, drop=True)
+
+
 def in_purview_disagreement(systems_data):
     """
     Return collated data where in-purview judgments are not unanimous for a question.
@@ -224,17 +429,30 @@ def in_purview_disagreement(systems_data):
     :return: subset of collated data where the purview judgments are not unanimous for a question
     :rtype: pandas.DataFrame
     """
-    question_groups = systems_data[[QUESTION, IN_PURVIEW]].groupby(QUESTION)
-    index = question_groups.filter(lambda qg: len(qg[IN_PURVIEW].unique()) == 2).index
-    purview_disagreement = systems_data.loc[index]
-    m = len(purview_disagreement[QUESTION].drop_duplicates())
+    disagreement = purview_disagreement_questions(systems_data)
+    purview_disagreement = systems_data[systems_data[QUESTION].isin(disagreement)]
+    m = len(disagreement)
     if m:
-        n = len(systems_data[QUESTION].drop_duplicates())
+        n = systems_data[QUESTION].nunique()
         logger.warning("%d out of %d questions have non-unanimous in-purview judgments (%0.3f%%)"
                        % (m, n, 100.0 * m / n))
     return purview_disagreement
 
 
+def purview_disagreement_questions(systems_data):
+    """
+    Find the questions whose answers have exactly two distinct in-purview judgments, counting a missing judgment as a
+    value, so that a question with some answers judged and others not is included.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame
+    :return: questions whose in-purview judgments are not unanimous
+    :rtype: numpy.array
+    """
+    values = systems_data[[QUESTION, IN_PURVIEW]].groupby(QUESTION, observed=True)[IN_PURVIEW].nunique(dropna=False)
+    return np.asarray(values.index[values.values == 2])
+
+
 def oracle_combination(systems_data, system_names, oracle_name):
     """
     Combine results from multiple systems into a single oracle system. The oracle system gets a question correct if any
@@ -254,50 +472,154 @@ def oracle_combination(systems_data, system_names, oracle_name):
     :rtype: pandas.DataFrame
     """
 
-    def log_correct(system_data, name):
-        n = len(system_data)
-        m = sum(system_data[CORRECT])
+    def log_correct(n, m, name):
         logger.info("%d of %d correct in %s (%0.3f%%)" % (m, n, name, 100.0 * m / n))
 
-    percentile = "Percentile"
     systems_data = drop_missing(systems_data)
-    # Extract the systems of interest and map confidences to percentile rank.
-    systems = []
-    for system_name in system_names:
-        system = systems_data[systems_data[SYSTEM] == system_name].set_index(QUESTION)
-        system[percentile] = system[CONFIDENCE].rank(pct=True)
-        log_correct(system, system_name)
-        systems.append(system)
-    # Get the questions asked to all the systems.
-    questions = functools.reduce(lambda m, i: m.intersection(i), (system.index for system in systems))
-    # Start the oracle with a copy of one of the systems.
-    oracle = systems[0].loc[questions].copy()
-    oracle = oracle.drop([ANSWER, percentile], axis="columns")
-    oracle[SYSTEM] = oracle_name
+    matrix = SystemMatrix(systems_data)
+    systems = np.array([matrix.system_index(system_name) for system_name in system_names])
+    for system_name, system in zip(system_names, systems):
+        log_correct(sum(matrix.complete[:, system]), sum(matrix.correct[:, system] == 1), system_name)
+    # Map confidences to percentile rank and get the questions asked to all the systems.
+    percentiles = matrix.percentiles()[:, systems]
+    questions = matrix.complete[:, systems].all(axis=1)
+    percentiles = percentiles[questions]
     # An oracle question is in purview if all systems mark it as in purview. There should be consensus on this.
-    systems_in_purview = [system.loc[questions][[IN_PURVIEW]] for system in systems]
-    oracle[[IN_PURVIEW]] = functools.reduce(lambda m, x: m & x, systems_in_purview)
+    in_purview = (matrix.in_purview[questions][:, systems] == 1).all(axis=1)
     # An oracle question is correct if any system gets it right.
-    systems_correct = [system.loc[questions][[CORRECT]] for system in systems]
-    oracle[[CORRECT]] = functools.reduce(lambda m, x: m | x, systems_correct)
-    # If the oracle answer is correct, use the highest confidence.
-    confidences = [system[[percentile]].rename(columns={percentile: system[SYSTEM][0]}) for system in systems]
-    system_confidences = functools.reduce(lambda m, x: pandas.merge(m, x, left_index=True, right_index=True),
-                                          confidences)
-    correct = oracle[CORRECT].astype("bool")
-    oracle.loc[correct, CONFIDENCE] = system_confidences[correct].max(axis=1)
-    oracle.loc[correct, ANSWERING_SYSTEM] = system_confidences[correct].idxmax(axis=1)
-    # If the question is out of purview or the answer is incorrect, use the lowest confidence.
-    oracle.loc[~correct, CONFIDENCE] = system_confidences[~correct].min(axis=1)
-    oracle.loc[~correct, ANSWERING_SYSTEM] = system_confidences[~correct].idxmin(axis=1)
+    correct = (matrix.correct[questions][:, systems] == 1).any(axis=1)
+    # If the oracle answer is correct, use the highest confidence. If the question is out of purview or the answer is
+    # incorrect, use the lowest confidence.
+    choice = np.where(correct, percentiles.argmax(axis=1), percentiles.argmin(axis=1))
+    rows = np.arange(len(percentiles))
+    answering_systems = systems[choice]
     # Use the answer produced by the system incorporated into the oracle.
-    oracle = oracle.reset_index()
-    oracle[ANSWER] = pandas.merge(systems_data, oracle,
-                                  left_on=[QUESTION, SYSTEM], right_on=[QUESTION, ANSWERING_SYSTEM])[ANSWER]
-    log_correct(oracle, oracle_name)
+    oracle = pandas.DataFrame({
+        QUESTION: matrix.questions[questions],
+        SYSTEM: oracle_name,
+        ANSWERING_SYSTEM: matrix.systems[answering_systems],
+        ANSWER: matrix.answer_values[matrix.answers[questions][rows, answering_systems]],
+        CONFIDENCE: percentiles[rows, choice],
+        IN_PURVIEW: in_purview,
+        CORRECT: correct,
+        FREQUENCY: matrix.frequency[questions, systems[0]].astype(systems_data[FREQUENCY].dtype)
+    }, columns=OracleFileType.columns)
+    log_correct(len(oracle), sum(correct), oracle_name)
     return oracle
 
 
+@stage("search")
+def oracle_search(systems_data, system_names, max_size, top, beam_width):
+    """
+    Find the combinations of systems whose oracle gets the highest percentage of in-purview questions correct.
+
+    Combinations are scored on the questions answered by all the candidate systems. As in oracle_combination, a question
+    is in purview if all the systems in the combination say it is, and an in-purview question is correct if any of them
+    got it right. Each system's judgments are packed into bitsets once so that every combination is scored with a
+    few bitwise operations.
+
+    By default every combination up to the maximum size is scored, keeping only the best of each size. If a beam width
+    is specified, only combinations that extend one of the best combinations of the next smaller size are scored, which
+    is practical for large numbers of systems. A beam width of 1 is a greedy search. If there are more than
+    EXHAUSTIVE_SEARCH_LIMIT combinations to score, a beam search of width DEFAULT_BEAM_WIDTH is done instead.
+
+    The marginal gain of a combination is its correct percentage minus that of the best combination of one fewer of its
+    systems.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame
+    :param system_names: names of candidate systems, if None use all systems
+    :type system_names: list of str
+    :param max_size: largest combination to consider, if None consider combinations of all the systems
+    :type max_size: int
+    :param top: number of best combinations of each size to return
+    :type top: int
+    :param beam_width: number of combinations of each size to extend in a beam search, if None search exhaustively
+    :type beam_width: int
+    :return: best combinations of each size with their in purview, correct, correct percentage, and marginal gain
+    :rtype: pandas.DataFrame
+    """
+    systems_data = drop_missing(systems_data)
+    matrix = SystemMatrix(systems_data)
+    if system_names is None:
+        system_names = list(matrix.systems)
+    systems = [matrix.system_index(system_name) for system_name in system_names]
+    questions = matrix.complete[:, systems].all(axis=1)
+    logger.info("%d questions answered by all %d systems" % (sum(questions), len(systems)))
+    in_purview_bits = [np.packbits(questions & (matrix.in_purview[:, system] == 1)) for system in systems]
+    correct_bits = [np.packbits(questions & (matrix.correct[:, system] == 1)) for system in systems]
+    max_size = min(max_size or len(systems), len(systems))
+    n, combinations = 0, 1
+    for size in range(1, max_size + 1):
+        combinations = combinations * (len(systems) - size + 1) // size
+        n += combinations
+    if beam_width is None and n > EXHAUSTIVE_SEARCH_LIMIT:
+        beam_width = max(top, DEFAULT_BEAM_WIDTH)
+        logger.warning("%d combinations of %d systems are too many to search exhaustively, " % (n, len(systems)) +
+                       "doing a beam search of width %d instead" % beam_width)
+    scored = [0]
+
+    def score(in_purview, correct):
+        scored[0] += 1
+        correct = int(BIT_COUNTS[correct & in_purview].sum())
+        in_purview = int(BIT_COUNTS[in_purview].sum())
+        return 100.0 * correct / in_purview if in_purview else 0.0, correct, in_purview
+
+    def bits(combination):
+        return (functools.reduce(np.bitwise_and, (in_purview_bits[i] for i in combination)),
+                functools.reduce(np.bitwise_or, (correct_bits[i] for i in combination)))
+
+    # The best combinations of each size are kept in bounded min-heaps ordered by correct percentage, then number
+    # correct, then earliest scored, so that the worst of them can be replaced by a better one.
+    heaps = [[] for _ in range(max_size)]
+
+    def keep(combination, scores, n):
+        heap = heaps[len(combination) - 1]
+        entry = (scores[0], scores[1], -scored[0], combination, scores)
+        if len(heap) < n:
+            heapq.heappush(heap, entry)
+        elif entry[:3] > heap[0][:3]:
+            heapq.heapreplace(heap, entry)
+
+    def extend(combination, in_purview, correct):
+        # Depth-first enumeration of combinations that reuses the bitsets of the combination being extended.
+        for i in range(combination[-1] + 1 if combination else 0, len(systems)):
+            extended = combination + (i,)
+            extended_in_purview = in_purview_bits[i] if in_purview is None else in_purview & in_purview_bits[i]
+            extended_correct = correct_bits[i] if correct is None else correct | correct_bits[i]
+            keep(extended, score(extended_in_purview, extended_correct), top)
+            if len(extended) < max_size:
+                extend(extended, extended_in_purview, extended_correct)
+
+    def best(heap):
+        return [(combination, scores) for _, _, _, combination, scores in sorted(heap, reverse=True)]
+
+    if beam_width is None:
+        extend((), None, None)
+    else:
+        beam = [()]
+        for size in range(1, max_size + 1):
+            combinations = set(tuple(sorted(combination + (i,)))
+                               for combination in beam for i in range(len(systems)) if i not in combination)
+            for combination in combinations:
+                keep(combination, score(*bits(combination)), max(top, beam_width))
+            beam = [combination for combination, _ in best(heaps[size - 1])[:beam_width]]
+    logger.info("Scored %d combinations of %d systems" % (scored[0], len(systems)))
+    rows = []
+    for heap in heaps:
+        for combination, (correct_percent, correct, in_purview) in best(heap)[:top]:
+            if len(combination) > 1:
+                # Score the subsets of one fewer system on demand rather than keeping every score.
+                gain = correct_percent - max(score(*bits(subset))[0]
+                                             for subset in itertools.combinations(combination, len(combination) - 1))
+            else:
+                gain = np.nan
+            rows.append(("+".join(system_names[i] for i in combination), len(combination),
+                         in_purview, correct, correct_percent, gain))
+    columns = ["Systems", "Size", IN_PURVIEW, CORRECT, CORRECT + " %", "Marginal Gain"]
+    return pandas.DataFrame(rows, columns=columns).set_index("Systems")
+
+
 def filter_judged_answers(systems_data, correct, system_names):
     """
     Filter out just the correct or incorrect in-purview answers.
@@ -322,6 +644,7 @@ def filter_judged_answers(systems_data, correct, system_names):
     return filtered
 
 
+@stage("join")
 def add_judgments_and_frequencies_to_qa_pairs(qa_pairs, judgments, question_frequencies, remove_newlines):
     """
     Collate system answer confidences and annotator judgments by question/answer pair.
@@ -369,23 +692,46 @@ def drop_missing(systems_data):
     return systems_data
 
 
+def kfold_indexes(n, folds, strata=None, seed=None):
+    """
+    Randomly divide row positions into folds.
+
+    Without strata the rows are shuffled and divided into consecutive folds of equal size, except possibly the last
+    one. With strata the shuffled rows are ordered by stratum and dealt out to the folds in turn, so that each stratum
+    is spread as evenly as possible across the folds.
+
+    :param n: number of rows
+    :type n: int
+    :param folds: number of folds
+    :type folds: int
+    :param strata: stratum of each row, if None do not stratify
+    :type strata: sequence
+    :param seed: random seed, if None use numpy's global random state
+    :type seed: int
+    :return: row positions in each fold
+    :rtype: list of numpy.array
+    """
+    random = np.random if seed is None else np.random.RandomState(seed)
+    order = random.permutation(n)
+    if strata is None:
+        fold_size = int(math.ceil(n / float(folds)))
+        fold = np.arange(n) // max(1, fold_size)
+    else:
+        codes = pandas.factorize(np.asarray(strata))[0]
+        order = order[np.argsort(codes[order], kind="stable")]
+        fold = np.arange(n) % folds
+    return [order[fold == i] for i in range(folds)]
+
+
 def kfold_split(df, outdir, _folds = 5):
     # Randomize the order of the input dataframe
-    df = df.iloc[np.random.permutation(len(df))]
-    df = df.reset_index(drop=True)
-    foldSize = int(math.ceil(len(df) / float(_folds)))
+    folds = kfold_indexes(len(df), _folds)
     logger.info("Total records: " + str(len(df)))
-    logger.info("Fold size: " + str(foldSize))
+    logger.info("Fold size: " + str(len(folds[0])))
 
     for x in range(0, _folds):
-        fold_low = x*foldSize
-        fold_high = (x+1)*foldSize
-
-        if fold_high >= len(df):
-            fold_high = len(df)
-
-        test_df = df.iloc[fold_low:fold_high]
-        train_df = df.drop(df.index[fold_low:fold_high])
+        test_df = df.iloc[folds[x]]
+        train_df = df.iloc[np.concatenate([folds[i] for i in range(_folds) if i != x])]
 
         test_df.to_csv(os.path.join(outdir, 'Test' + str(x) + '.csv'), encoding='utf-8', index=False)
         train_df.to_csv(os.path.join(outdir, 'Train' + str(x) + '.csv'), header=False, encoding='utf-8', index=False)
@@ -394,15 +740,116 @@ def kfold_split(df, outdir, _folds = 5):
         logger.info("--- Test_Fold_" + str(x) + ' size = ' + str(len(test_df)))
 
 
+class SystemMatrix(object):
+    """
+    Collated results for multiple systems arranged as question by system arrays.
+
+    Rows correspond to questions and columns to systems, both in sorted order. Answers are stored as integer codes into
+    an array of answer values, with -1 for a missing answer. Confidences, in-purview and correct judgments, and
+    frequencies are stored as floating point values, with NaN for a missing value. This allows cross-system analyses to
+    be computed with vectorized array operations instead of repeated merges of the collated data.
+    """
+
+    @stage("join")
+    def __init__(self, systems_data):
+        systems_data = systems_data.dropna(subset=[QUESTION, SYSTEM])
+        duplicated = systems_data.duplicated([QUESTION, SYSTEM])
+        if any(duplicated):
+            m = sum(duplicated)
+            logger.warning("Ignoring %d duplicate answers to the same question from a single system" % m)
+            systems_data = systems_data[~duplicated]
+        question_codes, self.questions = pandas.factorize(systems_data[QUESTION], sort=True)
+        system_codes, self.systems = pandas.factorize(systems_data[SYSTEM], sort=True)
+        answer_codes, self.answer_values = pandas.factorize(systems_data[ANSWER])
+        self.questions = np.asarray(self.questions)
+        self.systems = np.asarray(self.systems)
+        self.answer_values = np.asarray(self.answer_values)
+        shape = (len(self.questions), len(self.systems))
+        self.answers = np.full(shape, -1, dtype="int64")
+        self.answers[question_codes, system_codes] = answer_codes
+        for attribute, column in [("confidence", CONFIDENCE), ("in_purview", IN_PURVIEW), ("correct", CORRECT),
+                                  ("frequency", FREQUENCY)]:
+            values = np.full(shape, np.nan)
+            values[question_codes, system_codes] = systems_data[column].astype("float")
+            setattr(self, attribute, values)
+        # Question/system pairs with all their values present.
+        self.complete = (self.answers >= 0) & ~np.isnan(self.confidence) & ~np.isnan(self.in_purview) & \
+                        ~np.isnan(self.correct) & ~np.isnan(self.frequency)
+
+    def __repr__(self):
+        return "%s: %d questions, %d systems" % (self.__class__.__name__, len(self.questions), len(self.systems))
+
+    def system_index(self, system):
+        """
+        :param system: system name
+        :type system: str
+        :return: column of the system in the arrays
+        :rtype: int
+        """
+        index = np.flatnonzero(self.systems == system)
+        if not len(index):
+            raise ValueError("No system named %s" % system)
+        return index[0]
+
+    def agreement(self):
+        """
+        For each pair of systems, count the questions they both answered and the ones they answered the same.
+
+        :return: system by system arrays of shared question counts and same answer counts
+        :rtype: (numpy.array, numpy.array)
+        """
+        complete = self.complete.astype("int64")
+        common = np.dot(complete.T, complete)
+        same = np.zeros(common.shape, dtype="int64")
+        for i in range(len(self.systems)):
+            same_answer = (self.answers == self.answers[:, [i]]) & self.complete & self.complete[:, [i]]
+            same[i] = same_answer.sum(axis=0)
+        return common, same
+
+    def similarity(self):
+        """
+        For each system pair, the number of questions they answered the same.
+
+        :return: table of pairs of systems and their similarity statistics
+        :rtype: pandas.DataFrame
+        """
+        common, same = self.agreement()
+        xs, ys = np.triu_indices(len(self.systems), 1)
+        for x, y in zip(xs, ys):
+            logger.info("%d question/answer pairs in common for %s and %s" %
+                        (common[x, y], self.systems[x], self.systems[y]))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            same_answer_pct = 100.0 * same[xs, ys] / common[xs, ys]
+        results = pandas.DataFrame({"System 1": self.systems[xs], "System 2": self.systems[ys],
+                                    "Same Answer": same[xs, ys].astype("int64"), "Same Answer %": same_answer_pct},
+                                   columns=["System 1", "System 2", "Same Answer", "Same Answer %"])
+        return results.set_index(["System 1", "System 2"])
+
+    def percentiles(self):
+        """
+        Percentile ranks of the confidences of each system's complete answers.
+
+        :return: question by system array of confidence percentile ranks, NaN where the answer is incomplete
+        :rtype: numpy.array
+        """
+        percentiles = np.full(self.confidence.shape, np.nan)
+        for i in range(len(self.systems)):
+            complete = self.complete[:, i]
+            percentiles[complete, i] = pandas.Series(self.confidence[complete, i]).rank(pct=True)
+        return percentiles
+
+
 class CollatedFileType(CsvFileType):
     columns = [QUESTION, SYSTEM, ANSWER, CONFIDENCE, IN_PURVIEW, CORRECT, FREQUENCY]
+    dtype = {QUESTION: str, SYSTEM: str, ANSWER: str, CONFIDENCE: float}
 
     def __init__(self):
-        super(self.__class__, self).__init__(self.__class__.columns)
+        super(self.__class__, self).__init__(self.__class__.columns, dtype=self.__class__.dtype)
 
-    def __call__(self, filename):
-        collated = super(self.__class__, self).__call__(filename)
-        m = sum(collated[collated[IN_PURVIEW] == False][CORRECT])
+    def read(self, filename, csv=None):
+        collated = super(self.__class__, self).read(filename, csv)
+        collated = compact(collated, categorical=[SYSTEM], boolean=[IN_PURVIEW, CORRECT])
+        m = collated[collated[IN_PURVIEW] == False][CORRECT].sum()
         if m:
             n = len(collated)
             logger.warning(
@@ -413,9 +860,35 @@ class CollatedFileType(CsvFileType):
     @classmethod
     def output_format(cls, collated):
         collated = collated[cls.columns]
-        collated = collated.sort_values([QUESTION, SYSTEM])
+        collated = sort_for_output(collated, [QUESTION, SYSTEM])
         return collated.set_index([QUESTION, SYSTEM, ANSWER])
 
 
+class PlaintextFileType(CsvFileType):
+    """
+    Plain text and token counts of corpus answers created by the 'analyze corpus' command.
+    """
+    columns = [ANSWER_ID, ANSWER_HASH, PLAIN_TEXT, TOKENS]
+
+    def __init__(self):
+        super(self.__class__, self).__init__(self.__class__.columns)
+
+    def read(self, filename, csv=None):
+        plaintext = super(self.__class__, self).read(filename, csv)
+        # Empty plain text is read as a null value.
+        plaintext[PLAIN_TEXT] = plaintext[PLAIN_TEXT].fillna("")
+        return plaintext
+
+    @classmethod
+    def create_empty(cls):
+        return pandas.DataFrame(columns=cls.columns)
+
+    @classmethod
+    def output_format(cls, plaintext):
+        plaintext = plaintext[cls.columns].drop_duplicates([ANSWER_ID, ANSWER_HASH])
+        plaintext = sort_for_output(plaintext, ANSWER_ID)
+        return plaintext.set_index(ANSWER_ID)
+
+
 class OracleFileType(CollatedFileType):
     columns = CollatedFileType.columns[:2] + [ANSWERING_SYSTEM] + CollatedFileType.columns[2:]
@@ -3,8 +3,9 @@ import re
 import pandas
 # noinspection PyPackageRequirements
 import solr
-from themis import logger, percent_complete_message, CsvFileType
+from themis import logger, CsvFileType, compact
 from themis.checkpoint import DataFrameCheckpoint
+from themis.telemetry import telemetry, timed
 from themis import QUESTION, ANSWER, CONFIDENCE
 
 
@@ -28,11 +29,13 @@ def answer_questions(system, questions, output_filename, checkpoint_frequency):
             logger.info("Recovered %d answers from %s" % (len(answers.recovered), output_filename))
         questions = sorted(questions - answers.recovered)
         n = len(answers.recovered) + len(questions)
+        job = telemetry.job("Question", n, len(answers.recovered))
         for i, question in enumerate(questions, len(answers.recovered) + 1):
             if i is 1 or i == n or i % checkpoint_frequency is 0:
-                logger.info(percent_complete_message("Question", i, n))
-            # NLC and Solr cannot handle newlines in questions.
-            answer, confidence = system.ask(question.replace("\n", " "))
+                logger.info(job.message())
+            with job.item():
+                # NLC and Solr cannot handle newlines in questions.
+                answer, confidence = system.ask(question.replace("\n", " "))
             logger.debug("%s\t%s\t%s" % (question, answer, confidence))
             answers.write(question, answer, confidence)
     finally:
@@ -72,6 +75,7 @@ class Solr(object):
     def __repr__(self):
         return "Solr: %s" % self.url
 
+    @timed("Solr.ask")
     def ask(self, question):
         question = self.escape_solr_query(question)
         logger.debug(question)
@@ -97,4 +101,8 @@ class AnswersFileType(CsvFileType):
     """
 
     def __init__(self):
-        super(self.__class__, self).__init__([QUESTION, ANSWER, CONFIDENCE])
+        super(self.__class__, self).__init__([QUESTION, ANSWER, CONFIDENCE],
+                                             dtype={QUESTION: str, ANSWER: str, CONFIDENCE: float})
+
+    def read(self, filename, csv=None):
+        return compact(super(self.__class__, self).read(filename, csv))
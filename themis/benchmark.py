@@ -0,0 +1,291 @@
+"""
+Measure the performance of the command line tool.
+
+The import time benchmark measures how long the command line takes to start. The scaling benchmark suite runs the hot
+paths of an experiment on synthetic data at a range of scales and records the time and memory each one uses, so that
+the results of different versions can be compared.
+"""
+import json
+import logging
+import os
+import subprocess
+import sys
+import timeit
+
+import pandas
+
+from themis import logger, __version__
+from themis.profiling import megabytes
+
+COMMAND = "Command"
+MODULES = "Modules"
+SECONDS = "Seconds"
+VERSION = "Version"
+BENCHMARK = "Benchmark"
+ROWS = "Rows"
+PEAK_RSS = "Peak RSS MB"
+STATUS = "Status"
+BASELINE_SECONDS = "Baseline Seconds"
+SECONDS_RATIO = "Seconds Ratio"
+BASELINE_PEAK_RSS = "Baseline Peak RSS MB"
+PEAK_RSS_RATIO = "Peak RSS Ratio"
+REGRESSION = "Regression"
+
+SUCCESS = "success"
+FAILED = "failed"
+TIMEOUT = "timeout"
+
+QUESTION_EXTRACT = "question extract"
+ANALYZE_COLLATE = "analyze collate"
+ANALYZE_PLOT = "analyze plot"
+ANALYZE_ORACLE = "analyze oracle"
+CHECKPOINT = "checkpoint"
+# Benchmarks in the order in which they run. Later benchmarks read the output of earlier ones.
+BENCHMARKS = [QUESTION_EXTRACT, ANALYZE_COLLATE, ANALYZE_PLOT, ANALYZE_ORACLE, CHECKPOINT]
+
+# Name of the file in a synthetic data directory that records the parameters the data was generated with.
+SYNTHETIC_FILENAME = "synthetic.json"
+
+# Print the time taken to import modules after the themis package has been imported.
+IMPORT_SCRIPT = """
+import sys, time
+import themis
+start = time.time()
+for module in sys.argv[1:]:
+    __import__(module)
+print(time.time() - start)
+"""
+
+# Print the time taken to import the themis package.
+PACKAGE_SCRIPT = """
+import time
+start = time.time()
+import themis
+print(time.time() - start)
+"""
+
+# Get an item for every question in a Q&A pairs file and write them to a checkpoint, recording a profile.
+CHECKPOINT_SCRIPT = """
+import sys
+import pandas
+from themis import QUESTION
+from themis.checkpoint import get_items, DataFrameCheckpoint
+from themis.profiling import start_profiling, stop_profiling, write_profile, stage
+qa_pairs, output, profile = sys.argv[1:]
+questions = pandas.read_csv(qa_pairs, usecols=[QUESTION], encoding="utf-8")[QUESTION]
+start_profiling()
+with stage("checkpoint"):
+    get_items("Question", questions, DataFrameCheckpoint(output, [QUESTION, "Length"], 100), len, 1000)
+write_profile(profile, stop_profiling())
+"""
+
+
+def import_times(command_modules, repeat):
+    """
+    Measure the command line startup time and the time taken to import the modules that implement each command.
+
+    Every measurement is made in a fresh Python process so that no modules are already imported, and the fastest of
+    the repeated measurements is reported. Command module times do not include the time taken to import the themis
+    package, which is always imported at startup. A command whose modules cannot be imported, for instance because an
+    optional dependency is not installed, has a missing time.
+
+    :param command_modules: commands and the modules that implement them
+    :type command_modules: list of (str, list of str)
+    :param repeat: number of times to measure each import
+    :type repeat: int
+    :return: import time in seconds for the themis package, the startup of the 'version' command, and each command
+    :rtype: pandas.DataFrame
+    """
+    rows = [("themis", "themis", fastest(lambda: float(python_output(["-c", PACKAGE_SCRIPT])), repeat)),
+            ("version", "themis.main", fastest(lambda: timed(["-m", "themis.main", "version"]), repeat))]
+    for command, modules in command_modules:
+        try:
+            seconds = fastest(lambda: float(python_output(["-c", IMPORT_SCRIPT] + modules)), repeat)
+        except subprocess.CalledProcessError:
+            logger.warning("Cannot import modules for %s command: %s" % (command, ", ".join(modules)))
+            seconds = None
+        rows.append((command, " ".join(modules), seconds))
+    return pandas.DataFrame(rows, columns=[COMMAND, MODULES, SECONDS]).set_index(COMMAND)
+
+
+def fastest(measure, repeat):
+    return min(measure() for _ in range(repeat))
+
+
+def python_output(arguments):
+    return subprocess.check_output([sys.executable] + arguments, stderr=subprocess.STDOUT).decode("utf-8")
+
+
+def timed(arguments):
+    start = timeit.default_timer()
+    python_output(arguments)
+    return timeit.default_timer() - start
+
+
+def run_benchmarks(directory, scales, systems=3, benchmarks=None, repeat=1, timeout=None, seed=0):
+    """
+    Run the scaling benchmark suite.
+
+    For each scale, a usage log with that many rows and the rest of an experiment's files are generated in a
+    subdirectory of the specified directory, unless they have already been generated there. The benchmarks are then
+    run on these files in order, each in a fresh Python process with profiling enabled, and the fastest of the repeated
+    runs and the largest peak resident set size are reported. The profile of each benchmark's last run, which breaks
+    its time and memory down by stage, and its log are kept in the data directory.
+
+    :param directory: directory in which to generate the data and run the benchmarks
+    :type directory: str
+    :param scales: numbers of usage log rows
+    :type scales: list of int
+    :param systems: number of systems that answer the questions
+    :type systems: int
+    :param benchmarks: names of the benchmarks to run, if None run all of them
+    :type benchmarks: list of str
+    :param repeat: number of times to run each benchmark
+    :type repeat: int
+    :param timeout: seconds after which to stop a benchmark, if None never stop
+    :type timeout: float
+    :param seed: random number generator seed for the synthetic data
+    :type seed: int
+    :return: time and peak memory of each benchmark at each scale
+    :rtype: pandas.DataFrame
+    """
+    from themis.pipeline import themis_environment
+
+    environment = themis_environment()
+    benchmarks = [b for b in BENCHMARKS if benchmarks is None or b in benchmarks]
+    results = []
+    for rows in scales:
+        data_directory = synthetic_data(os.path.join(directory, "rows-%d" % rows), rows, systems, seed)
+        for benchmark in benchmarks:
+            runs = [run_benchmark(benchmark, data_directory, systems, environment, timeout) for _ in range(repeat)]
+            status = next((s for _, _, s in runs if s != SUCCESS), SUCCESS)
+            if status == SUCCESS:
+                seconds = min(s for s, _, _ in runs)
+                peak = max(p or 0 for _, p, _ in runs) or None
+                logger.info("Benchmark %s, %d rows: %0.3f seconds, peak RSS %s MB" %
+                            (benchmark, rows, seconds, megabytes(peak)))
+            else:
+                seconds = peak = None
+                logger.warning("Benchmark %s, %d rows: %s" % (benchmark, rows, status))
+            results.append((__version__, benchmark, rows, seconds, None if peak is None else peak / 2.0 ** 20, status))
+    results = pandas.DataFrame(results, columns=[VERSION, BENCHMARK, ROWS, SECONDS, PEAK_RSS, STATUS])
+    return results.set_index([BENCHMARK, ROWS])
+
+
+def synthetic_data(directory, rows, systems, seed):
+    """
+    Generate synthetic data in a directory unless it was already generated there with the same parameters.
+
+    :return: the directory
+    :rtype: str
+    """
+    from themis.synthetic import generate_experiment
+
+    parameters = {"rows": rows, "systems": systems, "seed": seed, "version": __version__}
+    filename = os.path.join(directory, SYNTHETIC_FILENAME)
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            if json.load(f) == parameters:
+                logger.info("Use synthetic data in %s" % directory)
+                return directory
+    generate_experiment(directory, rows, systems, seed)
+    with open(filename, "w") as f:
+        json.dump(parameters, f)
+    return directory
+
+
+def benchmark_command(benchmark, systems, profile):
+    """
+    :param benchmark: benchmark name
+    :type benchmark: str
+    :param systems: number of systems in the synthetic data
+    :type systems: int
+    :param profile: name of the file to which to write the profile
+    :type profile: str
+    :return: Python arguments that run the benchmark, and the name of the file that receives its standard output
+    :rtype: (list of str, str)
+    """
+    from themis.synthetic import USAGE_LOG_FILENAME, JUDGMENTS_FILENAME, ANSWERS_FILENAME, system_name
+
+    if benchmark == CHECKPOINT:
+        return ["-c", CHECKPOINT_SCRIPT, "qa-pairs.csv", "checkpoint.csv", profile], None
+    if benchmark == QUESTION_EXTRACT:
+        arguments, stdout = ["question", "extract", USAGE_LOG_FILENAME], "qa-pairs.csv"
+    elif benchmark == ANALYZE_COLLATE:
+        answers = [ANSWERS_FILENAME % system_name(i) for i in range(systems)]
+        labels = [system_name(i) for i in range(systems)]
+        arguments, stdout = ["analyze", "collate", "qa-pairs.csv"] + answers + ["--labels"] + labels + \
+                            ["--judgments", JUDGMENTS_FILENAME], "collated.csv"
+    elif benchmark == ANALYZE_PLOT:
+        arguments, stdout = ["analyze", "plot", "precision", "collated.csv", "--output", "curves"], None
+    elif benchmark == ANALYZE_ORACLE:
+        arguments, stdout = ["analyze", "oracle", "collated.csv"] + [system_name(i) for i in range(systems)], \
+                            "oracle.csv"
+    else:
+        raise ValueError("Unknown benchmark %s" % benchmark)
+    level = logging.getLevelName(logger.getEffectiveLevel())
+    return ["-m", "themis.main", "--log", level, "--profile", profile] + arguments, stdout
+
+
+def run_benchmark(benchmark, directory, systems, environment, timeout):
+    """
+    Run a benchmark once in a separate process.
+
+    :return: profiled time in seconds, peak resident set size in bytes, and status
+    :rtype: (float, int, str)
+    """
+    name = benchmark.replace(" ", "-")
+    profile = "profile.%s.json" % name
+    arguments, stdout = benchmark_command(benchmark, systems, profile)
+    if benchmark == CHECKPOINT and os.path.exists(os.path.join(directory, "checkpoint.csv")):
+        # Start from an empty checkpoint so that no items are recovered from a previous run.
+        os.remove(os.path.join(directory, "checkpoint.csv"))
+    logger.debug("Run benchmark %s in %s" % (benchmark, directory))
+    with open(os.path.join(directory, stdout or os.devnull), "wb") as out, \
+            open(os.path.join(directory, "benchmark.%s.log" % name), "wb") as log:
+        try:
+            return_code = subprocess.call([sys.executable] + arguments, cwd=directory, env=environment,
+                                          stdout=out, stderr=log, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return None, None, TIMEOUT
+    if return_code != 0:
+        return None, None, FAILED
+    # The profiled time excludes interpreter startup, which the import time benchmark measures.
+    with open(os.path.join(directory, profile)) as f:
+        summary = json.load(f)
+    return summary["seconds"], summary["peak_rss_bytes"], SUCCESS
+
+
+def compare_benchmarks(results, baseline, tolerance):
+    """
+    Compare benchmark results with the results of a baseline run, such as the previous release.
+
+    A benchmark has regressed if it took longer or used more memory than the baseline by more than the tolerance, or if
+    it completed in the baseline but not now.
+
+    :param results: benchmark results returned by run_benchmarks
+    :type results: pandas.DataFrame
+    :param baseline: baseline benchmark results
+    :type baseline: pandas.DataFrame
+    :param tolerance: fractional increase in time or memory that is not a regression
+    :type tolerance: float
+    :return: benchmark results with the baseline results, the ratios to them, and whether each benchmark regressed
+    :rtype: pandas.DataFrame
+    """
+    baseline = baseline.set_index([BENCHMARK, ROWS])[[SECONDS, PEAK_RSS]]
+    baseline.columns = [BASELINE_SECONDS, BASELINE_PEAK_RSS]
+    comparison = results.join(baseline)
+    comparison[SECONDS_RATIO] = comparison[SECONDS] / comparison[BASELINE_SECONDS]
+    comparison[PEAK_RSS_RATIO] = comparison[PEAK_RSS] / comparison[BASELINE_PEAK_RSS]
+    # A benchmark that no longer completes has also regressed.
+    comparison[REGRESSION] = (comparison[SECONDS_RATIO] > 1 + tolerance) | \
+                             (comparison[PEAK_RSS_RATIO] > 1 + tolerance) | \
+                             ((comparison[STATUS] != SUCCESS) & comparison[BASELINE_SECONDS].notnull())
+    for (benchmark, rows), comparison_row in comparison[comparison[REGRESSION]].iterrows():
+        if comparison_row[STATUS] != SUCCESS:
+            logger.warning("Benchmark %s, %d rows regressed: %s" % (benchmark, rows, comparison_row[STATUS]))
+        else:
+            logger.warning("Benchmark %s, %d rows regressed: %0.2f times the baseline time, %0.2f times the peak RSS" %
+                           (benchmark, rows, comparison_row[SECONDS_RATIO], comparison_row[PEAK_RSS_RATIO]))
+    return comparison[[VERSION, SECONDS, BASELINE_SECONDS, SECONDS_RATIO,
+                       PEAK_RSS, BASELINE_PEAK_RSS, PEAK_RSS_RATIO, STATUS, REGRESSION]]
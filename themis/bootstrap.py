@@ -0,0 +1,184 @@
+"""
+Bootstrap confidence intervals for system accuracy and curve metrics.
+
+Questions are resampled with replacement. A resample is represented by a vector of weights that count how many times
+each question was drawn, so a batch of replicates is a replicate by question weight matrix and every metric is computed
+for all the replicates in the batch with matrix operations. All systems share the same resamples.
+"""
+import multiprocessing
+
+import numpy as np
+import pandas
+
+from themis import CORRECT, IN_PURVIEW, logger, parallel_map
+from themis.analyze import SYSTEM, SystemMatrix, drop_missing
+from themis.profiling import stage
+
+METRIC = "Metric"
+ESTIMATE = "Estimate"
+LOWER = "Lower"
+UPPER = "Upper"
+AUC = "AUC"
+
+# Maximum number of elements in a replicate by question weight matrix.
+BATCH_ELEMENTS = 2 ** 22
+
+
+@stage("resample")
+def bootstrap(systems_data, replicates, level, thresholds=(), frequency_weighted=False, seed=None, processes=None):
+    """
+    Bootstrap confidence intervals for each system's correct percentage, in-purview percentage, area under the ROC
+    curve, and precision at confidence thresholds.
+
+    The metrics are defined as in 'analyze answers' and the curves in 'plot'. By default each question counts once. If
+    the metrics are frequency weighted each question counts as many times as it was asked, which is how the curves are
+    drawn.
+
+    Replicates are generated in batches that may be computed in parallel. Each batch has its own random seed derived
+    from the specified one, so the intervals do not depend on the number of processes.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame
+    :param replicates: number of bootstrap replicates
+    :type replicates: int
+    :param level: confidence level as a percentage
+    :type level: float
+    :param thresholds: confidence thresholds at which to compute precision
+    :type thresholds: list of float
+    :param frequency_weighted: weight questions by their frequency
+    :type frequency_weighted: bool
+    :param seed: random seed, if None use a random one
+    :type seed: int
+    :param processes: number of processes computing replicates in parallel, if None use one per CPU
+    :type processes: int
+    :return: estimate and confidence interval of each metric for each system
+    :rtype: pandas.DataFrame
+    """
+    systems_data = drop_missing(systems_data)
+    matrix = SystemMatrix(systems_data)
+    systems = [system_arrays(matrix, i, frequency_weighted) for i in range(len(matrix.systems))]
+    n = len(matrix.questions)
+    estimates = system_metrics(np.ones((1, n)), systems, thresholds)
+    entropy = np.random.SeedSequence(seed).entropy
+    batch_size = max(1, BATCH_ELEMENTS // max(1, n))
+    batches = [(entropy, batch, min(batch_size, replicates - start))
+               for batch, start in enumerate(range(0, replicates, batch_size))]
+    logger.info("%d replicates of %d questions in %d batches" % (replicates, n, len(batches)))
+    # Give each process a few contiguous groups of batches so that the system arrays are only sent to it a few times.
+    tasks = 1 if processes == 1 else 4 * (processes or multiprocessing.cpu_count())
+    groups = [batches[i::tasks] for i in range(min(tasks, len(batches)))]
+    samples = np.concatenate(parallel_map(bootstrap_batches, [(systems, thresholds, n, group) for group in groups],
+                                          processes), axis=1)
+    tail = (100.0 - level) / 2
+    with np.errstate(all="ignore"):
+        lower, upper = np.nanpercentile(samples, [tail, 100.0 - tail], axis=1)
+    metrics = metric_names(thresholds)
+    rows = []
+    for i, system in enumerate(matrix.systems):
+        for j, metric in enumerate(metrics):
+            rows.append((system, metric, estimates[i, 0, j], lower[i, j], upper[i, j]))
+    return pandas.DataFrame(rows, columns=[SYSTEM, METRIC, ESTIMATE, LOWER, UPPER]).set_index([SYSTEM, METRIC])
+
+
+def metric_names(thresholds):
+    return [CORRECT + " %", IN_PURVIEW + " %", AUC] + ["Precision @ %g" % t for t in thresholds]
+
+
+def system_arrays(matrix, i, frequency_weighted):
+    """
+    Arrange a system's complete answers in descending order of confidence.
+
+    :param matrix: collated results for all systems
+    :type matrix: SystemMatrix
+    :param i: column of the system in the matrix
+    :type i: int
+    :param frequency_weighted: weight questions by their frequency
+    :type frequency_weighted: bool
+    :return: question indexes, confidences, question weights, in purview, correct, and out of purview weights, and the
+        positions of correct and out-of-purview answers with the number of correct answers ranked above each
+        out-of-purview answer
+    :rtype: dict
+    """
+    questions = np.flatnonzero(matrix.complete[:, i])
+    questions = questions[np.argsort(-matrix.confidence[questions, i], kind="stable")]
+    confidence = matrix.confidence[questions, i]
+    if frequency_weighted:
+        weight = matrix.frequency[questions, i]
+    else:
+        weight = np.ones(len(questions))
+    in_purview = matrix.in_purview[questions, i]
+    correct = weight * matrix.correct[questions, i]
+    out_of_purview = weight * (1 - in_purview)
+    # Answers with the same confidence are a single step of the ROC curve. For each out-of-purview answer, find the
+    # number of correct answers with a higher confidence and the number with a higher or equal confidence.
+    step = np.append(0, np.cumsum(confidence[1:] != confidence[:-1]))
+    correct_positions = np.flatnonzero(correct)
+    out_of_purview_positions = np.flatnonzero(out_of_purview)
+    above = np.searchsorted(step[correct_positions], step[out_of_purview_positions], side="left")
+    through = np.searchsorted(step[correct_positions], step[out_of_purview_positions], side="right")
+    return {"questions": questions, "confidence": confidence, "weight": weight,
+            "in_purview": weight * in_purview, "correct": correct, "out_of_purview": out_of_purview,
+            "correct_positions": correct_positions, "out_of_purview_positions": out_of_purview_positions,
+            "above": above, "through": through}
+
+
+def bootstrap_batches(task):
+    """
+    Compute metrics for batches of bootstrap replicates.
+
+    :param task: system arrays, confidence thresholds, number of questions, and batches of replicates to compute, each
+        specified by a seed, a batch number, and a number of replicates
+    :type task: (list of dict, list of float, int, list of (int, int, int))
+    :return: system by replicate by metric array
+    :rtype: numpy.array
+    """
+    systems, thresholds, n, batches = task
+    samples = []
+    for entropy, batch, size in batches:
+        random = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(batch,)))
+        # Count the number of times each question is drawn in each replicate.
+        draws = random.integers(0, n, (size, n)) + n * np.arange(size)[:, np.newaxis]
+        weights = np.bincount(draws.ravel(), minlength=size * n).reshape(size, n).astype("float")
+        samples.append(system_metrics(weights, systems, thresholds))
+    return np.concatenate(samples, axis=1)
+
+
+def system_metrics(weights, systems, thresholds):
+    """
+    Compute metrics for question resamples.
+
+    :param weights: replicate by question array of the number of times each question was drawn
+    :type weights: numpy.array
+    :param systems: system arrays created by system_arrays
+    :type systems: list of dict
+    :param thresholds: confidence thresholds at which to compute precision
+    :type thresholds: list of float
+    :return: system by replicate by metric array
+    :rtype: numpy.array
+    """
+    metrics = np.full((len(systems), len(weights), 3 + len(thresholds)), np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i, system in enumerate(systems):
+            w = weights[:, system["questions"]]
+            total = np.dot(w, system["weight"])
+            in_purview = np.dot(w, system["in_purview"])
+            correct = np.dot(w, system["correct"])
+            out_of_purview = np.dot(w, system["out_of_purview"])
+            metrics[i, :, 0] = 100.0 * correct / in_purview
+            metrics[i, :, 1] = 100.0 * in_purview / total
+            # The trapezoidal area under the ROC curve is the sum over out-of-purview answers of their weight times the
+            # weight of correct answers with a higher confidence, counting correct answers with the same confidence as
+            # half, normalized by the total in-purview and out-of-purview weights.
+            positions = system["correct_positions"]
+            correct_above = np.zeros((len(w), len(positions) + 1))
+            np.cumsum(w[:, positions] * system["correct"][positions], axis=1, out=correct_above[:, 1:])
+            positions = system["out_of_purview_positions"]
+            area = np.sum(w[:, positions] * system["out_of_purview"][positions] *
+                          (correct_above[:, system["above"]] + correct_above[:, system["through"]]), axis=1) / 2
+            metrics[i, :, 2] = area / (in_purview * out_of_purview)
+            for j, t in enumerate(thresholds):
+                # Answers are in descending order of confidence, so the attempted ones come first.
+                k = np.sum(system["confidence"] >= t)
+                metrics[i, :, 3 + j] = np.dot(w[:, :k], system["correct"][:k]) / \
+                    np.dot(w[:, :k], system["in_purview"][:k])
+    return metrics
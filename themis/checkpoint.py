@@ -2,18 +2,28 @@
 Checkpointing provides a framework for writing intermediary results of long-running operations to disk so that they can
 resume where they left off if they fail in the middle.
 """
+import itertools
+import multiprocessing
 import time
 
 import pandas
 
-from themis import logger, percent_complete_message
+from themis import logger, from_csv, open_file
+from themis.telemetry import telemetry
 
 
-def get_items(item_type, names, checkpoint, get_item, write_frequency):
+def get_items(item_type, names, checkpoint, get_item, write_frequency, processes=1, read_items=None):
     """
     Given a list of item names and a checkpoint, this function recovers any previously checkpointed items, then gets
     the remaining items and writes them to a checkpoint.
 
+    Items may optionally be gotten in parallel by a pool of worker processes, in which case get_item must be a
+    module-level function that can be pickled.
+
+    By default get_item is called with an item's name. If a read_items function is specified, it is called with the
+    sorted names of the items to get and returns (name, argument) pairs in any order, and get_item is called with the
+    argument instead. This allows item sources such as archives to be read in a single sequential pass.
+
     :param item_type: name of item type for use in logging
     :type item_type: str
     :param names: list of item names
@@ -24,6 +34,10 @@ def get_items(item_type, names, checkpoint, get_item, write_frequency):
     :type get_item: func
     :param write_frequency: how often to log a process message
     :type write_frequency: int
+    :param processes: number of worker processes, if None use one per CPU
+    :type processes: int
+    :param read_items: optional function that generates (name, argument) pairs for get_item from a list of names
+    :type read_items: func
     :return: the checkpoint
     :rtype: DataFrameCheckpoint
     """
@@ -32,31 +46,76 @@ def get_items(item_type, names, checkpoint, get_item, write_frequency):
         logger.info("Recovered %d %s from previous run" % (len(recovered), item_type))
     total = len(names)
     start = 1 + len(recovered)
+    pool = None
     try:
         names_to_get = sorted(set(names) - recovered)
-        for i, name in enumerate(names_to_get, start):
+        if read_items is None:
+            arguments = ((name, name) for name in names_to_get)
+        else:
+            arguments = read_items(names_to_get)
+        if processes is None or processes > 1:
+            processes = processes or multiprocessing.cpu_count()
+            pool = multiprocessing.Pool(processes)
+            items = map_in_batches(pool, processes, get_item, arguments, len(names_to_get), write_frequency)
+        else:
+            items = ((name, get_item(argument)) for name, argument in arguments)
+        job = telemetry.job(item_type, total, len(recovered))
+        for i, (name, item) in enumerate(items, start):
+            job.complete()
             if i == start or i == total or i % write_frequency == 0:
-                logger.info("Get " + percent_complete_message(item_type, i, total))
-            item = get_item(name)
+                logger.info("Get " + job.message())
             checkpoint.write(name, item)
     finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
         checkpoint.close()
     return checkpoint
 
 
+def map_in_batches(pool, processes, get_item, arguments, n, write_frequency):
+    """
+    Map a function over (name, argument) pairs in a process pool, generating (name, item) pairs.
+
+    The arguments are handed to the pool in bounded batches so that a large or lazily generated set of arguments is
+    never read into memory all at once.
+    """
+    # Hand out work in chunks large enough to amortize interprocess communication but small enough to keep all the
+    # workers busy.
+    chunksize = max(1, min(write_frequency, n // (4 * processes)))
+    batch_size = 4 * processes * chunksize
+    arguments = iter(arguments)
+    while True:
+        batch = list(itertools.islice(arguments, batch_size))
+        if not batch:
+            break
+        batch_names = [name for name, _ in batch]
+        items = pool.map(get_item, [argument for _, argument in batch], chunksize)
+        for name, item in zip(batch_names, items):
+            yield name, item
+
+
 class DataFrameCheckpoint(object):
+    """
+    Items written to a CSV file in batches.
+
+    The file may be compressed. Each batch is appended to it as a separate compressed segment, which is complete as
+    soon as it has been written, so a checkpoint interrupted between batches can still be recovered.
+    """
+
     def __init__(self, output_filename, columns, interval=None):
         try:
-            recovered = pandas.read_csv(open(output_filename), usecols=[0], encoding="utf-8")
+            recovered = from_csv(output_filename, usecols=[0])
             self.recovered = set(recovered[recovered.columns[0]])
             self.need_header = False
             logger.debug("Recovered %d items from disk" % len(self.recovered))
         except IOError:
             self.recovered = set()
             self.need_header = True
-        except ValueError:
+        except (ValueError, EOFError):
+            # A compressed file that ends in the middle of a segment raises EOFError.
             raise Exception("Cannot recover data from %s" % output_filename)
-        self.output_file = open(output_filename, "a")
+        self.output_filename = output_filename
         self.columns = columns
         self.buffer = pandas.DataFrame(columns=self.columns)
         self.interval = interval
@@ -66,7 +125,7 @@ class DataFrameCheckpoint(object):
                (self.__class__.__name__, self.filename(), ", ".join(self.columns), len(self.buffer))
 
     def filename(self):
-        return self.output_file.name
+        return self.output_filename
 
     def write(self, *values):
         self.buffer = self.buffer.append(dict(zip(self.buffer.columns, values)), ignore_index=True)
@@ -75,12 +134,13 @@ class DataFrameCheckpoint(object):
 
     def close(self):
         self.flush()
-        self.output_file.close()
 
     def flush(self):
-        logger.debug("Flush %d items to %s" % (len(self.buffer), self.output_file.name))
-        self.buffer.to_csv(self.output_file, header=self.need_header, index=False, encoding="utf-8")
-        self.output_file.flush()
+        logger.debug("Flush %d items to %s" % (len(self.buffer), self.output_filename))
+        # Do not add empty segments to compressed files.
+        if len(self.buffer) or self.need_header:
+            with open_file(self.output_filename, "a") as output_file:
+                self.buffer.to_csv(output_file, header=self.need_header, index=False)
         self.buffer = pandas.DataFrame(columns=self.columns)
         self.need_header = False
 
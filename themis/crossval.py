@@ -0,0 +1,160 @@
+"""
+Cross-validate truth with a local answering engine.
+
+The local engine is a TF-IDF nearest centroid classifier that maps questions to answer Ids. It needs no external
+service, so every fold can be trained and evaluated in a separate worker process.
+"""
+import numpy as np
+import pandas
+
+from themis import QUESTION, ANSWER_ID, CONFIDENCE, CORRECT, CsvFileType, logger, parallel_map, sort_for_output
+from themis.analyze import TOKEN, kfold_indexes
+from themis.profiling import stage
+
+FOLD = "Fold"
+TRAIN = "Train"
+TEST = "Test"
+PREDICTED_ANSWER_ID = "Predicted " + ANSWER_ID
+
+ROW = "Row"
+TERM = "Term"
+WEIGHT = "Weight"
+
+
+@stage("cross-validate")
+def crossval(truth, folds, stratify=False, seed=None, processes=None):
+    """
+    Cross-validate truth with a local answering engine.
+
+    The truth is divided into folds. For each fold, a local classifier is trained on the other folds and asked the
+    fold's questions. An answer is correct if it has the answer Id of the question in the truth. Folds are evaluated in
+    parallel.
+
+    :param truth: question to answer mapping used in training
+    :type truth: pandas.DataFrame
+    :param folds: number of folds
+    :type folds: int
+    :param stratify: spread the questions for each answer Id evenly across the folds
+    :type stratify: bool
+    :param seed: random seed, if None use a random one
+    :type seed: int
+    :param processes: number of processes evaluating folds in parallel, if None use one per CPU
+    :type processes: int
+    :return: per-fold metrics with a final row for all the folds, and the answers to all the questions
+    :rtype: (pandas.DataFrame, pandas.DataFrame)
+    """
+    truth = truth[[QUESTION, ANSWER_ID]].dropna().reset_index(drop=True)
+    fold_indexes = kfold_indexes(len(truth), folds, truth[ANSWER_ID] if stratify else None, seed)
+    arguments = [(fold, truth.iloc[np.concatenate(fold_indexes[:fold] + fold_indexes[fold + 1:])], truth.iloc[test])
+                 for fold, test in enumerate(fold_indexes)]
+    answers = pandas.concat(parallel_map(evaluate_fold, arguments, processes))
+    metrics = answers.groupby(FOLD)[CORRECT].agg(["count", "sum"]).rename(columns={"count": TEST, "sum": CORRECT})
+    metrics[TRAIN] = len(truth) - metrics[TEST]
+    metrics.loc["All"] = metrics[[TEST, CORRECT]].sum()
+    metrics[[TRAIN, TEST, CORRECT]] = metrics[[TRAIN, TEST, CORRECT]].astype("Int64")
+    metrics[CORRECT + " %"] = 100.0 * metrics[CORRECT] / metrics[TEST]
+    fold_accuracy = metrics[CORRECT + " %"].drop("All")
+    logger.info("%d folds: correct %0.3f%%, standard deviation %0.3f%%" %
+                (folds, fold_accuracy.mean(), fold_accuracy.std()))
+    return metrics[[TRAIN, TEST, CORRECT, CORRECT + " %"]], CrossValidationAnswersFileType.output_format(answers)
+
+
+def evaluate_fold(argument):
+    """
+    Train a local classifier on a fold's training questions and ask it the test questions.
+
+    :param argument: fold number, training truth, and test truth
+    :type argument: (int, pandas.DataFrame, pandas.DataFrame)
+    :return: answers to the test questions
+    :rtype: pandas.DataFrame
+    """
+    fold, train, test = argument
+    logger.info("Fold %d: train on %d questions, test on %d" % (fold, len(train), len(test)))
+    answers = LocalClassifier(train).classify(test[QUESTION])
+    answers = answers.rename(columns={ANSWER_ID: PREDICTED_ANSWER_ID})
+    answers[ANSWER_ID] = test[ANSWER_ID].values
+    answers[CORRECT] = answers[PREDICTED_ANSWER_ID] == answers[ANSWER_ID]
+    answers[FOLD] = fold
+    return answers
+
+
+class LocalClassifier(object):
+    """
+    A TF-IDF nearest centroid classifier that maps questions to answer Ids.
+
+    Questions are represented as length-normalized TF-IDF vectors of their lower-cased tokens. Each answer Id is
+    represented by the normalized sum of the vectors of its training questions. A question is classified as the answer
+    Id whose vector has the highest cosine similarity to its own, and that similarity is the confidence.
+    """
+
+    def __init__(self, truth):
+        terms = question_terms(truth[QUESTION])
+        n = len(truth)
+        # Smoothed inverse document frequency.
+        self.idf = np.log((1.0 + n) / (1.0 + terms.groupby(TERM)[ROW].nunique())) + 1
+        vectors = self.vectors(terms)
+        vectors[ANSWER_ID] = truth[ANSWER_ID].values[vectors[ROW].values]
+        centroids = vectors.groupby([ANSWER_ID, TERM])[WEIGHT].sum().reset_index()
+        self.centroids = normalize(centroids, ANSWER_ID)
+        self.answers = len(centroids[ANSWER_ID].unique())
+
+    def __repr__(self):
+        return "Local classifier: %d answers, %d terms" % (self.answers, len(self.idf))
+
+    def ask(self, question):
+        answer = self.classify(pandas.Series([question])).iloc[0]
+        return answer[ANSWER_ID], answer[CONFIDENCE]
+
+    def classify(self, questions):
+        """
+        :param questions: questions to classify
+        :type questions: pandas.Series
+        :return: questions with their answer Ids and confidences, answer Id is None for questions with no known terms
+        :rtype: pandas.DataFrame
+        """
+        questions = questions.reset_index(drop=True)
+        vectors = self.vectors(question_terms(questions))
+        scores = pandas.merge(vectors, self.centroids, on=TERM, suffixes=("", " Centroid"))
+        scores[WEIGHT] *= scores[WEIGHT + " Centroid"]
+        scores = scores.groupby([ROW, ANSWER_ID])[WEIGHT].sum().reset_index()
+        best = scores.sort_values([ROW, WEIGHT], ascending=(True, False)).drop_duplicates(ROW).set_index(ROW)
+        answers = pandas.DataFrame({QUESTION: questions.values}, columns=[QUESTION, ANSWER_ID, CONFIDENCE])
+        answers[ANSWER_ID] = best[ANSWER_ID].reindex(answers.index)
+        answers[CONFIDENCE] = best[WEIGHT].reindex(answers.index).fillna(0.0)
+        return answers
+
+    def vectors(self, terms):
+        terms = terms[terms[TERM].isin(self.idf.index)].copy()
+        terms[WEIGHT] = terms[WEIGHT] * self.idf.reindex(terms[TERM]).values
+        return normalize(terms, ROW)
+
+
+def question_terms(questions):
+    """
+    :param questions: questions
+    :type questions: pandas.Series
+    :return: question row positions, terms, and the number of times the term appears in the question
+    :rtype: pandas.DataFrame
+    """
+    tokens = pandas.Series(questions.values).fillna("").str.lower().str.findall(TOKEN).explode().dropna()
+    terms = pandas.DataFrame({ROW: tokens.index, TERM: tokens.values})
+    return terms.groupby([ROW, TERM]).size().rename(WEIGHT).reset_index()
+
+
+def normalize(vectors, key):
+    norms = np.sqrt((vectors[WEIGHT] ** 2).groupby(vectors[key]).transform("sum"))
+    vectors[WEIGHT] = vectors[WEIGHT] / norms
+    return vectors
+
+
+class CrossValidationAnswersFileType(CsvFileType):
+    columns = [FOLD, QUESTION, ANSWER_ID, PREDICTED_ANSWER_ID, CONFIDENCE, CORRECT]
+
+    def __init__(self):
+        super(self.__class__, self).__init__(self.__class__.columns)
+
+    @classmethod
+    def output_format(cls, answers):
+        answers = answers[cls.columns]
+        answers = sort_for_output(answers, [FOLD, QUESTION])
+        return answers.set_index(FOLD)
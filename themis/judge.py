@@ -3,7 +3,7 @@ import json
 import pandas
 
 from themis import ANSWER, ANSWER_ID, TITLE, FILENAME, QUESTION, CONFIDENCE, IN_PURVIEW, CORRECT
-from themis import logger, CsvFileType, pretty_print_json
+from themis import logger, CsvFileType, pretty_print_json, compact, sort_for_output
 from themis.question import QUESTION_TEXT, TOP_ANSWER_TEXT
 
 QUESTION_TEXT_INPUT = "QuestionText"  # Column header for input file required by Annotation Assist
@@ -115,11 +115,16 @@ class JudgmentFileType(CsvFileType):
     """
 
     def __init__(self):
-        super(self.__class__, self).__init__([QUESTION, ANSWER, IN_PURVIEW, CORRECT])
+        super(self.__class__, self).__init__([QUESTION, ANSWER, IN_PURVIEW, CORRECT],
+                                             dtype={QUESTION: str, ANSWER: str})
+
+    def read(self, filename, csv=None):
+        judgments = super(self.__class__, self).read(filename, csv)
+        return compact(judgments, boolean=[IN_PURVIEW, CORRECT])
 
     @staticmethod
     def output_format(judgments):
-        judgments = judgments.sort_values([QUESTION, ANSWER])
+        judgments = sort_for_output(judgments, [QUESTION, ANSWER])
         return judgments.set_index([QUESTION, ANSWER])
 
 
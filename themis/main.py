@@ -5,36 +5,89 @@ various Q&A systems, annotate the answers and analyze the results.
 
 import argparse
 import os
+import sys
 import textwrap
 from argparse import RawDescriptionHelpFormatter as Raw
 
 import pandas
 
 from themis import configure_logger, CsvFileType, to_csv, QUESTION, ANSWER_ID, pretty_print_json, logger, print_csv, \
-    __version__, FREQUENCY, ANSWER, IN_PURVIEW, CORRECT, DOCUMENT_ID, ensure_directory_exists
-from themis.analyze import SYSTEM, CollatedFileType, add_judgments_and_frequencies_to_qa_pairs, system_similarity, \
-    compare_systems, oracle_combination, filter_judged_answers, corpus_statistics, truth_statistics, \
-    in_purview_disagreement, analyze_answers, truth_coverage, OracleFileType, long_tail_fat_head, kfold_split
-from themis.answer import answer_questions, Solr, get_answers_from_usage_log, AnswersFileType
-from themis.checkpoint import retry
-from themis.fixup import filter_usage_log_by_date, filter_usage_log_by_user_experience, deakin, filter_corpus
-from themis.judge import AnnotationAssistFileType, annotation_assist_qa_input, create_annotation_assist_corpus, \
-    interpret_annotation_assist, JudgmentFileType, augment_usage_log
-from themis.nlc import train_nlc, NLC, classifier_list, classifier_status, remove_classifiers
-from themis.plot import generate_curves, plot_curves
-from themis.question import QAPairFileType, UsageLogFileType, extract_question_answer_pairs_from_usage_logs, \
-    QuestionFrequencyFileType, DATE_TIME
-from themis.trec import corpus_from_trec
-from themis.xmgr import CorpusFileType, XmgrProject, DownloadCorpusFromXmgrClosure, download_truth_from_xmgr, \
-    validate_truth_with_corpus, TruthFileType, examine_truth, validate_answers_with_corpus, augment_corpus_answers, \
-    augment_corpus_truth
+    __version__, FREQUENCY, ANSWER, CONFIDENCE, IN_PURVIEW, CORRECT, DOCUMENT_ID, ensure_directory_exists, \
+    enable_compact_loading, align_compact, lazy_file_type, load_csv_files, disable_output_sorting, store_output, \
+    CsvFile
+from themis import profiling
+from themis.benchmark import BENCHMARKS
+from themis.profiling import stage, start_profiling, stop_profiling, write_profile
+from themis.telemetry import TelemetryWriter
+
+# File types are referred to lazily so that declaring the command line arguments does not import the modules that
+# implement the commands. Handlers import what they need from those modules when they are run.
+AnnotationAssistFileType = lazy_file_type("themis.judge", "AnnotationAssistFileType")
+AnswersFileType = lazy_file_type("themis.answer", "AnswersFileType")
+CollatedFileType = lazy_file_type("themis.analyze", "CollatedFileType")
+CorpusFileType = lazy_file_type("themis.xmgr", "CorpusFileType")
+JudgmentFileType = lazy_file_type("themis.judge", "JudgmentFileType")
+OracleFileType = lazy_file_type("themis.analyze", "OracleFileType")
+QAPairFileType = lazy_file_type("themis.question", "QAPairFileType")
+QuestionFrequencyFileType = lazy_file_type("themis.question", "QuestionFrequencyFileType")
+TruthFileType = lazy_file_type("themis.xmgr", "TruthFileType")
+UsageLogFileType = lazy_file_type("themis.question", "UsageLogFileType")
+
+# Modules that implement each command.
+COMMAND_MODULES = [("xmgr", ["themis.xmgr", "themis.trec", "themis.fixup"]),
+                   ("question", ["themis.question", "themis.fixup"]),
+                   ("answer", ["themis.answer", "themis.nlc"]),
+                   ("judge", ["themis.judge"]),
+                   ("analyze", ["themis.analyze", "themis.plot", "themis.report", "themis.bootstrap"]),
+                   ("crossval", ["themis.crossval"]),
+                   ("run", ["themis.pipeline"]),
+                   ("serve", ["themis.serve"]),
+                   ("workspace", ["themis.workspace"]),
+                   ("query", ["themis.workspace"])]
 
 
 def main():
+    run(sys.argv[1:], delegate=True)
+
+
+def run(argv, delegate=False, served=False):
+    """
+    Run a command.
+
+    :param argv: command line arguments without the program name
+    :type argv: list of str
+    :param delegate: send the command to the server named by the --server option if there is one and it can run it
+    :type delegate: bool
+    :param served: the command is being run by a server, which only runs some commands
+    :type served: bool
+    """
     parser = argparse.ArgumentParser(description="Themis analysis toolkit, version %s" % __version__)
     parser.add_argument("--log", default="INFO", help="logging level")
-
-    subparsers = parser.add_subparsers(title="Q&A System analysis", description=__doc__)
+    parser.add_argument("--compact", nargs=0, action=CompactAction,
+                        help="load collated, judgment and answer files in a compact format " +
+                             "that stores each distinct question and answer once")
+    parser.add_argument("--unsorted", action="store_true",
+                        help="write output rows in the order they were produced instead of sorting them, " +
+                             "which is faster when the order does not matter")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write the time and memory used by each stage of the command to this JSON file")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="also record the peak memory allocated by Python in each stage, which is slower")
+    parser.add_argument("--profile-stats", metavar="FILE", help="write cProfile statistics to this file")
+    parser.add_argument("--telemetry", metavar="FILE",
+                        help="periodically write the progress of long-running jobs and the latencies of remote calls " +
+                             "to this file")
+    parser.add_argument("--telemetry-format", choices=["json", "prometheus"], default="json",
+                        help="append JSON lines or rewrite a Prometheus textfile, default json")
+    parser.add_argument("--telemetry-interval", metavar="SECONDS", type=float, default=10.0,
+                        help="how often to write telemetry, default 10 seconds")
+    parser.add_argument("--server", metavar="ADDRESS", default=os.environ.get("THEMIS_SERVER"),
+                        help="run analyze, answer, judge and question commands on the server started by 'themis " +
+                             "serve' at this address, default the THEMIS_SERVER environment variable")
+    parser.add_argument("--store", metavar="WORKSPACE::ARTIFACT[/LABEL]",
+                        help="store CSV output as an artifact in a workspace instead of printing it")
+
+    subparsers = parser.add_subparsers(title="Q&A System analysis", description=__doc__, dest="command")
     # Download information from xmgr.
     xmgr_command(subparsers)
     # Extract questions from usage logs.
@@ -45,19 +98,65 @@ def main():
     judge_command(subparsers)
     # Analyze results.
     analyze_command(parser, subparsers)
+    # Cross-validate truth.
+    crossval_command(subparsers)
+    # Run a pipeline of commands.
+    run_command(subparsers)
     # Various utilities.
     util_command(subparsers)
+    # Keep files in memory for other commands.
+    serve_command(subparsers)
+    # Store artifacts in a SQL workspace.
+    workspace_command(subparsers)
+    # Query a workspace.
+    query_command(subparsers)
     # Print the version number.
     version_command(subparsers)
 
     # Set logger to default level before parsing arguments so command line parsing can log messages.
     fmt = "%(asctime)-15s %(levelname)-8s %(message)s"
     configure_logger(parser.get_default("log"), fmt)
-    args = parser.parse_args()
+    args = parser.parse_args(argv, namespace=CsvFileNamespace())
     logger.handlers = []  # Reset so that we don't have duplicate handlers.
 
     configure_logger(args.log.upper(), fmt)
-    args.func(args)
+    if delegate and args.server is not None:
+        from themis.serve import SERVED_COMMANDS, delegate as delegate_command
+        if args.command in SERVED_COMMANDS:
+            status = delegate_command(args.server, without_server_option(argv), os.getcwd())
+            if status is not None:
+                sys.exit(status)
+    if served:
+        from themis.serve import SERVED_COMMANDS
+        if args.command not in SERVED_COMMANDS:
+            parser.error("the server cannot run the %s command" % args.command)
+    if args.unsorted:
+        disable_output_sorting()
+    if args.store is not None:
+        store_output(args.store)
+    if args.profile is not None or args.profile_stats is not None:
+        start_profiling(args.profile_memory, args.profile_stats)
+    if args.telemetry is not None:
+        telemetry_writer = TelemetryWriter(args.telemetry, args.telemetry_format, args.telemetry_interval).start()
+    status = "error"
+    try:
+        with stage("command"):
+            if args.compact:
+                # Compactly loaded files must all be loaded before their categories can be aligned.
+                align_compact([getattr(args, name) for name in vars(args)])
+            args.func(args)
+        status = "success"
+    except InvalidCsvFileArgument as e:
+        # Files are parsed after the command line, so report invalid ones the way argparse would have.
+        parser.error(str(e))
+    finally:
+        if args.telemetry is not None:
+            telemetry_writer.stop()
+        if profiling.profiler is not None:
+            summary = stop_profiling()
+            if args.profile is not None:
+                summary.update(version=__version__, status=status)
+                write_profile(args.profile, summary)
 
 
 def xmgr_command(subparsers):
@@ -100,13 +199,19 @@ def xmgr_command(subparsers):
                                       description=textwrap.dedent("""
     Extract the corpus from the TREC XML files in which XMGR stores PAU information.
 
-    This is for when we have file system access to the corpus instead of needing to download it."""),
+    This is for when we have file system access to the corpus instead of needing to download it. The TREC files may be
+    in a directory or in a .tar, .tar.gz or .zip archive, which is read without extracting it.
+
+    The contents of every TREC file are recorded along with its size and modification time in a corpus.trec.csv file
+    in the output directory. Subsequent runs only parse new and modified TREC files."""),
                                       help="extract corpus from TREC files")
-    xmgr_trec.add_argument("directory", help="directory containing XML TREC files")
+    xmgr_trec.add_argument("source", help="directory or tar or zip archive containing XML TREC files")
     xmgr_trec.add_argument("--max-docs", metavar="MAX-DOCS", type=int,
                            help="maximum number of TREC documents to examine")
     xmgr_trec.add_argument("--checkpoint-frequency", metavar="CHECKPOINT-FREQUENCY", type=int, default=1000,
                            help="flush corpus to checkpoint file after parsing this many TREC files")
+    xmgr_trec.add_argument("--processes", metavar="PROCESSES", type=int,
+                           help="number of processes parsing TREC files in parallel, default one per CPU")
     xmgr_trec.set_defaults(func=trec_handler)
     # Download truth from XMGR.
     xmgr_truth = subparsers.add_parser("truth", parents=[xmgr_shared_arguments, output_directory],
@@ -217,59 +322,72 @@ def xmgr_command(subparsers):
 
 
 def download_handler(args):
+    from themis.checkpoint import retry
+    from themis.xmgr import DownloadCorpusFromXmgrClosure, XmgrProject
     xmgr = XmgrProject(args.url, args.username, args.password)
     closure = DownloadCorpusFromXmgrClosure(xmgr, args.output_directory, args.checkpoint_frequency, args.max_docs)
     retry(closure, args.retries)
 
 
 def trec_handler(args):
-    checkpoint_filename = os.path.join(args.output_directory, "corpus.trec.temp.csv")
-    corpus = corpus_from_trec(checkpoint_filename, args.directory, args.checkpoint_frequency, args.max_docs)
+    from themis.trec import corpus_from_trec
+    from themis.xmgr import CorpusFileType
+    checkpoint_filename = os.path.join(args.output_directory, "corpus.trec.csv")
+    corpus = corpus_from_trec(checkpoint_filename, args.source, args.checkpoint_frequency, args.max_docs,
+                              args.processes)
     to_csv(os.path.join(args.output_directory, "corpus.csv"), CorpusFileType.output_format(corpus))
     logger.info("%d documents and %d PAUs in corpus" % (len(corpus[DOCUMENT_ID].drop_duplicates()), len(corpus)))
-    os.remove(checkpoint_filename)
 
 
 def truth_handler(args):
+    from themis.xmgr import XmgrProject, download_truth_from_xmgr
     xmgr = XmgrProject(args.url, args.username, args.password)
     download_truth_from_xmgr(xmgr, args.output_directory)
 
 
 def pau_handler(args):
+    from themis.xmgr import XmgrProject
     xmgr = XmgrProject(args.url, args.username, args.password)
     print(pretty_print_json(xmgr.get_paus(args.pau)))
 
 
 def document_handler(args):
+    from themis.xmgr import XmgrProject
     xmgr = XmgrProject(args.url, args.username, args.password)
     print(", ".join(xmgr.get_pau_ids_in_document(args.document)))
 
 
 def augment_answers_handler(args):
+    from themis.xmgr import CorpusFileType, augment_corpus_answers
     augmented_corpus = augment_corpus_answers(args.corpus, args.qa_pairs)
     print_csv(CorpusFileType.output_format(augmented_corpus))
 
 
 def augment_truth_handler(args):
+    from themis.xmgr import CorpusFileType, XmgrProject, augment_corpus_truth
     xmgr = XmgrProject(args.url, args.username, args.password)
     augmented_corpus = augment_corpus_truth(xmgr, args.corpus, args.truth, args.checkpoint_frequency)
     print_csv(CorpusFileType.output_format(augmented_corpus))
 
 
 def filter_corpus_handler(args):
+    from themis.fixup import filter_corpus
     corpus = filter_corpus(args.corpus, args.max_size)
     print_csv(corpus)
 
 
 def validate_truth_handler(args):
+    from themis.xmgr import validate_truth_with_corpus
     validate_truth_with_corpus(args.corpus, args.truth, args.output_directory)
 
 
 def validate_answers_handler(args):
+    from themis.xmgr import validate_answers_with_corpus
     validate_answers_with_corpus(args.corpus, args.qa_pairs, args.output_directory)
 
 
 def examine_handler(args):
+    from themis.xmgr import examine_truth
     examine_truth(args.corpus, args.truth)
 
 
@@ -314,6 +432,8 @@ def question_command(subparsers):
 # noinspection PyTypeChecker
 def extract_handler(args):
     # Do custom fixup of usage logs.
+    from themis.fixup import deakin, filter_usage_log_by_date, filter_usage_log_by_user_experience
+    from themis.question import QAPairFileType, extract_question_answer_pairs_from_usage_logs
     usage_log = pandas.concat(args.usage_log)
     n = len(usage_log)
     if args.before or args.after:
@@ -332,6 +452,7 @@ def extract_handler(args):
 
 def sample_handler(args):
     # Sample questions by frequency.
+    from themis.question import QuestionFrequencyFileType
     questions = args.questions[[QUESTION, FREQUENCY]].drop_duplicates(QUESTION)
     sample = questions.sample(args.sample_size, weights=FREQUENCY)
     print_csv(QuestionFrequencyFileType.output_format(sample))
@@ -378,7 +499,7 @@ def answer_command(subparsers):
 
     The question/answer pairs are written to a specified file."""),
                                        help="extract WEA answers from usage log")
-    answer_wea.add_argument("qa_pairs", metavar="qa-pairs", type=QAPairFileType(),
+    answer_wea.add_argument("qa_pairs", metavar="qa-pairs", type=QAPairFileType([QUESTION, ANSWER, CONFIDENCE]),
                             help="question/answer pairs produced by the 'question extract' command")
     answer_wea.set_defaults(func=wea_handler)
 
@@ -437,42 +558,50 @@ def answer_command(subparsers):
 
 
 def wea_handler(args):
+    from themis.answer import get_answers_from_usage_log
     wea_answers = get_answers_from_usage_log(args.questions, args.qa_pairs)
     to_csv(args.output, wea_answers)
 
 
 def solr_handler(args):
+    from themis.answer import Solr, answer_questions
     answer_questions(Solr(args.url), set(args.questions[QUESTION]), args.output, args.checkpoint_frequency)
 
 
 def nlc_train_handler(args):
+    from themis.nlc import train_nlc
     print(train_nlc(args.url, args.username, args.password, args.truth, args.name))
 
 
 def nlc_use_handler(args):
+    from themis.answer import answer_questions
+    from themis.nlc import NLC
     corpus = args.corpus.set_index(ANSWER_ID)
     n = NLC(args.url, args.username, args.password, args.classifier, corpus)
     answer_questions(n, set(args.questions[QUESTION]), args.output, args.checkpoint_frequency)
 
 
 def nlc_list_handler(args):
+    from themis.nlc import classifier_list
     print(pretty_print_json(classifier_list(args.url, args.username, args.password)))
 
 
 def nlc_status_handler(args):
+    from themis.nlc import classifier_status
     classifier_status(args.url, args.username, args.password, args.classifiers)
 
 
 def nlc_delete_handler(args):
+    from themis.nlc import remove_classifiers
     remove_classifiers(args.url, args.username, args.password, args.classifiers)
 
 
 class QuestionSetFileType(CsvFileType):
     def __init__(self):
-        super(self.__class__, self).__init__([QUESTION])
+        super(self.__class__, self).__init__([QUESTION], dtype={QUESTION: str})
 
-    def __call__(self, filename):
-        questions = super(self.__class__, self).__call__(filename)
+    def read(self, filename, csv=None):
+        questions = super(self.__class__, self).read(filename, csv)
         return questions.drop_duplicates()
 
 
@@ -501,7 +630,7 @@ def judge_command(subparsers):
     The Q&A pairs to be judged are compiled from sets of answers generated by Q&A systems. These may be filtered by an
     optional list of questions. Judgements may be taken from optional sets of previously judged Q&A pairs."""),
                                         help="generate question and answer pairs for judgment by Annotation Assistant")
-    judge_pairs.add_argument("answers", type=CsvFileType(), nargs="+",
+    judge_pairs.add_argument("answers", type=CsvFileType([QUESTION, ANSWER, CONFIDENCE]), nargs="+",
                              help="answers generated by one of the 'answer' commands")
     judge_pairs.add_argument("--questions", type=CsvFileType([QUESTION]),
                              help="limit Q&A pairs to just these questions")
@@ -557,20 +686,24 @@ def judge_command(subparsers):
 
 
 def annotation_pairs_handler(args):
+    from themis.judge import annotation_assist_qa_input
     qa_pairs = annotation_assist_qa_input(args.answers, args.questions, args.judgments)
     print_csv(qa_pairs, index=False)
 
 
 def annotation_corpus_handler(args):
+    from themis.judge import create_annotation_assist_corpus
     print(create_annotation_assist_corpus(args.corpus))
 
 
 def annotation_interpret_handler(args):
+    from themis.judge import JudgmentFileType, interpret_annotation_assist
     judgments = interpret_annotation_assist(args.judgments, args.judgment_threshold)
     print_csv(JudgmentFileType.output_format(judgments))
 
 
 def judge_sample_handler(args):
+    from themis.question import QuestionFrequencyFileType
     questions = pandas.concat(args.judgments)[[QUESTION]].drop_duplicates()
     sample = pandas.merge(questions, args.frequency, on=QUESTION, how="left")
     n = len(sample)
@@ -582,6 +715,7 @@ def judge_sample_handler(args):
 
 
 def augment_handler(args):
+    from themis.judge import augment_usage_log
     usage_log = pandas.concat(args.usage_log)
     # noinspection PyTypeChecker
     augmented = augment_usage_log(usage_log, args.judments)
@@ -630,13 +764,35 @@ def analyze_command(parser, subparsers):
     Generate precision and ROC curves for multiple systems.
 
     Plot data is generated for each system represented in the collated file and written to a file in the output
-    directory named 'precision|roc.SYSTEM-NAME.csv'."""),
+    directory named 'precision|roc.SYSTEM-NAME.csv'. The area under each system's curve is written to
+    'precision|roc.summary.csv'. For ROC curves this is the AUC. For precision curves it is the area under precision as
+    a function of questions attempted.
+
+    Curves may be decimated to a maximum number of points. Areas are computed from the full curves, and the summary
+    records the maximum distance of a point on the full curve from the decimated one.
+
+    Plots may be drawn on the screen with --draw or rendered to an image file with --save, which does not need a
+    display. With --panels the systems in each collated file are drawn in a separate panel of the same figure, and
+    curves are generated for each file separately, so the files may contain systems with the same names. Curve files
+    are then named 'precision|roc.PANEL.SYSTEM-NAME.csv', where PANEL is the name of the collated file, and the
+    summary has a Panel column."""),
                                         help="generate performance plots from judged answers")
     plot_parser.add_argument("type", choices=["roc", "precision"], help="type of plot to create")
     plot_parser.add_argument("collated", nargs="+", type=CollatedFileType(),
                              help="combined system answers and judgments created by 'analyze collate'")
     plot_parser.add_argument("--output", default=".", help="output directory")
     plot_parser.add_argument("--draw", action="store_true", help="draw plots")
+    plot_parser.add_argument("--save", metavar="FILE",
+                             help="render plots to an image file, its format given by its extension, " +
+                                  "e.g. png, svg, pdf")
+    plot_parser.add_argument("--panels", action="store_true",
+                             help="draw the systems in each collated file in a separate panel")
+    plot_parser.add_argument("--max-points", metavar="N", type=int,
+                             help="decimate curves to at most this many points")
+    plot_parser.add_argument("--tolerance", metavar="DISTANCE", type=float, default=0.0,
+                             help="decimate curves until no point is farther than this from them, default 0")
+    plot_parser.add_argument("--precision-target", metavar="PRECISION", type=float,
+                             help="print the lowest threshold at which each system's precision is at least this value")
     plot_parser.set_defaults(func=plot_handler)
     # Print in-purview correct answers.
     correct_parser = subparsers.add_parser("correct", parents=[filter_arguments],
@@ -692,6 +848,77 @@ def analyze_command(parser, subparsers):
                                help="combined system answers and judgments created by 'analyze collate'")
     oracle_parser.add_argument("system_names", metavar="system", nargs="+", help="name of systems to combine")
     oracle_parser.set_defaults(func=oracle_handler)
+    # Search for the best oracle combinations.
+    oracle_search_parser = subparsers.add_parser("oracle-search",
+                                                 formatter_class=Raw,
+                                                 description=textwrap.dedent("""
+    Find the combinations of systems whose oracle gets the highest percentage of in-purview questions correct.
+
+    Combinations are scored on the questions answered by all the candidate systems, using the same rules as the
+    'analyze oracle' command. Every combination is scored unless a beam width is specified, in which case only
+    extensions of the best combinations of the next smaller size are scored. A beam width of 1 is a greedy search.
+    If there are more than about a million combinations, a beam search of width 100 is done instead of scoring them all.
+
+    The marginal gain of a combination is its correct percentage minus that of the best combination of one fewer of its
+    systems."""),
+                                                 help="find the best combinations of systems to combine into an oracle")
+    oracle_search_parser.add_argument("collated", type=CollatedFileType(),
+                                      help="combined system answers and judgments created by 'analyze collate'")
+    oracle_search_parser.add_argument("--system-names", metavar="system", nargs="+",
+                                      help="name of candidate systems, by default use them all")
+    oracle_search_parser.add_argument("--max-size", metavar="SIZE", type=int,
+                                      help="largest combination of systems to consider, by default all of them")
+    oracle_search_parser.add_argument("--top", metavar="N", type=int, default=5,
+                                      help="number of best combinations of each size to report, default 5")
+    oracle_search_parser.add_argument("--beam", metavar="WIDTH", type=int,
+                                      help="beam width, by default search exhaustively if there are at most about a " +
+                                           "million combinations")
+    oracle_search_parser.set_defaults(func=oracle_search_handler)
+    # Report with all analyses.
+    report_parser = subparsers.add_parser("report",
+                                          formatter_class=Raw,
+                                          description=textwrap.dedent("""
+    Generate the output of the 'analyze answers', 'long-tail', 'similarity', 'purview', and 'truth-coverage' commands
+    and the curve data of the 'plot' command from a single load of the collated files.
+
+    By default the tables are written to TABLE.csv files and the curves to 'precision|roc.SYSTEM-NAME.csv' files in the
+    output directory. With --json everything is written to a single JSON document instead. Truth coverage is only
+    generated if a corpus and truth are specified."""),
+                                          help="generate all analyses of judged answers")
+    report_parser.add_argument("collated", nargs="+", type=CollatedFileType(),
+                               help="combined system answers and judgments created by 'analyze collate'")
+    report_parser.add_argument("--frequency-cutoff", metavar="FREQUENCY", type=int, default=1,
+                               help="question frequency dividing fat head from long tail, default 1")
+    report_parser.add_argument("--corpus", type=CorpusFileType(),
+                               help="corpus file created by the 'download corpus' command")
+    report_parser.add_argument("--truth", type=TruthFileType(), help="truth file created by the 'xmgr truth' command")
+    report_parser.add_argument("--output", default="report", help="output directory, default report")
+    report_parser.add_argument("--json", metavar="FILE", help="write the report to a JSON file")
+    report_parser.set_defaults(func=report_handler)
+    # Bootstrap confidence intervals.
+    bootstrap_parser = subparsers.add_parser("bootstrap",
+                                             formatter_class=Raw,
+                                             description=textwrap.dedent("""
+    Bootstrap confidence intervals for each system's correct percentage, in-purview percentage, area under the ROC
+    curve, and precision at confidence thresholds.
+
+    Questions are resampled with replacement, and the same resamples are used for all systems. By default each question
+    counts once, as in 'analyze answers'. With --frequency-weighted each question counts as many times as it was asked,
+    as in 'plot'."""),
+                                             help="confidence intervals for system performance")
+    bootstrap_parser.add_argument("collated", nargs="+", type=CollatedFileType(),
+                                  help="combined system answers and judgments created by 'analyze collate'")
+    bootstrap_parser.add_argument("--replicates", metavar="N", type=int, default=1000,
+                                  help="number of bootstrap replicates, default 1000")
+    bootstrap_parser.add_argument("--level", metavar="PERCENT", type=float, default=95,
+                                  help="confidence level, default 95")
+    bootstrap_parser.add_argument("--thresholds", metavar="THRESHOLD", type=float, nargs="+", default=[],
+                                  help="confidence thresholds at which to compute precision")
+    bootstrap_parser.add_argument("--frequency-weighted", action="store_true", help="weight questions by frequency")
+    bootstrap_parser.add_argument("--seed", type=int, help="random seed")
+    bootstrap_parser.add_argument("--processes", metavar="PROCESSES", type=int,
+                                  help="number of processes computing replicates in parallel, default one per CPU")
+    bootstrap_parser.set_defaults(func=bootstrap_handler)
     # Corpus statistics.
     corpus_parser = subparsers.add_parser("corpus",
                                           formatter_class=Raw,
@@ -701,6 +928,11 @@ def analyze_command(parser, subparsers):
     corpus_parser.add_argument("corpus", type=CorpusFileType(),
                                help="corpus file created by the 'download corpus' command")
     corpus_parser.add_argument("--histogram", help="token frequency per answer histogram")
+    corpus_parser.add_argument("--plaintext", metavar="PLAINTEXT",
+                               help="cache answer plain text and token counts in this file, which is created if it " +
+                                    "does not exist, default no cache")
+    corpus_parser.add_argument("--processes", metavar="PROCESSES", type=int,
+                               help="number of processes extracting plain text in parallel, default one per CPU")
     corpus_parser.set_defaults(func=analyze_corpus_handler)
     # Truth statistics.
     truth_parser = subparsers.add_parser("truth",
@@ -723,7 +955,8 @@ def analyze_command(parser, subparsers):
                                        "or 'question sample' command")
     questions_parser.add_argument("questions", type=QAPairFileType(),
                                   help="question set generated by the 'question extract' command")
-    questions_parser.add_argument("truth", type=TruthFileType(), help="truth file created by the 'xmgr truth' command")
+    questions_parser.add_argument("truth", type=TruthFileType([QUESTION]),
+                                  help="truth file created by the 'xmgr truth' command")
     questions_parser.set_defaults(func=analyze_questions_handler)
     # Answer statistics.
     answer_parser = subparsers.add_parser("answers",
@@ -757,10 +990,20 @@ def analyze_command(parser, subparsers):
     Accuracy statistics broken down by 'fat-head' and 'long-tail' questions.
 
     Fat-head are questions with frequency above a threshold value. Long-tail are questions with frequency equal to or
-    less than the threshold."""),
+    less than the threshold.
+
+    Alternatively, break the statistics down into several frequency buckets delimited by a list of cut points or by
+    quantiles of the question frequencies. Each bucket contains the questions with frequencies greater than its lower
+    cut point and less than or equal to its upper one. Bucket statistics may be frequency weighted."""),
                                              help="long tail vs. fat head statistics")
     long_tail_parser.add_argument("--frequency-cutoff", metavar="FREQUENCY", type=int, default=1,
                                   help="long-tail frequency cutoff, default 1")
+    buckets_group = long_tail_parser.add_mutually_exclusive_group()
+    buckets_group.add_argument("--cut-points", metavar="FREQUENCY", type=float, nargs="+",
+                               help="frequencies dividing buckets")
+    buckets_group.add_argument("--quantiles", metavar="N", type=int, help="number of quantile buckets")
+    long_tail_parser.add_argument("--frequency-weighted", action="store_true",
+                                  help="count each question as many times as it was asked in bucket statistics")
     long_tail_parser.add_argument("collated", nargs="+", type=CollatedFileType(),
                                   help="combined system answers and judgments created by 'analyze collate'")
     long_tail_parser.set_defaults(func=long_tail_handler)
@@ -779,6 +1022,8 @@ def analyze_command(parser, subparsers):
 
 # noinspection PyTypeChecker
 def collate_handler(parser, args):
+    from themis.analyze import CollatedFileType, SYSTEM, add_judgments_and_frequencies_to_qa_pairs, \
+        in_purview_disagreement
     labeled_qa_pairs = answer_labels(parser, args)
     judgments = pandas.concat(args.judgments)
     all_systems = []
@@ -810,45 +1055,114 @@ def answer_labels(parser, args):
 
 
 def correct_handler(args):
+    from themis.analyze import CollatedFileType, filter_judged_answers
     correct = filter_judged_answers(args.collated, True, args.system_names)
     print_csv(CollatedFileType.output_format(correct))
 
 
 def incorrect_handler(args):
+    from themis.analyze import CollatedFileType, filter_judged_answers
     incorrect = filter_judged_answers(args.collated, False, args.system_names)
     print_csv(CollatedFileType.output_format(incorrect))
 
 
 def plot_handler(args):
-    curves = generate_curves(args.type, args.collated)
+    from themis.analyze import SYSTEM
+    from themis.plot import ATTEMPTED, PANEL, PRECISION, THRESHOLD, curve_area, decimate_curve, generate_curves, \
+        panel_titles, plot_curves, plot_panels, precision_threshold
+    # In panel mode each collated file gets its own curves, so files may contain systems with the same names.
+    if args.panels:
+        collated_sets = list(zip(panel_titles(args.collated), [[collated] for collated in args.collated]))
+    else:
+        collated_sets = [(None, args.collated)]
+    panels = [(title, generate_curves(args.type, collated)) for title, collated in collated_sets]
+    labels = [SYSTEM] if not args.panels else [PANEL, SYSTEM]
+
+    def key(title, label):
+        return (label,) if title is None else (title, label)
+
+    # Optionally find the thresholds achieving a target precision.
+    if args.precision_target is not None:
+        thresholds = []
+        for (title, curves), (_, collated) in zip(panels, collated_sets):
+            precision_curves = curves if args.type == "precision" else generate_curves("precision", collated)
+            points = dict((label, precision_threshold(curve, args.precision_target))
+                          for label, curve in precision_curves.items())
+            thresholds.extend(key(title, label) + (point.name, point[PRECISION], point[ATTEMPTED])
+                              for label, point in sorted(points.items()) if point is not None)
+            for label in sorted(label for label, point in points.items() if point is None):
+                logger.warning("%s never achieves %0.3f precision" % (" ".join(key(title, label)),
+                                                                       args.precision_target))
+        print_csv(pandas.DataFrame(thresholds, columns=labels + [THRESHOLD, PRECISION, ATTEMPTED]).set_index(labels))
+    # Summarize the full curves and optionally decimate them.
+    summary = []
+    for title, curves in panels:
+        for label, curve in sorted(curves.items()):
+            area = curve_area(curve)
+            error = 0.0
+            if args.max_points is not None or args.tolerance:
+                curves[label], error = decimate_curve(curve, args.max_points, args.tolerance)
+            summary.append(key(title, label) + (area, len(curve), len(curves[label]), error))
+    summary = pandas.DataFrame(summary, columns=labels + ["Area", "Points", "Decimated Points", "Maximum Error"])
     # Write curves data.
     ensure_directory_exists(args.output)
-    for label, curve in curves.items():
-        filename = os.path.join(args.output, "%s.%s.csv" % (args.type, label))
-        to_csv(filename, curve)
+    for title, curves in panels:
+        for label, curve in curves.items():
+            filename = os.path.join(args.output, ".".join((args.type,) + key(title, label)) + ".csv")
+            to_csv(filename, curve)
+    to_csv(os.path.join(args.output, "%s.summary.csv" % args.type), summary.set_index(labels))
     # Optionally draw plot.
-    if args.draw:
-        plot_curves(curves, args.type)
+    if args.draw or args.save is not None:
+        if args.panels:
+            plot_panels(panels, args.type, args.save)
+        else:
+            plot_curves(panels[0][1], args.type, args.save)
 
 
 def similarity_handler(args):
+    from themis.analyze import system_similarity
     similarity = system_similarity(args.collated)
     print_csv(similarity)
 
 
 def comparison_handler(args):
+    from themis.analyze import compare_systems
     comparison = compare_systems(args.collated, args.system_1, args.system_2, args.type)
     print_csv(comparison)
 
 
 def oracle_handler(args):
+    from themis.analyze import OracleFileType, oracle_combination
     oracle_name = "%s Oracle" % "+".join(args.system_names)
     oracle = oracle_combination(args.collated, args.system_names, oracle_name)
     print_csv(OracleFileType.output_format(oracle))
 
 
+def oracle_search_handler(args):
+    from themis.analyze import oracle_search
+    combinations = oracle_search(args.collated, args.system_names, args.max_size, args.top, args.beam)
+    print_csv(combinations)
+
+
+def report_handler(args):
+    from themis.report import analysis_report, write_report_directory, write_report_json
+    tables, curves = analysis_report(args.collated, args.frequency_cutoff, args.corpus, args.truth)
+    if args.json is not None:
+        write_report_json(args.json, tables, curves)
+    else:
+        write_report_directory(args.output, tables, curves)
+
+
+def bootstrap_handler(args):
+    from themis.bootstrap import bootstrap
+    intervals = bootstrap(pandas.concat(args.collated), args.replicates, args.level, args.thresholds,
+                          args.frequency_weighted, args.seed, args.processes)
+    print_csv(intervals)
+
+
 def analyze_corpus_handler(args):
-    answers, tokens, histogram = corpus_statistics(args.corpus)
+    from themis.analyze import corpus_statistics
+    answers, tokens, histogram = corpus_statistics(args.corpus, args.plaintext, args.processes)
     print("%d answers, %d tokens, average %0.3f tokens per answer" % (answers, tokens, tokens / float(answers)))
     if args.histogram:
         r = pandas.DataFrame(list(histogram.items()), columns=("Tokens", "Count")).set_index("Tokens").sort_index()
@@ -856,6 +1170,7 @@ def analyze_corpus_handler(args):
 
 
 def analyze_truth_handler(parser, args):
+    from themis.analyze import truth_statistics
     if args.histogram is None and args.corpus is not None:
         parser.print_usage()
         parser.error("The corpus is only used when drawing a histogram.")
@@ -872,6 +1187,7 @@ def analyze_truth_handler(parser, args):
 
 
 def analyze_questions_handler(args):
+    from themis.question import DATE_TIME
     questions = args.sample[[QUESTION]]
     dates = pandas.merge(questions,
                          args.questions[[QUESTION, DATE_TIME]], on=QUESTION, how="left").sort_values(DATE_TIME)
@@ -883,16 +1199,24 @@ def analyze_questions_handler(args):
 
 
 def analyze_answers_handler(args):
+    from themis.analyze import analyze_answers
     summary = analyze_answers(args.collated, args.freq_le, args.freq_gr)
     print_csv(summary)
 
 
 def truth_coverage_handler(args):
+    from themis.analyze import truth_coverage
     coverage = truth_coverage(args.corpus, args.truth, args.collated)
     print_csv(coverage)
 
 
 def long_tail_handler(args):
+    from themis.analyze import long_tail_buckets, long_tail_fat_head
+    if args.cut_points is not None or args.quantiles is not None or args.frequency_weighted:
+        cut_points = args.cut_points or [args.frequency_cutoff]
+        buckets = long_tail_buckets(args.collated, cut_points, args.quantiles, args.frequency_weighted)
+        print_csv(buckets)
+        return
     fat_head, long_tail = long_tail_fat_head(args.frequency_cutoff, args.collated)
     print("Fat Head (frequency > %d)" % args.frequency_cutoff)
     print_csv(fat_head)
@@ -901,10 +1225,72 @@ def long_tail_handler(args):
 
 
 def purview_disagreement_handler(args):
+    from themis.analyze import CollatedFileType, in_purview_disagreement
     purview_disagreement = in_purview_disagreement(args.collated)
     print_csv(CollatedFileType.output_format(purview_disagreement))
 
 
+def crossval_command(subparsers):
+    crossval_parser = subparsers.add_parser("crossval",
+                                            formatter_class=Raw,
+                                            description=textwrap.dedent("""
+    Cross-validate truth with a local answering engine.
+
+    The truth is randomly divided into folds. For each fold, a local TF-IDF nearest centroid classifier is trained on
+    the questions in the other folds and asked the questions in the fold. An answer is correct if it has the answer Id
+    of the question in the truth. Folds are evaluated in parallel.
+
+    Accuracy for each fold and for all the folds together is printed. The answers to all the questions may optionally
+    be written to a file."""),
+                                            help="cross-validate truth with a local answering engine")
+    crossval_parser.add_argument("truth", type=TruthFileType([QUESTION, ANSWER_ID]),
+                                 help="truth file created by the 'xmgr truth' command")
+    crossval_parser.add_argument("--folds", type=int, default=10, help="number of folds, default 10")
+    crossval_parser.add_argument("--stratify", action="store_true",
+                                 help="spread the questions for each answer Id evenly across the folds")
+    crossval_parser.add_argument("--seed", type=int, help="random seed")
+    crossval_parser.add_argument("--processes", metavar="PROCESSES", type=int,
+                                 help="number of processes evaluating folds in parallel, default one per CPU")
+    crossval_parser.add_argument("--answers", metavar="FILE", help="write answers to all the questions to this file")
+    crossval_parser.set_defaults(func=crossval_handler)
+
+
+def crossval_handler(args):
+    from themis.crossval import crossval
+    metrics, answers = crossval(args.truth, args.folds, args.stratify, args.seed, args.processes)
+    if args.answers is not None:
+        to_csv(args.answers, answers)
+    print_csv(metrics)
+
+
+def run_command(subparsers):
+    run_parser = subparsers.add_parser("run",
+                                       formatter_class=Raw,
+                                       description=textwrap.dedent("""
+    Run a pipeline of Themis commands described in a YAML file.
+
+    Each step in the pipeline is a Themis command with the files it reads and writes. A step depends on the steps that
+    write the files it reads. Steps whose inputs, command line, and outputs have not changed since they last succeeded
+    are skipped. Independent steps are run concurrently.
+
+    See the themis.pipeline module for the pipeline file format. The status of each step is printed."""),
+                                       help="run a pipeline of commands")
+    run_parser.add_argument("pipeline", help="YAML pipeline file")
+    run_parser.add_argument("steps", nargs="*", help="steps to run along with the steps they depend on, default all")
+    run_parser.add_argument("--jobs", type=int, help="maximum number of steps to run at once, default one per CPU")
+    run_parser.add_argument("--force", action="store_true", help="run steps even if they are up to date")
+    run_parser.add_argument("--dry-run", action="store_true", help="show which steps would run without running them")
+    run_parser.set_defaults(func=run_handler)
+
+
+def run_handler(args):
+    from themis.pipeline import FAILED, STATUS, run_pipeline
+    summary = run_pipeline(args.pipeline, args.steps, args.jobs, args.force, args.dry_run)
+    print_csv(summary)
+    if any(summary[STATUS] == FAILED):
+        sys.exit(1)
+
+
 def util_command(subparsers):
     util_parser = subparsers.add_parser("util", help="various utilities")
     subparsers = util_parser.add_subparsers(description="various utilities")
@@ -919,6 +1305,37 @@ def util_command(subparsers):
     kfold_split.add_argument("--output_directory", metavar="OUTPUT_DIRECTORY", type=str, default=".",
                                   help="output directory")
     kfold_split.set_defaults(func=kfold_split_handler)
+    import_time = subparsers.add_parser("import-time", help="measure command line startup and module import times")
+    import_time.add_argument("--repeat", type=int, default=5, help="number of times to measure each import")
+    import_time.set_defaults(func=import_time_handler)
+    synthetic = subparsers.add_parser("synthetic",
+                                      help="generate a synthetic usage log, corpus, truth, answers and judgments")
+    synthetic.add_argument("output_directory", metavar="OUTPUT_DIRECTORY", help="output directory")
+    synthetic.add_argument("--rows", type=int, default=10000, help="number of usage log rows, default 10000")
+    synthetic.add_argument("--systems", type=int, default=3, help="number of systems, default 3")
+    synthetic.add_argument("--seed", type=int, default=0, help="random number generator seed, default 0")
+    synthetic.set_defaults(func=synthetic_handler)
+    benchmark = subparsers.add_parser("benchmark", formatter_class=Raw, description=textwrap.dedent("""
+    Time and memory-profile the hot paths of an experiment on synthetic data at a range of scales.
+
+    The synthetic data for each scale is generated in a subdirectory of the benchmark directory the first time it is
+    needed and reused after that. Each benchmark's profile and log are written to the data directory.
+
+    Results from a baseline run, such as the previous release, may be given with the --compare option. The ratios of
+    the current results to the baseline are reported and the command exits with an error if any benchmark
+    regressed."""),
+                                      help="time and memory-profile hot paths at a range of scales")
+    benchmark.add_argument("directory", metavar="DIRECTORY", help="directory for synthetic data and benchmark output")
+    benchmark.add_argument("--scales", metavar="ROWS", type=int, nargs="+", default=[1000, 10000, 100000],
+                           help="numbers of usage log rows, default 1000 10000 100000")
+    benchmark.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, help="benchmarks to run, default all")
+    benchmark.add_argument("--systems", type=int, default=3, help="number of systems, default 3")
+    benchmark.add_argument("--repeat", type=int, default=1, help="number of times to run each benchmark, default 1")
+    benchmark.add_argument("--timeout", metavar="SECONDS", type=float, help="stop benchmarks that run this long")
+    benchmark.add_argument("--compare", metavar="BASELINE", type=CsvFileType(), help="baseline benchmark results")
+    benchmark.add_argument("--tolerance", type=float, default=0.2,
+                           help="fractional increase in time or memory that is not a regression, default 0.2")
+    benchmark.set_defaults(func=benchmark_handler)
 
 
 def rows_handler(args):
@@ -935,6 +1352,161 @@ def drop_null_handler(args):
     print_csv(non_null, index=False)
 
 
+def import_time_handler(args):
+    from themis.benchmark import import_times
+    print_csv(import_times(COMMAND_MODULES, args.repeat))
+
+
+def synthetic_handler(args):
+    from themis.synthetic import generate_experiment
+    generate_experiment(args.output_directory, args.rows, args.systems, args.seed)
+
+
+def benchmark_handler(args):
+    from themis.benchmark import run_benchmarks, compare_benchmarks, REGRESSION
+    results = run_benchmarks(args.directory, args.scales, args.systems, args.benchmarks, args.repeat, args.timeout)
+    if args.compare is not None:
+        results = compare_benchmarks(results, args.compare, args.tolerance)
+    print_csv(results)
+    if args.compare is not None and any(results[REGRESSION]):
+        sys.exit(1)
+
+
+def serve_command(subparsers):
+    serve_parser = subparsers.add_parser("serve", formatter_class=Raw, description=textwrap.dedent("""
+    Run a server that keeps the CSV files read by commands in memory, so that later commands do not have to parse them
+    again. Files are parsed again when they change. The corpus, truth and judgment files given as options are loaded
+    when the server starts and reloaded as soon as they change.
+
+    The server runs analyze, answer, judge and question commands sent to it by 'themis --server ADDRESS' or by
+    setting the THEMIS_SERVER environment variable to the address. Commands run in the directory they were sent from,
+    so the server and the commands must share a file system.
+
+    Files that were not preloaded are kept in memory up to a size limit, beyond which the least recently used are
+    dropped.
+
+    The address is either http://HOST:PORT or the name of a Unix socket, which only the user running the server can
+    connect to. Anyone who can connect to the server can run commands as that user, so the server only listens on a
+    loopback address such as 127.0.0.1 unless --allow-remote is given. Only allow remote connections on a trusted
+    network. GET /status on the server returns the files it has in memory."""),
+                                         help="keep files in memory for other commands")
+    serve_parser.add_argument("--address", default="http://127.0.0.1:8642",
+                              help="http://HOST:PORT or Unix socket file name, default http://127.0.0.1:8642")
+    serve_parser.add_argument("--corpus", metavar="FILE", help="corpus to load")
+    serve_parser.add_argument("--truth", metavar="FILE", help="truth to load")
+    serve_parser.add_argument("--judgments", metavar="FILE", nargs="+", default=[], help="judgments to load")
+    serve_parser.add_argument("--interval", metavar="SECONDS", type=float, default=5.0,
+                              help="how often to check whether files have changed, default 5 seconds")
+    serve_parser.add_argument("--cache-size", metavar="MB", type=float, default=4096,
+                              help="memory limit of the files kept that were not preloaded, default 4096 MB")
+    serve_parser.add_argument("--allow-remote", action="store_true",
+                              help="allow listening on a host that is not a loopback address")
+    serve_parser.set_defaults(func=HandlerClosure(serve_handler, serve_parser))
+
+
+def serve_handler(parser, args):
+    from themis.judge import JudgmentFileType
+    from themis.serve import serve
+    from themis.xmgr import CorpusFileType, TruthFileType
+    preload = [(JudgmentFileType(), judgments) for judgments in args.judgments]
+    if args.corpus is not None:
+        preload.append((CorpusFileType(), args.corpus))
+    if args.truth is not None:
+        preload.append((TruthFileType(), args.truth))
+    try:
+        serve(args.address, lambda argv: run(argv, served=True), preload, args.interval, args.cache_size,
+              args.allow_remote)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def without_server_option(argv):
+    """
+    :param argv: command line arguments
+    :type argv: list of str
+    :return: the arguments without the --server option
+    :rtype: list of str
+    """
+    arguments = []
+    skip = False
+    for argument in argv:
+        if skip:
+            skip = False
+        elif argument == "--server":
+            skip = True
+        elif not argument.startswith("--server="):
+            arguments.append(argument)
+    return arguments
+
+
+def workspace_command(subparsers):
+    workspace_parser = subparsers.add_parser("workspace", formatter_class=Raw, description=textwrap.dedent("""
+    Store experiment artifacts in a single SQLite database.
+
+    Each type of artifact has its own table, indexed by question, answer ID and system where it has those columns.
+    Several artifacts of the same type are told apart by a label, which is stored in the System column of answers and
+    curves and the Label column of everything else. The 'artifacts' table lists the artifacts in the workspace.
+
+    Wherever a command reads or writes a CSV file, WORKSPACE::ARTIFACT or WORKSPACE::ARTIFACT/LABEL refers to an
+    artifact in a workspace instead, and the --store option stores the CSV output of a command in a workspace."""),
+                                             help="store artifacts in a SQL workspace")
+    subparsers = workspace_parser.add_subparsers(description="workspace operations")
+    workspace_import = subparsers.add_parser("import", help="import a CSV file into a workspace")
+    workspace_import.add_argument("workspace", help="workspace database file, created if it does not exist")
+    workspace_import.add_argument("artifact",
+                                  help="artifact type: answers, collated, corpus, judgments, precision, qa_pairs, " +
+                                       "roc, truth, or any other name to store a file with the columns it has")
+    workspace_import.add_argument("file", help="CSV file")
+    workspace_import.add_argument("--label", default="",
+                                  help="label that distinguishes this artifact from others of the same type, such as " +
+                                       "the name of the system that produced answers")
+    workspace_import.set_defaults(func=workspace_import_handler)
+    workspace_list = subparsers.add_parser("list", help="list the artifacts in a workspace")
+    workspace_list.add_argument("workspace", help="workspace database file")
+    workspace_list.set_defaults(func=workspace_list_handler)
+
+
+def workspace_import_handler(args):
+    from themis.workspace import Workspace
+    workspace = Workspace(args.workspace)
+    try:
+        workspace.import_file(args.artifact, args.file, args.label)
+    finally:
+        workspace.close()
+
+
+def workspace_list_handler(args):
+    from themis.workspace import Workspace
+    workspace = Workspace(args.workspace)
+    try:
+        print_csv(workspace.artifacts(), index=False)
+    finally:
+        workspace.close()
+
+
+def query_command(subparsers):
+    query_parser = subparsers.add_parser("query", description="Run a read-only SQL query on a workspace.",
+                                         help="run an SQL query on a workspace")
+    query_parser.add_argument("workspace", help="workspace database file")
+    query_parser.add_argument("sql", help="SQL query")
+    query_parser.set_defaults(func=HandlerClosure(query_handler, query_parser))
+
+
+def query_handler(parser, args):
+    import sqlite3
+    from themis.workspace import Workspace
+    if not os.path.isfile(args.workspace):
+        parser.error("argument workspace: no such file: '%s'" % args.workspace)
+    workspace = Workspace(args.workspace, read_only=True)
+    try:
+        results = workspace.query(args.sql)
+    except (sqlite3.Error, ValueError) as e:
+        parser.error("invalid query: %s" % e)
+    finally:
+        workspace.close()
+    print_csv(results, index=False)
+
+
 def version_command(subparsers):
     version_parser = subparsers.add_parser("version", help="print version number")
     version_parser.set_defaults(func=version_handler)
@@ -945,9 +1517,49 @@ def version_handler(_):
 
 
 def kfold_split_handler(args):
+    from themis.analyze import kfold_split
     kfold_split(args.file, args.output_directory, 5)
 
 
+class CompactAction(argparse.Action):
+    """
+    Enable compact loading as soon as the option is parsed, so that it applies to the files named in the subcommand
+    arguments that follow it.
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        enable_compact_loading()
+        setattr(namespace, self.dest, True)
+
+
+class CsvFileNamespace(argparse.Namespace):
+    """
+    Command line arguments that parse the CSV files they name the first time they are used.
+    """
+
+    def __getattribute__(self, name):
+        value = argparse.Namespace.__getattribute__(self, name)
+        try:
+            csv = load_csv_files(value)
+        except ValueError:
+            invalid = [csv_file for csv_file in (value if isinstance(value, list) else [value])
+                       if isinstance(csv_file, CsvFile) and csv_file.csv is None][0]
+            raise InvalidCsvFileArgument(name, invalid)
+        if csv is not value:
+            setattr(self, name, csv)
+        return csv
+
+
+class InvalidCsvFileArgument(Exception):
+    """
+    A CSV file named on the command line could not be parsed when it was used.
+    """
+
+    def __init__(self, name, csv_file):
+        super(self.__class__, self).__init__("argument %s: invalid %s value: '%s'" %
+                                             (name, csv_file.file_type.__class__.__name__, csv_file.filename))
+
+
 class HandlerClosure(object):
     def __init__(self, func, parser):
         self.func = func
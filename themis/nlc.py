@@ -4,6 +4,7 @@ from watson_developer_cloud import NaturalLanguageClassifierV1 as NaturalLanguag
 
 from themis import QUESTION, ANSWER_ID, ANSWER
 from themis import logger, to_csv, pretty_print_json
+from themis.telemetry import timed
 
 
 def classifier_list(url, username, password):
@@ -51,6 +52,7 @@ class NLC(object):
     def __repr__(self):
         return "NLC: %s" % self.classifier_id
 
+    @timed("NLC.ask")
     def ask(self, question):
         classification = self.nlc.classify(self.classifier_id, question)
         class_name = classification["classes"][0]["class_name"]
@@ -0,0 +1,366 @@
+"""
+Run a Themis experiment as a pipeline of commands.
+
+A pipeline is a YAML file that maps step names to Themis commands and the files they read and write.
+
+    steps:
+      qa-pairs:
+        command: question extract QuestionsData.csv
+        inputs: [QuestionsData.csv]
+        stdout: qa-pairs.csv
+      wea:
+        command: answer wea qa-pairs.csv answers.wea.csv qa-pairs.csv
+        inputs: [qa-pairs.csv]
+        outputs: [answers.wea.csv]
+
+A step's command is a command line without the 'themis' program name, given either as a string or a list of
+arguments. The optional stdout file receives the command's standard output and is one of its outputs. It is compressed
+if its name ends in .gz, .xz, or .zst. Inputs and outputs may be files or directories. Relative paths are relative to
+the directory containing the pipeline file, in which the commands are run.
+
+Steps form a directed acyclic graph in which a step depends on the steps that write its inputs, and on any steps named
+in an optional 'after' list. Steps run as soon as the steps they depend on have finished, so independent steps run
+concurrently.
+
+A step is skipped if its outputs are up to date. Each step has a key that is a hash of its command line, its output
+names, and the contents of its inputs. The keys and the content hashes of the outputs of successful steps are recorded
+in a cache file. A step is up to date if its key has not changed and its outputs still have the recorded contents.
+Since keys depend on input contents rather than modification times, a step whose inputs were rewritten with the same
+contents is not rerun. A command that exits successfully without writing all of its step's outputs fails the step.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import timeit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas
+
+import themis
+from themis import logger, __version__, compression, open_file
+
+STEP = "Step"
+STATUS = "Status"
+SECONDS = "Seconds"
+
+RUN = "run"
+UP_TO_DATE = "up to date"
+FAILED = "failed"
+NOT_RUN = "not run"
+WOULD_RUN = "would run"
+
+# Name of the file in which step keys and output hashes are recorded, relative to the pipeline file.
+CACHE_FILENAME = ".themis-pipeline.json"
+
+
+def run_pipeline(pipeline_filename, targets=None, jobs=None, force=False, dry_run=False):
+    """
+    Run the steps of a pipeline whose outputs are not up to date.
+
+    :param pipeline_filename: YAML pipeline file
+    :type pipeline_filename: str
+    :param targets: names of steps to run along with the steps they depend on, if None run all steps
+    :type targets: list of str
+    :param jobs: maximum number of steps to run at once, if None use one per CPU
+    :type jobs: int
+    :param force: run steps even if they are up to date
+    :type force: bool
+    :param dry_run: report which steps would run without running them
+    :type dry_run: bool
+    :return: status and run time of each step
+    :rtype: pandas.DataFrame
+    """
+    pipeline = Pipeline(pipeline_filename)
+    steps = pipeline.required_steps(targets)
+    cache = PipelineCache(os.path.join(pipeline.directory, CACHE_FILENAME))
+    dependencies = dict((name, pipeline.dependencies[name] & steps) for name in steps)
+    status = {}
+    seconds = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs or multiprocessing.cpu_count()) as executor:
+        while len(status) < len(steps):
+            # Visit steps in topological order so that the status of a step is known before its dependents are visited.
+            for name in pipeline.order:
+                if name not in steps or name in status or name in running.values():
+                    continue
+                dependency_status = [status.get(d) for d in dependencies[name]]
+                if any(s in (FAILED, NOT_RUN) for s in dependency_status):
+                    status[name] = NOT_RUN
+                elif all(s in (RUN, UP_TO_DATE, WOULD_RUN) for s in dependency_status):
+                    step = pipeline.steps[name]
+                    # In a dry run, a step whose inputs would be rewritten cannot be checked.
+                    key = None if WOULD_RUN in dependency_status else step.key(cache)
+                    if key is not None and not force and cache.up_to_date(name, key, step):
+                        logger.info("Step %s is up to date" % name)
+                        status[name] = UP_TO_DATE
+                    elif dry_run:
+                        logger.info("Step %s would run: %s" % (name, step))
+                        status[name] = WOULD_RUN
+                    else:
+                        running[executor.submit(step.run)] = name
+            if running:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    success, seconds[name] = future.result()
+                    step = pipeline.steps[name]
+                    outputs = step.output_hashes(cache)
+                    missing = [o for o, digest in sorted(outputs.items()) if digest is None]
+                    if success and missing:
+                        logger.error("Step %s did not write %s" %
+                                     (name, ", ".join(os.path.relpath(o, step.directory) for o in missing)))
+                        success = False
+                    if success:
+                        cache.record(name, step.key(cache), outputs)
+                        status[name] = RUN
+                    else:
+                        logger.error("Step %s failed" % name)
+                        cache.remove(name)
+                        status[name] = FAILED
+                    cache.save()
+    summary = pandas.DataFrame([(name, status[name], seconds.get(name)) for name in pipeline.order if name in steps],
+                               columns=[STEP, STATUS, SECONDS])
+    return summary.set_index(STEP)
+
+
+class Pipeline(object):
+    """
+    The steps of a pipeline and the dependencies between them.
+    """
+
+    def __init__(self, filename):
+        import yaml
+
+        with open(filename) as f:
+            specification = yaml.safe_load(f)
+        if not isinstance(specification, dict) or not isinstance(specification.get("steps"), dict):
+            raise ValueError("%s does not have a 'steps' mapping" % filename)
+        self.filename = filename
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self.steps = dict((name, PipelineStep(name, step, self.directory))
+                          for name, step in specification["steps"].items())
+        producers = {}
+        for name, step in self.steps.items():
+            for output in step.outputs:
+                if output in producers:
+                    raise ValueError("Steps %s and %s both write %s" % (producers[output], name, output))
+                producers[output] = name
+        self.dependencies = {}
+        for name, step in self.steps.items():
+            unknown = [d for d in step.after if d not in self.steps]
+            if unknown:
+                raise ValueError("Step %s runs after unknown steps %s" % (name, ", ".join(unknown)))
+            self.dependencies[name] = set(producers[i] for i in step.inputs if i in producers) | set(step.after)
+        self.order = self.topological_order()
+
+    def __repr__(self):
+        return "Pipeline %s: %d steps" % (self.filename, len(self.steps))
+
+    def topological_order(self):
+        """
+        :return: step names ordered so that every step comes after the steps it depends on
+        :rtype: list of str
+        """
+        order = []
+        visiting = set()
+
+        def visit(name, path):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError("Pipeline steps have a cycle: %s" % " -> ".join(path + [name]))
+            visiting.add(name)
+            for dependency in sorted(self.dependencies[name]):
+                visit(dependency, path + [name])
+            visiting.remove(name)
+            order.append(name)
+
+        for name in sorted(self.steps):
+            visit(name, [])
+        return order
+
+    def required_steps(self, targets=None):
+        """
+        :param targets: names of steps, if None all steps
+        :type targets: list of str
+        :return: the target steps and all the steps they depend on
+        :rtype: set of str
+        """
+        if not targets:
+            return set(self.steps)
+        unknown = [target for target in targets if target not in self.steps]
+        if unknown:
+            raise ValueError("Unknown pipeline steps %s" % ", ".join(unknown))
+        steps = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in steps:
+                steps.add(name)
+                pending.extend(self.dependencies[name])
+        return steps
+
+
+class PipelineStep(object):
+    """
+    A Themis command that reads input files and writes output files.
+    """
+
+    def __init__(self, name, specification, directory):
+        if not isinstance(specification, dict) or "command" not in specification:
+            raise ValueError("Step %s does not have a command" % name)
+        command = specification["command"]
+        self.name = name
+        self.arguments = shlex.split(command) if isinstance(command, str) else [str(a) for a in command]
+        self.directory = directory
+        self.inputs = [self.path(i) for i in specification.get("inputs", [])]
+        self.stdout = specification.get("stdout")
+        if self.stdout is not None:
+            self.stdout = self.path(self.stdout)
+        self.outputs = [self.path(o) for o in specification.get("outputs", [])]
+        if self.stdout is not None and self.stdout not in self.outputs:
+            self.outputs.append(self.stdout)
+        self.after = specification.get("after", [])
+
+    def __repr__(self):
+        command = "themis " + " ".join(shlex.quote(a) for a in self.arguments)
+        if self.stdout is not None:
+            command += " > %s" % shlex.quote(os.path.relpath(self.stdout, self.directory))
+        return command
+
+    def path(self, filename):
+        return os.path.normpath(os.path.join(self.directory, filename))
+
+    def key(self, cache):
+        """
+        :param cache: pipeline cache used to look up file hashes
+        :type cache: PipelineCache
+        :return: hash of the command line, outputs, and input contents, or None if an input is missing
+        :rtype: str
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps([__version__, self.arguments, self.outputs]).encode("utf-8"))
+        for i in self.inputs:
+            digest = cache.hash(i)
+            if digest is None:
+                return None
+            h.update(("%s %s\n" % (i, digest)).encode("utf-8"))
+        return h.hexdigest()
+
+    def output_hashes(self, cache):
+        return dict((o, cache.hash(o)) for o in self.outputs)
+
+    def run(self):
+        """
+        Run the step's command in a separate process.
+
+        :return: whether the command succeeded and how long it took in seconds
+        :rtype: (bool, float)
+        """
+        logger.info("Run step %s: %s" % (self.name, self))
+        start = timeit.default_timer()
+        level = logging.getLevelName(logger.getEffectiveLevel())
+        command = [sys.executable, "-m", "themis.main", "--log", level] + self.arguments
+        environment = themis_environment()
+        if self.stdout is None:
+            return_code = subprocess.call(command, cwd=self.directory, env=environment)
+        elif compression(self.stdout) is None:
+            with open(self.stdout, "wb") as stdout:
+                return_code = subprocess.call(command, cwd=self.directory, env=environment, stdout=stdout)
+        else:
+            # Compress the standard output of the command as it is written.
+            with open_file(self.stdout, "wb") as stdout:
+                process = subprocess.Popen(command, cwd=self.directory, env=environment, stdout=subprocess.PIPE)
+                shutil.copyfileobj(process.stdout, stdout)
+                return_code = process.wait()
+        return return_code == 0, timeit.default_timer() - start
+
+
+def themis_environment():
+    """
+    :return: environment in which this copy of Themis can be imported from any directory even if it is not installed
+    :rtype: dict
+    """
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(themis.__file__)))] +
+        [path for path in [environment.get("PYTHONPATH")] if path])
+    return environment
+
+
+class PipelineCache(object):
+    """
+    A JSON file that records the key and output hashes of every successful step.
+
+    It also records the size, modification time, and content hash of every file that has been hashed so that
+    unchanged files do not have to be read again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                cache = json.load(f)
+        else:
+            cache = {}
+        self.steps = cache.get("steps", {})
+        self.files = cache.get("files", {})
+
+    def __repr__(self):
+        return "Pipeline cache %s: %d steps" % (self.filename, len(self.steps))
+
+    def up_to_date(self, name, key, step):
+        entry = self.steps.get(name)
+        if entry is None or entry["key"] != key:
+            return False
+        outputs = step.output_hashes(self)
+        # A step whose outputs are missing is never up to date.
+        return None not in outputs.values() and entry["outputs"] == outputs
+
+    def record(self, name, key, outputs):
+        self.steps[name] = {"key": key, "outputs": outputs}
+
+    def remove(self, name):
+        self.steps.pop(name, None)
+
+    def save(self):
+        temporary = self.filename + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"steps": self.steps, "files": self.files}, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.filename)
+
+    def hash(self, path):
+        """
+        :param path: file or directory
+        :type path: str
+        :return: hash of the contents of a file or of the names and contents of the files in a directory, or None if
+            the path does not exist
+        :rtype: str
+        """
+        if os.path.isdir(path):
+            h = hashlib.sha1()
+            for directory, subdirectories, filenames in os.walk(path):
+                subdirectories.sort()
+                for filename in sorted(filenames):
+                    filename = os.path.join(directory, filename)
+                    h.update(("%s %s\n" % (os.path.relpath(filename, path), self.hash(filename))).encode("utf-8"))
+            return h.hexdigest()
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        entry = self.files.get(path)
+        if entry is None or entry[:2] != signature:
+            h = hashlib.sha1()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(2 ** 20), b""):
+                    h.update(block)
+            entry = signature + [h.hexdigest()]
+            self.files[path] = entry
+        return entry[2]
@@ -1,15 +1,20 @@
-import matplotlib.pyplot as plt
+import heapq
+import math
+import os
+
 import numpy
 import pandas
 
-from themis import CORRECT, IN_PURVIEW, CONFIDENCE, FREQUENCY, CsvFileType, QUESTION, logger
+from themis import CORRECT, IN_PURVIEW, CONFIDENCE, FREQUENCY, CsvFileType, QUESTION, logger, sort_for_output
 from themis.analyze import SYSTEM, drop_missing
+from themis.profiling import stage
 
 THRESHOLD = "Threshold"
 TRUE_POSITIVE_RATE = "True Positive Rate"
 FALSE_POSITIVE_RATE = "False Positive Rate"
 PRECISION = "Precision"
 ATTEMPTED = "Attempted"
+PANEL = "Panel"
 
 
 def generate_curves(curve_type, collated):
@@ -25,18 +30,36 @@ def generate_curves(curve_type, collated):
     """
     collated = pandas.concat(collated)
     collated = drop_missing(collated)
-    ds = collated.duplicated(subset=(SYSTEM, QUESTION))
+    return system_curves([curve_type], collated)[curve_type]
+
+
+@stage("curves")
+def system_curves(curve_types, systems_data):
+    """
+    Generate curves of several types for multiple systems in a single pass over the systems.
+
+    :param curve_types: 'precision' or 'roc'
+    :type curve_types: list of str
+    :param systems_data: questions, answers, judgments, confidences, and frequencies across systems with no missing
+        values
+    :type systems_data: pandas.DataFrame
+    :return: mapping of curve types to mappings of system labels to curve data
+    :rtype: {str : {str : pandas.DataFrame}}
+    """
+    ds = systems_data.duplicated(subset=(SYSTEM, QUESTION))
     if any(ds):
-        logger.error("Duplicate answers for %s" % ", ".join(collated[ds][SYSTEM].drop_duplicates()))
+        logger.error("Duplicate answers for %s" % ", ".join(systems_data[ds][SYSTEM].drop_duplicates()))
         raise ValueError("Cannot have multiple answers to the same question from a single system")
     try:
-        curve = {"precision": precision_curve, "roc": roc_curve}[curve_type]
-    except KeyError:
-        raise ValueError("Invalid curve type %s" % curve_type)
-    curves = {}
-    for label, data in collated.groupby(SYSTEM):
-        curves[label] = {"precision": PrecisionCurveFileType,
-                         "roc": ROCCurveFileType}[curve_type].output_format(curve(data))
+        curve_functions = [(curve_type, {"precision": precision_curve, "roc": roc_curve}[curve_type],
+                            {"precision": PrecisionCurveFileType, "roc": ROCCurveFileType}[curve_type])
+                           for curve_type in curve_types]
+    except KeyError as e:
+        raise ValueError("Invalid curve type %s" % e.args[0])
+    curves = dict((curve_type, {}) for curve_type in curve_types)
+    for label, data in systems_data.groupby(SYSTEM, observed=True):
+        for curve_type, curve, file_type in curve_functions:
+            curves[curve_type][label] = file_type.output_format(curve(data))
     return curves
 
 
@@ -49,27 +72,43 @@ def roc_curve(judgments):
     :return: true positive rate, false positive rate, and confidence thresholds
     :rtype: pandas.DataFrame
     """
-    ts = confidence_thresholds(judgments, True)
-    true_positive_rates = [true_positive_rate(judgments, t) for t in ts]
-    false_positive_rates = [false_positive_rate(judgments, t) for t in ts]
+    ts, correct, in_purview, out_of_purview = cumulative_judgments(judgments)
+    # The curve starts at an infinite threshold at which no questions are attempted.
+    ts = numpy.insert(ts, 0, numpy.Infinity)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        true_positive_rates = numpy.insert(correct, 0, 0) / float(in_purview[-1] if len(in_purview) else 0)
+        false_positive_rates = numpy.insert(out_of_purview, 0, 0) / \
+            float(out_of_purview[-1] if len(out_of_purview) else 0)
     curve = pandas.DataFrame.from_dict({THRESHOLD: ts,
                                         TRUE_POSITIVE_RATE: true_positive_rates,
                                         FALSE_POSITIVE_RATE: false_positive_rates})
     return curve
 
 
-def true_positive_rate(judgments, t):
-    correct = judgments[judgments[CORRECT]]
-    true_positive = sum(correct[correct[CONFIDENCE] >= t][FREQUENCY])
-    in_purview = sum(judgments[judgments[IN_PURVIEW]][FREQUENCY])
-    return true_positive / float(in_purview)
+def cumulative_judgments(judgments):
+    """
+    Frequency-weighted judgment counts of the questions attempted at each confidence threshold.
+
+    The judgments are sorted by descending confidence once and the counts are cumulative sums taken at the last
+    judgment with each distinct confidence, so all the points of a curve are computed in O(N log N) time.
 
+    :param judgments: confidence, in purview, correct, and frequency information
+    :type judgments: pandas.DataFrame
+    :return: distinct confidences in descending order, and the correct, in-purview, and out-of-purview frequencies of
+        questions with at least those confidences
+    :rtype: (numpy.array, numpy.array, numpy.array, numpy.array)
+    """
+    judgments = judgments.sort_values(CONFIDENCE, ascending=False, kind="mergesort")
+    confidence = judgments[CONFIDENCE].values
+    frequency = judgments[FREQUENCY].values
+    ends = numpy.append(numpy.flatnonzero(confidence[1:] != confidence[:-1]), len(confidence) - 1)
+    ends = ends[ends >= 0]
 
-def false_positive_rate(judgments, t):
-    out_of_purview_questions = judgments[judgments[IN_PURVIEW] == False]
-    false_positive = sum(out_of_purview_questions[out_of_purview_questions[CONFIDENCE] >= t][FREQUENCY])
-    out_of_purview = sum(out_of_purview_questions[FREQUENCY])
-    return false_positive / float(out_of_purview)
+    def cumulative(mask):
+        return numpy.cumsum(numpy.where(numpy.asarray(mask, dtype=bool), frequency, 0))[ends]
+
+    return confidence[ends], cumulative(judgments[CORRECT] == True), cumulative(judgments[IN_PURVIEW] == True), \
+        cumulative(judgments[IN_PURVIEW] == False)
 
 
 def precision_curve(judgments):
@@ -81,55 +120,205 @@ def precision_curve(judgments):
     :return: questions attempted, precision, and confidence thresholds
     :rtype: pandas.DataFrame
     """
-    ts = confidence_thresholds(judgments, False)
-    precision_values = [(t, precision(judgments, t)) for t in ts]
-    attempted_values = [(t, questions_attempted(judgments, t)) for t in ts]
+    ts, correct, in_purview, _ = cumulative_judgments(judgments)
+    total_in_purview = in_purview[-1] if len(in_purview) else 0
     # Plot those threshold values that have both x and y values.
-    xs = [(pv[0], pv[1], av[1]) for pv, av in zip(precision_values, attempted_values)
-          if pv[1] is not None and av[1] is not None]
-    ts, precision_values, attempted_values = zip(*xs)  # zip(*x) is the inverse of zip(x)
+    defined = in_purview > 0
+    if total_in_purview == 0:
+        logger.warning("No in-purview questions attempted at any threshold level")
+        defined[:] = False
+    elif not all(defined):
+        logger.warning("No in-purview questions at %d threshold levels down to %0.3f" %
+                       (len(defined) - sum(defined), ts[~defined][-1]))
+    ts, correct, in_purview = ts[defined], correct[defined], in_purview[defined]
+    precision_values = correct / in_purview.astype("float")
+    attempted_values = in_purview / float(total_in_purview)
     curve = pandas.DataFrame.from_dict({THRESHOLD: ts, PRECISION: precision_values, ATTEMPTED: attempted_values})
     return curve
 
 
-def precision(judgments, t):
-    s = judgments[judgments[CONFIDENCE] >= t]
-    correct = sum(s[s[CORRECT]][FREQUENCY])
-    in_purview = sum(s[s[IN_PURVIEW]][FREQUENCY])
-    try:
-        return correct / float(in_purview)
-    except ZeroDivisionError:
-        logger.warning("No in-purview questions at threshold level %0.3f" % t)
-        return None
+def precision_threshold(curve, target):
+    """
+    Find the lowest confidence threshold at which the precision at that threshold and all higher ones is at least a
+    target value.
 
+    The running minimum of precision from the highest threshold down is monotonic, so it is found by binary search.
 
-def questions_attempted(judgments, t):
-    s = judgments[judgments[CONFIDENCE] >= t]
-    in_purview_attempted = sum(s[s[IN_PURVIEW]][FREQUENCY])
-    total_in_purview = sum(judgments[judgments[IN_PURVIEW]][FREQUENCY])
-    try:
-        return in_purview_attempted / float(total_in_purview)
-    except ZeroDivisionError:
-        logger.warning("No in-purview questions attempted at threshold level %0.3f" % t)
+    :param curve: precision curve indexed by threshold, as returned by generate_curves
+    :type curve: pandas.DataFrame
+    :param target: minimum precision
+    :type target: float
+    :return: curve point at the threshold, or None if no threshold achieves the target precision
+    :rtype: pandas.Series
+    """
+    curve = curve.sort_index(ascending=False)
+    lowest_precision = numpy.minimum.accumulate(curve[PRECISION].values)
+    n = numpy.searchsorted(-lowest_precision, -target, side="right")
+    if n == 0:
         return None
+    return curve.iloc[n - 1]
+
+
+def curve_area(curve):
+    """
+    Trapezoidal area under a curve, where the first column is the x coordinate and the second the y coordinate.
+
+    This is the area under the ROC curve for an ROC curve and the area under precision as a function of questions
+    attempted for a precision curve.
 
+    :param curve: curve indexed by threshold, as returned by generate_curves
+    :type curve: pandas.DataFrame
+    :return: area under the curve
+    :rtype: float
+    """
+    curve = curve.sort_index(ascending=False)
+    return numpy.trapz(curve.iloc[:, 1].values, curve.iloc[:, 0].values)
+
+
+def decimate_curve(curve, max_points, tolerance=0.0):
+    """
+    Reduce the number of points in a curve while keeping its shape.
+
+    Starting with the curve's end points, repeatedly add the point farthest from the line segment between the points
+    already kept on either side of it, until there are max_points points or no point is farther than the tolerance.
+    The kept points are a subset of the original ones, so their thresholds are unchanged. The distance of the farthest
+    remaining point bounds the error of the decimated curve.
+
+    :param curve: curve indexed by threshold, as returned by generate_curves
+    :type curve: pandas.DataFrame
+    :param max_points: maximum number of points in the decimated curve, at least 2, if None only use the tolerance
+    :type max_points: int
+    :param tolerance: stop adding points once no point is farther than this from the decimated curve
+    :type tolerance: float
+    :return: decimated curve and the maximum distance of an original point from it
+    :rtype: (pandas.DataFrame, float)
+    """
+    n = len(curve)
+    max_points = max(max_points or n, 2)
+    if n <= 2 or (n <= max_points and not tolerance):
+        return curve, 0.0
+    x = curve.iloc[:, 0].values
+    y = curve.iloc[:, 1].values
+    keep = numpy.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    segments = []
 
-def confidence_thresholds(judgments, add_max):
-    ts = judgments[CONFIDENCE].sort_values(ascending=False).unique()
-    if add_max:
-        ts = numpy.insert(ts, 0, numpy.Infinity)
-    return ts
+    def split(i, j):
+        if j - i < 2:
+            return
+        dx, dy = x[j] - x[i], y[j] - y[i]
+        xs, ys = x[i + 1:j] - x[i], y[i + 1:j] - y[i]
+        length = numpy.hypot(dx, dy)
+        if length:
+            distances = numpy.abs(dx * ys - dy * xs) / length
+        else:
+            distances = numpy.hypot(xs, ys)
+        distances = numpy.nan_to_num(distances)
+        k = numpy.argmax(distances)
+        heapq.heappush(segments, (-distances[k], i, j, i + 1 + k))
 
+    split(0, n - 1)
+    points = 2
+    while segments and points < max_points and -segments[0][0] > tolerance:
+        _, i, j, k = heapq.heappop(segments)
+        keep[k] = True
+        points += 1
+        split(i, k)
+        split(k, j)
+    error = -segments[0][0] if segments else 0.0
+    return curve[keep], error
 
-def plot_curves(curves, curve_type):
-    x_label = curves.values()[0].columns[0]
-    y_label = curves.values()[0].columns[1]
-    for label, curve in curves.items():
-        plt.plot(curve[x_label], curve[y_label], label=label)
-    plt.legend(loc={"precision": 3, "roc": 1}[curve_type])
-    plt.xlabel(x_label)
-    plt.ylabel(y_label)
-    plt.show()
+
+def panel_titles(collated):
+    """
+    Name the panel drawn for each collated file after the file, numbering the names if they are not distinct.
+
+    :param collated: collated files
+    :type collated: list of pandas.DataFrame
+    :return: panel titles
+    :rtype: list of str
+    """
+    titles = [os.path.basename(getattr(systems_data, "filename", "")).split(".")[0] or "collated"
+              for systems_data in collated]
+    if len(set(titles)) < len(titles):
+        titles = ["%d-%s" % (i + 1, title) for i, title in enumerate(titles)]
+    return titles
+
+
+def plot_curves(curves, curve_type, filename=None):
+    """
+    Draw curves of the same type for multiple systems.
+
+    :param curves: mapping of system labels to curve data
+    :type curves: {str : pandas.DataFrame}
+    :param curve_type: 'precision' or 'roc'
+    :type curve_type: str
+    :param filename: image file to render the plot to, its format is determined by its extension, if None show the
+        plot on the screen
+    :type filename: str
+    """
+    plot_panels([(None, curves)], curve_type, filename)
+
+
+def plot_panels(panels, curve_type, filename=None):
+    """
+    Draw several panels of curves of the same type in a single figure.
+
+    :param panels: panel titles and mappings of system labels to curve data
+    :type panels: list of (str, {str : pandas.DataFrame})
+    :param curve_type: 'precision' or 'roc'
+    :type curve_type: str
+    :param filename: image file to render the figure to, its format is determined by its extension, if None show the
+        figure on the screen
+    :type filename: str
+    """
+    plt = pyplot(filename is None)
+    columns = int(math.ceil(math.sqrt(len(panels))))
+    rows = int(math.ceil(len(panels) / float(columns)))
+    figure, axes = plt.subplots(rows, columns, squeeze=False, figsize=(6.4 * columns, 4.8 * rows))
+    for axis, (title, curves) in zip(axes.flat, panels):
+        draw_curves(axis, curves, curve_type)
+        if title is not None:
+            axis.set_title(title)
+    for axis in axes.flat[len(panels):]:
+        axis.set_visible(False)
+    figure.tight_layout()
+    if filename is None:
+        plt.show()
+    else:
+        logger.info("Write %s plot to %s" % (curve_type, filename))
+        figure.savefig(filename)
+        plt.close(figure)
+
+
+def draw_curves(axis, curves, curve_type):
+    if not curves:
+        return
+    x_label, y_label = next(iter(curves.values())).columns[:2]
+    for label, curve in sorted(curves.items()):
+        axis.plot(curve[x_label], curve[y_label], label=label)
+    axis.legend(loc={"precision": 3, "roc": 1}[curve_type])
+    axis.set_xlabel(x_label)
+    axis.set_ylabel(y_label)
+
+
+def pyplot(interactive):
+    """
+    Import matplotlib's pyplot module.
+
+    Matplotlib is slow to import, so it is only imported when a plot is drawn. A non-interactive backend is used for
+    plots that are rendered to files so that they can be drawn on machines without a display.
+
+    :param interactive: whether the plot will be shown on the screen
+    :type interactive: bool
+    :return: pyplot module
+    :rtype: module
+    """
+    import matplotlib
+    if not interactive:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
 
 
 class PrecisionCurveFileType(CsvFileType):
@@ -141,7 +330,7 @@ class PrecisionCurveFileType(CsvFileType):
     @classmethod
     def output_format(cls, curve):
         curve = curve[cls.columns]
-        curve = curve.sort_values(THRESHOLD)
+        curve = sort_for_output(curve, THRESHOLD)
         return curve.set_index(THRESHOLD)
 
 
@@ -154,5 +343,5 @@ class ROCCurveFileType(CsvFileType):
     @classmethod
     def output_format(cls, curve):
         curve = curve[cls.columns]
-        curve = curve.sort_values(THRESHOLD)
+        curve = sort_for_output(curve, THRESHOLD)
         return curve.set_index(THRESHOLD)
@@ -0,0 +1,207 @@
+"""
+Record the time and memory used by the stages of a command.
+
+Code marks a stage by running it inside 'with stage(name)' or by decorating a function with '@stage(name)'. Stages may
+be nested. Nothing is recorded unless profiling has been started with start_profiling, so marking a stage costs almost
+nothing in a normal run.
+
+For each stage name the profiler records the number of times it ran, its total wall time, and its wall time excluding
+nested stages. It also records the process's peak resident set size when the stage finished and, if memory tracing is
+enabled, the peak memory allocated by Python while the stage ran. Memory tracing uses tracemalloc, which slows the
+program down, so the times recorded with it are less accurate.
+"""
+import cProfile
+import functools
+import json
+import logging
+import os
+import sys
+import time
+import timeit
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger("themis")
+
+# The active profiler, or None if profiling has not been started.
+profiler = None
+
+
+class stage(object):
+    """
+    Mark a named stage of a command for the profiler.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if profiler is not None:
+            profiler.enter(self.name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if profiler is not None:
+            profiler.exit()
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def staged(*args, **kwargs):
+            with self:
+                return function(*args, **kwargs)
+
+        return staged
+
+
+def start_profiling(trace_memory=False, stats_filename=None):
+    """
+    Start recording stages.
+
+    :param trace_memory: record the peak memory allocated by Python in each stage
+    :type trace_memory: bool
+    :param stats_filename: name of a file to which to write cProfile statistics, if None do not run cProfile
+    :type stats_filename: str
+    :return: the profiler
+    :rtype: Profiler
+    """
+    global profiler
+    profiler = Profiler(trace_memory, stats_filename)
+    return profiler
+
+
+def stop_profiling():
+    """
+    Stop recording stages.
+
+    :return: summary of the profiled run
+    :rtype: dict
+    """
+    global profiler
+    summary = profiler.stop()
+    profiler = None
+    return summary
+
+
+class Profiler(object):
+    """
+    Records the time and memory used by nested stages.
+    """
+
+    def __init__(self, trace_memory=False, stats_filename=None):
+        self.trace_memory = trace_memory
+        self.stats_filename = stats_filename
+        self.stages = {}
+        # Open stages, each with its name, start time, time spent in nested stages, and peak traced memory.
+        self.stack = []
+        self.start_time = time.time()
+        self.start = timeit.default_timer()
+        if trace_memory:
+            tracemalloc.start()
+        if stats_filename is not None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.profile = None
+
+    def __repr__(self):
+        return "%s: %d stages" % (self.__class__.__name__, len(self.stages))
+
+    def enter(self, name):
+        if self.trace_memory:
+            if self.stack:
+                self.stack[-1][3] = max(self.stack[-1][3], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.stack.append([name, timeit.default_timer(), 0.0, 0])
+
+    def exit(self):
+        name, start, nested, peak = self.stack.pop()
+        seconds = timeit.default_timer() - start
+        record = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "self_seconds": 0.0,
+                                               "peak_rss_bytes": None, "peak_traced_bytes": None})
+        # A stage nested inside another stage with the same name is only counted once in the calls and total time.
+        if name not in [s[0] for s in self.stack]:
+            record["calls"] += 1
+            record["seconds"] += seconds
+        record["self_seconds"] += seconds - nested
+        rss = peak_rss()
+        if rss is not None:
+            record["peak_rss_bytes"] = max(record["peak_rss_bytes"] or 0, rss)
+        if self.trace_memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            record["peak_traced_bytes"] = max(record["peak_traced_bytes"] or 0, peak)
+        if self.stack:
+            self.stack[-1][2] += seconds
+            self.stack[-1][3] = max(self.stack[-1][3], peak)
+
+    def stop(self):
+        """
+        Close any open stages, stop tracing, and write the cProfile statistics.
+
+        :return: summary of the profiled run
+        :rtype: dict
+        """
+        while self.stack:
+            self.exit()
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.stats_filename)
+            logger.info("Wrote profile statistics to %s" % self.stats_filename)
+        summary = {"argv": sys.argv,
+                   "start": self.start_time,
+                   "seconds": timeit.default_timer() - self.start,
+                   "peak_rss_bytes": peak_rss(),
+                   "children_peak_rss_bytes": peak_rss(children=True),
+                   "peak_traced_bytes": None,
+                   "stages": [dict(stage=name, **record) for name, record in self.stages.items()]}
+        if self.trace_memory:
+            summary["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return summary
+
+
+def peak_rss(children=False):
+    """
+    :param children: get the largest peak of the finished child processes instead of this process
+    :type children: bool
+    :return: peak resident set size in bytes, or None if it is not available on this platform
+    :rtype: int
+    """
+    if not children and os.path.isfile("/proc/self/status"):
+        # On Linux the peak reported by getrusage carries over from the parent of a process that was started with
+        # fork and exec, so get this process's own peak from the proc filesystem.
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def write_profile(filename, summary):
+    """
+    Write a profile summary as JSON and log the time and memory used by each stage.
+
+    :param filename: output file name
+    :type filename: str
+    :param summary: summary returned by stop_profiling
+    :type summary: dict
+    """
+    with open(filename, "w") as f:
+        json.dump(summary, f, indent=2)
+    for record in summary["stages"]:
+        logger.info("Stage %s: %d calls, %0.3f seconds (%0.3f excluding nested stages), peak RSS %s MB"
+                    % (record["stage"], record["calls"], record["seconds"], record["self_seconds"],
+                       megabytes(record["peak_rss_bytes"])) +
+                    (", peak traced %s MB" % megabytes(record["peak_traced_bytes"])
+                     if record["peak_traced_bytes"] is not None else ""))
+    logger.info("Wrote profile summary to %s" % filename)
+
+
+def megabytes(n):
+    return "unknown" if n is None else "%0.1f" % (n / 2.0 ** 20)
@@ -3,7 +3,7 @@ import re
 import pandas
 
 from themis import QUESTION, CONFIDENCE, ANSWER, FREQUENCY
-from themis import logger, CsvFileType
+from themis import logger, CsvFileType, sort_for_output
 
 # Column headers in usage log
 QUESTION_TEXT = "QuestionText"
@@ -57,12 +57,12 @@ class QuestionFrequencyFileType(CsvFileType):
     columns = [QUESTION, FREQUENCY]
 
     def __init__(self):
-        super(self.__class__, self).__init__(QuestionFrequencyFileType.columns)
+        super(self.__class__, self).__init__(QuestionFrequencyFileType.columns, dtype={QUESTION: str})
 
     @staticmethod
     def output_format(question_frequency):
         question_frequency = question_frequency[QuestionFrequencyFileType.columns]
-        question_frequency = question_frequency.sort_values(FREQUENCY, ascending=False)
+        question_frequency = sort_for_output(question_frequency, FREQUENCY, ascending=False)
         return question_frequency.set_index(QUESTION)
 
 
@@ -79,8 +79,8 @@ class UsageLogFileType(CsvFileType):
             [DATE_TIME, QUESTION_TEXT, TOP_ANSWER_TEXT, TOP_ANSWER_CONFIDENCE, USER_EXPERIENCE],
             {QUESTION_TEXT: QUESTION, TOP_ANSWER_TEXT: ANSWER, TOP_ANSWER_CONFIDENCE: CONFIDENCE})
 
-    def __call__(self, filename):
-        usage_log = super(self.__class__, self).__call__(filename)
+    def read(self, filename, csv=None):
+        usage_log = super(self.__class__, self).read(filename, csv)
         usage_log[DATE_TIME] = pandas.to_datetime(usage_log[DATE_TIME].apply(self.standard_date_format))
         return usage_log
 
@@ -101,11 +101,16 @@ class UsageLogFileType(CsvFileType):
 class QAPairFileType(CsvFileType):
     columns = [QUESTION, ANSWER, CONFIDENCE, USER_EXPERIENCE, FREQUENCY, DATE_TIME]
 
-    def __init__(self):
-        super(self.__class__, self).__init__(QAPairFileType.columns)
+    def __init__(self, columns=None):
+        """
+        :param columns: the columns a command uses, if None read them all
+        :type columns: list of str
+        """
+        super(self.__class__, self).__init__(columns or QAPairFileType.columns,
+                                             dtype={QUESTION: str, ANSWER: str, CONFIDENCE: float})
 
     @staticmethod
     def output_format(qa_pairs):
         qa_pairs = qa_pairs[QAPairFileType.columns]
-        qa_pairs = qa_pairs.sort_values([FREQUENCY, CONFIDENCE, QUESTION], ascending=(False, False, True))
+        qa_pairs = sort_for_output(qa_pairs, [FREQUENCY, CONFIDENCE, QUESTION], ascending=(False, False, True))
         return qa_pairs.set_index([QUESTION, ANSWER])
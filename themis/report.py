@@ -0,0 +1,111 @@
+"""
+Generate all the analysis tables and curves for a set of systems from a single load of the collated data.
+"""
+import json
+import os
+
+import numpy as np
+import pandas
+
+from themis import QUESTION, logger, to_csv, ensure_directory_exists
+from themis.analyze import SystemMatrix, CollatedFileType, answer_summary, truth_summary, drop_missing, \
+    fat_head_long_tail_summaries, purview_disagreement_questions
+from themis.plot import system_curves
+
+CURVE_TYPES = ["precision", "roc"]
+
+
+def analysis_report(systems_data, frequency_cutoff, corpus=None, truth=None):
+    """
+    Generate the tables produced by the 'analyze answers', 'long-tail', 'similarity', 'purview', and 'truth-coverage'
+    commands and the curves produced by the 'plot' command.
+
+    The collated data is concatenated and cleaned once. The cross-system tables share a single question by system
+    matrix, and both kinds of curve are generated in a single pass over the systems.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: list of pandas.DataFrame
+    :param frequency_cutoff: question frequency dividing fat head from long tail
+    :type frequency_cutoff: int
+    :param corpus: corpus generated by 'xmgr corpus' command, if None do not generate truth coverage
+    :type corpus: pandas.DataFrame
+    :param truth: question to answer mapping used in training, if None do not generate truth coverage
+    :type truth: pandas.DataFrame
+    :return: mapping of table names to tables and mapping of curve types to mappings of system labels to curve data
+    :rtype: ({str : pandas.DataFrame}, {str : {str : pandas.DataFrame}})
+    """
+    systems_data = drop_missing(pandas.concat(systems_data))
+    tables = {"answers": answer_summary(systems_data)}
+    tables["fat-head"], tables["long-tail"] = fat_head_long_tail_summaries(systems_data, frequency_cutoff)
+    matrix = SystemMatrix(systems_data)
+    tables["similarity"] = matrix.similarity()
+    disagreement = purview_disagreement_questions(systems_data)
+    m = len(disagreement)
+    if m:
+        n = len(matrix.questions)
+        logger.warning("%d out of %d questions have non-unanimous in-purview judgments (%0.3f%%)"
+                       % (m, n, 100.0 * m / n))
+    tables["purview"] = CollatedFileType.output_format(
+        systems_data[systems_data[QUESTION].isin(disagreement)])
+    if corpus is not None and truth is not None:
+        tables["truth-coverage"] = truth_summary(corpus, truth, systems_data)
+    curves = system_curves(CURVE_TYPES, systems_data)
+    return tables, curves
+
+
+def write_report_directory(directory, tables, curves):
+    """
+    Write a report as CSV files in a directory.
+
+    Each table is written to a file named TABLE.csv. Curves are written to files named 'precision|roc.SYSTEM-NAME.csv'
+    as by the 'plot' command.
+
+    :param directory: output directory
+    :type directory: str
+    :param tables: mapping of table names to tables
+    :type tables: {str : pandas.DataFrame}
+    :param curves: mapping of curve types to mappings of system labels to curve data
+    :type curves: {str : {str : pandas.DataFrame}}
+    """
+    ensure_directory_exists(directory)
+    for name, table in tables.items():
+        to_csv(os.path.join(directory, "%s.csv" % name), table)
+    for curve_type, system_curve in curves.items():
+        for label, curve in system_curve.items():
+            to_csv(os.path.join(directory, "%s.%s.csv" % (curve_type, label)), curve)
+
+
+def write_report_json(filename, tables, curves):
+    """
+    Write a report as a single JSON document.
+
+    The document has a "tables" object mapping table names to lists of rows and a "curves" object mapping curve types
+    to objects mapping system labels to lists of points. Missing values are written as null.
+
+    :param filename: output file name
+    :type filename: str
+    :param tables: mapping of table names to tables
+    :type tables: {str : pandas.DataFrame}
+    :param curves: mapping of curve types to mappings of system labels to curve data
+    :type curves: {str : {str : pandas.DataFrame}}
+    """
+    report = {"tables": dict((name, records(table)) for name, table in tables.items()),
+              "curves": dict((curve_type, dict((label, records(curve)) for label, curve in system_curve.items()))
+                             for curve_type, system_curve in curves.items())}
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def records(frame):
+    frame = frame.reset_index()
+    frame = frame.astype("object").where(frame.notnull(), None)
+    return [dict((column, json_value(value)) for column, value in row.items())
+            for row in frame.to_dict(orient="records")]
+
+
+def json_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isinf(value):
+        return None
+    return value
@@ -0,0 +1,455 @@
+"""
+A resident server that runs Themis commands while keeping the CSV files they read in memory.
+
+Large corpus, truth and judgment files can take minutes to parse. The server parses each file once and keeps the
+result, so commands it runs get their files from memory. A file is parsed again only when it changes. Files can be
+loaded when the server starts, and a background thread watches those files and reloads them when they change.
+
+Files are kept in memory up to a size limit, beyond which the least recently used are dropped. Preloaded files are
+always kept.
+
+The server speaks HTTP, either on a local TCP port or on a Unix socket, and runs one command at a time.
+
+    GET /status     version, process ID, and the files in memory
+    POST /run       run a command given as {"argv": [arguments], "cwd": directory}, returning
+                    {"status": exit status, "stdout": standard output, "stderr": standard error}
+
+The command line sends commands to a server named by the --server option or the THEMIS_SERVER environment variable.
+Commands run in the client's working directory, and the files they write are written by the server process, so the
+client and server must share a file system. Anyone who can connect to the server can run commands as the user running
+it, so a server only listens on a loopback address unless it is explicitly allowed to accept remote connections, and
+its Unix socket may only be used by that user.
+"""
+import contextlib
+import http.client
+import http.server
+import io
+import ipaddress
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import timeit
+import traceback
+
+import themis
+from themis import logger, __version__, parse_csv
+
+# Top level commands that a server can run.
+SERVED_COMMANDS = ["analyze", "answer", "judge", "question"]
+# Default memory limit of the files kept by a server, in megabytes.
+DEFAULT_CACHE_SIZE = 4096
+
+
+def serve(address, run, preload=(), interval=5.0, cache_size=DEFAULT_CACHE_SIZE, allow_remote=False):
+    """
+    Run a server until it is interrupted.
+
+    :param address: 'http://host:port' or the name of a Unix socket
+    :type address: str
+    :param run: function that runs a command given its arguments
+    :type run: func
+    :param preload: file types and the names of files to load when the server starts and reload when they change
+    :type preload: list of (CsvFileType, str)
+    :param interval: how often to check whether files have changed, in seconds
+    :type interval: float
+    :param cache_size: memory limit of the files kept that were not preloaded, in megabytes
+    :type cache_size: float
+    :param allow_remote: listen on a host that is not a loopback address
+    :type allow_remote: bool
+    """
+    check_address(address, allow_remote)
+    cache = CsvCache(cache_size * 1024 * 1024)
+    for file_type, filename in preload:
+        cache.preload(filename, file_type.columns, file_type.dtype)
+    themis.csv_cache = cache
+    command_runner = CommandRunner(run, cache)
+    stopped = threading.Event()
+    watcher = threading.Thread(target=command_runner.watch, args=(stopped, interval), name="watcher")
+    watcher.daemon = True
+    watcher.start()
+    server = create_server(address, allow_remote)
+    server.command_runner = command_runner
+    # Shut down cleanly when stopped by a service manager.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info("Themis server %s listening on %s" % (__version__, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Stop server")
+        stopped.set()
+        server.server_close()
+        if not address.startswith("http://"):
+            os.remove(address)
+        themis.csv_cache = None
+
+
+class CsvCache(object):
+    """
+    Data frames parsed from CSV files, each with the columns and column types it was parsed with and the size and
+    modification time of the file when it was parsed.
+
+    A request for some columns of a file is answered with a copy of a data frame that has those columns with the same
+    types, as long as the file has not changed since the data frame was parsed. A data frame that has all the columns
+    of another one of the same file with the same types replaces it.
+
+    Data frames of preloaded files are always kept. Others are dropped, least recently used first, when their total
+    memory use exceeds a limit.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.preloaded = {}
+        self.lock = threading.Lock()
+        self.uses = 0
+
+    def __repr__(self):
+        return "%s: %d files" % (self.__class__.__name__, len(self.entries))
+
+    @staticmethod
+    def cacheable(file, usecols=None, dtype=None, **kwargs):
+        """
+        Only files named by their paths and read by column names are cached.
+        """
+        return isinstance(file, str) and not kwargs and \
+               (usecols is None or all(isinstance(column, str) for column in usecols))
+
+    def read(self, filename, usecols=None, dtype=None, pin=False):
+        """
+        :param filename: CSV file
+        :type filename: str
+        :param usecols: columns to read, if None read them all
+        :type usecols: list of str
+        :param dtype: types of columns
+        :type dtype: dict
+        :param pin: always keep the data frame
+        :type pin: bool
+        :return: the data frame that pandas.read_csv would return
+        :rtype: pandas.DataFrame
+        """
+        path = os.path.abspath(filename)
+        signature = file_signature(path)
+        columns = None if usecols is None else set(usecols)
+        dtype = dict(dtype or {})
+        with self.lock:
+            entries = [entry for entry in self.entries.get(path, []) if entry.signature == signature]
+            self.entries[path] = entries
+            for entry in entries:
+                if entry.covers(columns, dtype):
+                    entry.hits += 1
+                    entry.pinned = entry.pinned or pin
+                    self.use(entry)
+                    return entry.select(columns)
+        entry = CachedCsv(path, columns, dtype)
+        with self.lock:
+            replaced = [other for other in self.entries.get(path, []) if entry.covers(other.columns, other.dtype)]
+            entry.pinned = pin or any(other.pinned for other in replaced)
+            self.entries[path] = [other for other in self.entries.get(path, []) if other not in replaced] + [entry]
+            self.use(entry)
+            self.evict()
+        return entry.select(columns)
+
+    def use(self, entry):
+        self.uses += 1
+        entry.used = self.uses
+
+    def evict(self):
+        """
+        Drop the least recently used data frames that are not pinned until the rest fit in the memory limit.
+        """
+        entries = [entry for entries in self.entries.values() for entry in entries if not entry.pinned]
+        size = sum(entry.size for entry in entries)
+        for entry in sorted(entries, key=lambda entry: entry.used):
+            if size <= self.max_bytes:
+                break
+            logger.info("Drop %s from memory" % entry)
+            self.entries[entry.path].remove(entry)
+            size -= entry.size
+
+    def preload(self, filename, columns, dtype):
+        path = os.path.abspath(filename)
+        self.preloaded.setdefault(path, []).append((columns, dtype))
+        self.read(path, columns, dtype, pin=True)
+
+    def refresh(self):
+        """
+        Drop data frames parsed from files that have changed since, and parse preloaded files again.
+        """
+        for path, entries in list(self.entries.items()):
+            try:
+                signature = file_signature(path)
+            except OSError:
+                signature = None
+            current = [entry for entry in entries if entry.signature == signature]
+            if len(current) < len(entries):
+                logger.info("%s changed" % path)
+                with self.lock:
+                    self.entries[path] = current
+                if signature is not None:
+                    for columns, dtype in self.preloaded.get(path, []):
+                        self.read(path, columns, dtype, pin=True)
+
+    def status(self):
+        with self.lock:
+            return [{"filename": entry.path, "columns": list(entry.frame.columns), "rows": len(entry.frame),
+                     "bytes": entry.size, "pinned": entry.pinned, "hits": entry.hits, "load_seconds": entry.seconds}
+                    for entries in self.entries.values() for entry in entries]
+
+
+class CachedCsv(object):
+    def __init__(self, path, columns, dtype):
+        self.path = path
+        self.columns = columns
+        self.dtype = dtype
+        self.signature = file_signature(path)
+        start = timeit.default_timer()
+        self.frame = parse_csv(path, usecols=None if columns is None else list(columns), dtype=dtype or None)
+        self.seconds = timeit.default_timer() - start
+        self.size = int(self.frame.memory_usage(index=True, deep=True).sum())
+        self.hits = 0
+        self.used = 0
+        self.pinned = False
+        logger.info("Loaded %d rows from %s in %0.3f seconds" % (len(self.frame), path, self.seconds))
+
+    def __repr__(self):
+        return "%s: %s, %d rows" % (self.__class__.__name__, self.path, len(self.frame))
+
+    def covers(self, columns, dtype):
+        """
+        :param columns: requested columns, if None all of them
+        :type columns: set of str
+        :param dtype: requested column types
+        :type dtype: dict
+        :return: whether this data frame has all the requested columns with the requested types
+        :rtype: bool
+        """
+        if columns is None:
+            return self.columns is None and self.dtype == dtype
+        return (self.columns is None or columns <= self.columns) and \
+               all(self.dtype.get(column) == dtype.get(column) for column in columns)
+
+    def select(self, columns):
+        # Readers may modify the data frames they are given, so hand out copies.
+        if columns is None:
+            return self.frame.copy()
+        return self.frame[[column for column in self.frame.columns if column in columns]].copy()
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class CommandRunner(object):
+    """
+    Runs commands one at a time, capturing their output.
+    """
+
+    def __init__(self, run, cache):
+        self.run = run
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.start = timeit.default_timer()
+        self.commands = 0
+
+    def __repr__(self):
+        return "%s: %d commands" % (self.__class__.__name__, self.commands)
+
+    def run_command(self, argv, cwd):
+        """
+        :param argv: command line arguments without the program name
+        :type argv: list of str
+        :param cwd: directory in which to run the command
+        :type cwd: str
+        :return: exit status, standard output, and standard error of the command
+        :rtype: dict
+        """
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with self.lock:
+            logger.info("Run %s in %s" % (" ".join(argv), cwd))
+            self.commands += 1
+            start = timeit.default_timer()
+            directory = os.getcwd()
+            handlers, level = list(logger.handlers), logger.level
+            reset_command_state()
+            try:
+                os.chdir(cwd)
+                with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                    try:
+                        self.run(argv)
+                        status = 0
+                    except SystemExit as e:
+                        status = exit_status(e.code)
+                    except Exception:
+                        traceback.print_exc()
+                        status = 1
+            finally:
+                os.chdir(directory)
+                logger.handlers = handlers
+                logger.setLevel(level)
+                reset_command_state()
+            logger.info("Exit status %d in %0.3f seconds" % (status, timeit.default_timer() - start))
+        return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+    def watch(self, stopped, interval):
+        while not stopped.wait(interval):
+            with self.lock:
+                self.cache.refresh()
+
+    def status(self):
+        return {"version": __version__, "pid": os.getpid(), "uptime_seconds": timeit.default_timer() - self.start,
+                "commands": self.commands, "files": self.cache.status()}
+
+
+def reset_command_state():
+    """
+    Clear the module state that a command sets up from its command line arguments.
+    """
+    themis.csv_files.clear()
+    themis.interners = None
+    themis.sort_output = True
+    themis.output_artifact = None
+
+
+def exit_status(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/status":
+            self.respond(200, self.server.command_runner.status())
+        else:
+            self.respond(404, {"error": "unknown path %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/run":
+            self.respond(404, {"error": "unknown path %s" % self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            argv, cwd = request["argv"], request["cwd"]
+            if not isinstance(argv, list) or not all(isinstance(a, str) for a in argv) or not os.path.isdir(cwd):
+                raise ValueError("invalid arguments or directory")
+        except (ValueError, KeyError, TypeError) as e:
+            self.respond(400, {"error": "invalid request: %s" % e})
+            return
+        self.respond(200, self.server.command_runner.run_command(argv, cwd))
+
+    def respond(self, code, body):
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients do not have addresses.
+        return str(self.client_address[0]) if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s" % (self.address_string(), format % args))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        os.chmod(self.server_address, 0o600)
+
+
+def create_server(address, allow_remote=False):
+    check_address(address, allow_remote)
+    if address.startswith("http://"):
+        return http.server.ThreadingHTTPServer(parse_http_address(address), RequestHandler)
+    return UnixHTTPServer(address, RequestHandler)
+
+
+def check_address(address, allow_remote):
+    """
+    Refuse to listen on a host that is not a loopback address unless remote connections are allowed, because anyone
+    who can connect to the server can run commands.
+    """
+    if address.startswith("http://") and not allow_remote:
+        host = parse_http_address(address)[0]
+        if not loopback_host(host):
+            raise ValueError("%s is not a loopback address, allow remote connections to listen on it" % (host or "''"))
+
+
+def loopback_host(host):
+    """
+    :param host: host name or IP address
+    :type host: str
+    :return: whether every address the host resolves to is a loopback address
+    :rtype: bool
+    """
+    try:
+        addresses = set(info[4][0] for info in socket.getaddrinfo(host, None))
+    except socket.gaierror:
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address.split("%")[0]).is_loopback for address in addresses)
+
+
+def parse_http_address(address):
+    host, _, port = address[len("http://"):].rstrip("/").rpartition(":")
+    return host, int(port)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        http.client.HTTPConnection.__init__(self, "localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def delegate(address, argv, cwd):
+    """
+    Send a command to a server and write its output.
+
+    :param address: 'http://host:port' or the name of a Unix socket
+    :type address: str
+    :param argv: command line arguments without the program name
+    :type argv: list of str
+    :param cwd: directory in which to run the command
+    :type cwd: str
+    :return: exit status of the command, or None if the server could not be reached
+    :rtype: int
+    """
+    if address.startswith("http://"):
+        connection = http.client.HTTPConnection(*parse_http_address(address))
+    else:
+        connection = UnixHTTPConnection(address)
+    try:
+        connection.request("POST", "/run", json.dumps({"argv": argv, "cwd": cwd}),
+                           {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        body = json.loads(response.read().decode("utf-8"))
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        logger.warning("Cannot run command on server %s, running it here: %s" % (address, e))
+        return None
+    finally:
+        connection.close()
+    if response.status != 200:
+        logger.warning("Server %s cannot run command, running it here: %s" % (address, body.get("error")))
+        return None
+    sys.stdout.write(body["stdout"])
+    sys.stderr.write(body["stderr"])
+    return body["status"]
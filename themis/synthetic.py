@@ -0,0 +1,148 @@
+"""
+Generate synthetic experiment data at a configurable scale.
+
+The generated data has the shape of a real experiment. A usage log records questions asked with a Zipf-like frequency
+distribution, so that a few questions are asked many times and most are asked once or twice. Every question has a
+correct answer in a corpus and most are in purview. Each synthetic system answers every question, correctly with a
+system-specific probability, and judgments exist for every answer. Correct answers tend to have higher confidences than
+incorrect ones so that precision and ROC curves have realistic shapes.
+
+All the files are derived from a random number generator seed, so the same seed and scale always produce the same data.
+"""
+import os
+
+import numpy
+import pandas
+
+from themis import logger, to_csv, ensure_directory_exists, QUESTION, QUESTION_ID, ANSWER, ANSWER_ID, TITLE, \
+    FILENAME, DOCUMENT_ID, CONFIDENCE, IN_PURVIEW, CORRECT
+from themis.judge import JudgmentFileType
+from themis.question import DATE_TIME, QUESTION_TEXT, TOP_ANSWER_TEXT, TOP_ANSWER_CONFIDENCE, USER_EXPERIENCE
+from themis.xmgr import CorpusFileType, TruthFileType
+
+USAGE_LOG_FILENAME = "QuestionsData.csv"
+CORPUS_FILENAME = "corpus.csv"
+TRUTH_FILENAME = "truth.csv"
+JUDGMENTS_FILENAME = "judgments.csv"
+ANSWERS_FILENAME = "answers.%s.csv"
+
+WORDS = ["account", "address", "balance", "benefit", "card", "change", "claim", "close", "contact", "cover", "date",
+         "deposit", "document", "email", "fee", "form", "fund", "insurance", "interest", "limit", "loan", "login",
+         "mortgage", "number", "online", "open", "password", "payment", "plan", "policy", "rate", "renew", "report",
+         "reset", "saving", "statement", "tax", "transfer", "update", "withdraw"]
+QUESTION_STARTS = ["How do I", "Can I", "What is the", "Where can I find my", "Why was my", "When should I"]
+USER_EXPERIENCES = ["Answered", "Low Confidence", "DIALOG"]
+USER_EXPERIENCE_PROBABILITIES = [0.9, 0.08, 0.02]
+IN_PURVIEW_PROBABILITY = 0.8
+WEA_ACCURACY = 0.6
+# Exponent of the Zipf-like question frequency distribution.
+FREQUENCY_EXPONENT = 1.1
+
+
+def generate_experiment(directory, rows, systems=3, seed=0):
+    """
+    Write a synthetic usage log, corpus, truth, system answers, and judgments to a directory.
+
+    The number of distinct questions is a tenth of the number of usage log rows, the corpus has a tenth as many answers
+    as there are distinct questions, and each document in the corpus has ten answers.
+
+    :param directory: output directory
+    :type directory: str
+    :param rows: number of rows in the usage log
+    :type rows: int
+    :param systems: number of systems that answer the questions
+    :type systems: int
+    :param seed: random number generator seed
+    :type seed: int
+    :return: names of the files written
+    :rtype: list of str
+    """
+    rng = numpy.random.RandomState(seed)
+    n_questions = max(10, rows // 10)
+    n_answers = max(10, n_questions // 10)
+    logger.info("Generate %d usage log rows, %d questions, %d answers, %d systems" %
+                (rows, n_questions, n_answers, systems))
+    ensure_directory_exists(directory)
+    questions = numpy.array(["%s %s %s %d?" % (start, first, second, i) for i, (start, first, second) in
+                             enumerate(zip(rng.choice(QUESTION_STARTS, n_questions),
+                                           rng.choice(WORDS, n_questions), rng.choice(WORDS, n_questions)))],
+                            dtype=object)
+    answers = numpy.array([("Answer %d: " % i) + " ".join(rng.choice(WORDS, length))
+                           for i, length in enumerate(rng.randint(10, 50, n_answers))], dtype=object)
+    in_purview = rng.random_sample(n_questions) < IN_PURVIEW_PROBABILITY
+    truth_answer = rng.randint(n_answers, size=n_questions)
+    filenames = []
+
+    def write(filename, frame, **kwargs):
+        filename = os.path.join(directory, filename)
+        to_csv(filename, frame, **kwargs)
+        filenames.append(filename)
+
+    corpus = pandas.DataFrame({ANSWER_ID: ["%d" % i for i in range(n_answers)],
+                               ANSWER: answers,
+                               TITLE: ["Title %d" % i for i in range(n_answers)],
+                               FILENAME: ["document-%d.html" % (i // 10) for i in range(n_answers)],
+                               DOCUMENT_ID: numpy.arange(n_answers) // 10})
+    write(CORPUS_FILENAME, CorpusFileType.output_format(corpus))
+    # Half the in-purview questions are in the truth used to train the systems.
+    trained = numpy.flatnonzero(in_purview & (rng.random_sample(n_questions) < 0.5))
+    truth = pandas.DataFrame({QUESTION_ID: ["%d" % i for i in trained], QUESTION: questions[trained],
+                              ANSWER_ID: ["%d" % i for i in truth_answer[trained]]})
+    write(TRUTH_FILENAME, TruthFileType.output_format(truth))
+    answer, confidence = system_answers(rng, in_purview, truth_answer, n_answers, WEA_ACCURACY)
+    write(USAGE_LOG_FILENAME, usage_log(rng, rows, questions, answers[answer], confidence), index=False)
+    judged = []
+    for i in range(systems):
+        accuracy = 0.3 + 0.5 * (i + 1) / (systems + 1)
+        answer, confidence = system_answers(rng, in_purview, truth_answer, n_answers, accuracy)
+        write(ANSWERS_FILENAME % system_name(i),
+              pandas.DataFrame({QUESTION: questions, ANSWER: answers[answer], CONFIDENCE: confidence}), index=False)
+        judged.append(pandas.DataFrame({"question": numpy.arange(n_questions), "answer": answer}))
+    judged = pandas.concat(judged).drop_duplicates()
+    judgments = pandas.DataFrame({QUESTION: questions[judged["question"]],
+                                  ANSWER: answers[judged["answer"]],
+                                  IN_PURVIEW: in_purview[judged["question"]],
+                                  CORRECT: in_purview[judged["question"]] &
+                                           (truth_answer[judged["question"]] == judged["answer"].values)})
+    write(JUDGMENTS_FILENAME, JudgmentFileType.output_format(judgments))
+    return filenames
+
+
+def system_name(i):
+    return "System%d" % (i + 1)
+
+
+def system_answers(rng, in_purview, truth_answer, n_answers, accuracy):
+    """
+    Answer every question, giving the correct answer to an in-purview question with the specified probability.
+
+    :return: index of the answer to each question in the corpus, and the confidence in each answer
+    :rtype: (numpy.array, numpy.array)
+    """
+    n = len(in_purview)
+    correct = in_purview & (rng.random_sample(n) < accuracy)
+    answer = numpy.where(correct, truth_answer, rng.randint(n_answers, size=n))
+    confidence = numpy.where(correct, rng.beta(5, 2, n), rng.beta(2, 5, n))
+    return answer, confidence
+
+
+def usage_log(rng, rows, questions, answers, confidences):
+    """
+    Ask questions with a Zipf-like frequency distribution over the course of a year. A question always gets the same
+    answer.
+
+    :return: usage log in the QuestionsData.csv format
+    :rtype: pandas.DataFrame
+    """
+    weights = 1.0 / numpy.arange(1, len(questions) + 1) ** FREQUENCY_EXPONENT
+    asked = rng.choice(len(questions), rows, p=weights / weights.sum())
+    # Log times have minute resolution, so there are few enough distinct times to format each one individually.
+    minutes, index = numpy.unique(rng.randint(365 * 24 * 60, size=rows), return_inverse=True)
+    times = (pandas.Timestamp("2016-01-01") + pandas.to_timedelta(minutes, unit="m")).strftime("%m%d%Y:%H%M00:UTC")
+    return pandas.DataFrame({DATE_TIME: numpy.asarray(times, dtype=object)[index],
+                             QUESTION_TEXT: questions[asked],
+                             TOP_ANSWER_TEXT: answers[asked],
+                             TOP_ANSWER_CONFIDENCE: confidences[asked],
+                             USER_EXPERIENCE: rng.choice(USER_EXPERIENCES, rows, p=USER_EXPERIENCE_PROBABILITIES)},
+                            columns=[DATE_TIME, QUESTION_TEXT, TOP_ANSWER_TEXT, TOP_ANSWER_CONFIDENCE,
+                                     USER_EXPERIENCE])
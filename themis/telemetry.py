@@ -0,0 +1,307 @@
+"""
+Progress and latency telemetry for long-running jobs.
+
+Jobs such as asking a Q&A system a set of questions or downloading a corpus record the items they complete, the items
+in flight, and the errors they encounter. Calls to remote services record their latencies in histograms. The recorded
+values can be periodically written to a file, either as JSON lines or as a Prometheus textfile for the node exporter's
+textfile collector.
+"""
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+import timeit
+
+# Upper bounds in seconds of the latency histogram buckets. The last bucket is unbounded.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+JSON = "json"
+PROMETHEUS = "prometheus"
+
+
+class Job(object):
+    """
+    The progress of a job that completes a known number of items.
+    """
+
+    def __init__(self, name, total, completed=0):
+        self.name = name
+        self.total = total
+        # Items completed before the job started, for instance recovered from a checkpoint, do not count toward the
+        # rate.
+        self.initial = completed
+        self.completed = completed
+        self.in_flight = 0
+        self.errors = 0
+        self.start = timeit.default_timer()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "%s: %d of %d" % (self.name, self.completed, self.total)
+
+    def item(self):
+        """
+        :return: context manager that counts an item as in flight while it runs, then as completed or as an error
+        :rtype: JobItem
+        """
+        return JobItem(self)
+
+    def complete(self, n=1):
+        with self.lock:
+            self.completed += n
+
+    def rate(self):
+        """
+        :return: items completed per second since the job started
+        :rtype: float
+        """
+        seconds = timeit.default_timer() - self.start
+        return (self.completed - self.initial) / seconds if seconds > 0 else 0.0
+
+    def eta(self):
+        """
+        :return: estimated seconds until the job completes, or None if no items have been completed yet
+        :rtype: float
+        """
+        rate = self.rate()
+        return (self.total - self.completed) / rate if rate > 0 else None
+
+    def message(self):
+        """
+        :return: a log message describing the job's progress
+        :rtype: str
+        """
+        eta = self.eta()
+        return "%s %d of %d (%0.3f%%), %0.2f per second, ETA %s" % \
+               (self.name, self.completed, self.total, 100.0 * self.completed / max(1, self.total), self.rate(),
+                "unknown" if eta is None else format_seconds(eta))
+
+    def snapshot(self):
+        return {"total": self.total, "completed": self.completed, "in_flight": self.in_flight, "errors": self.errors,
+                "items_per_second": self.rate(), "eta_seconds": self.eta()}
+
+
+class JobItem(object):
+    def __init__(self, job):
+        self.job = job
+
+    def __enter__(self):
+        with self.job.lock:
+            self.job.in_flight += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.job.lock:
+            self.job.in_flight -= 1
+            if exc_type is None:
+                self.job.completed += 1
+            else:
+                self.job.errors += 1
+
+
+class Latency(object):
+    """
+    A histogram of the latencies of calls to a remote service, with counts of the errors they raised by type.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, seconds, error=None):
+        with self.lock:
+            self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.count += 1
+            self.sum += seconds
+            if error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"count": self.count, "sum_seconds": self.sum, "errors": dict(self.errors),
+                    "buckets": [["+Inf" if bound == float("inf") else bound, n]
+                                for bound, n in zip(LATENCY_BUCKETS, self.buckets)]}
+
+
+class Telemetry(object):
+    """
+    The jobs and remote call latencies recorded by this process.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "%s: %d jobs, %d calls" % (self.__class__.__name__, len(self.jobs), len(self.calls))
+
+    def job(self, name, total, completed=0):
+        """
+        Start tracking a job, replacing any previous job with the same name.
+
+        :param name: job name, used in log messages and as a metric label
+        :type name: str
+        :param total: number of items in the job
+        :type total: int
+        :param completed: number of items already completed
+        :type completed: int
+        :return: the job
+        :rtype: Job
+        """
+        job = Job(name, total, completed)
+        with self.lock:
+            self.jobs[name] = job
+        return job
+
+    def latency(self, call):
+        with self.lock:
+            return self.calls.setdefault(call, Latency())
+
+    def snapshot(self):
+        with self.lock:
+            jobs = list(self.jobs.items())
+            calls = list(self.calls.items())
+        return {"time": time.time(), "pid": os.getpid(),
+                "jobs": dict((name, job.snapshot()) for name, job in jobs),
+                "calls": dict((name, latency.snapshot()) for name, latency in calls)}
+
+
+telemetry = Telemetry()
+
+
+def timed(call):
+    """
+    Decorate a function that calls a remote service so that the latency of each call is recorded.
+
+    :param call: name of the call, used as a metric label
+    :type call: str
+    :return: decorator
+    :rtype: func
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                telemetry.latency(call).record(timeit.default_timer() - start, type(e).__name__)
+                raise
+            telemetry.latency(call).record(timeit.default_timer() - start)
+            return result
+
+        return timed_function
+
+    return decorator
+
+
+class TelemetryWriter(object):
+    """
+    A background thread that periodically writes telemetry to a file.
+
+    In JSON format a snapshot is appended to the file as a single line each time. In Prometheus format the file is
+    replaced with the current values each time.
+    """
+
+    def __init__(self, filename, format=JSON, interval=10.0):
+        self.filename = filename
+        self.format = format
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="telemetry")
+        self.thread.daemon = True
+
+    def __repr__(self):
+        return "%s: %s every %g seconds to %s" % (self.__class__.__name__, self.format, self.interval, self.filename)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the thread and write a final snapshot.
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        snapshot = telemetry.snapshot()
+        if self.format == PROMETHEUS:
+            # Write to a temporary file and rename it so that the collector never reads a partial file.
+            temporary = self.filename + ".tmp"
+            with open(temporary, "w") as f:
+                f.write(prometheus_text(snapshot))
+            os.replace(temporary, self.filename)
+        else:
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(snapshot) + "\n")
+
+
+def prometheus_text(snapshot):
+    """
+    :param snapshot: telemetry snapshot
+    :type snapshot: dict
+    :return: the snapshot in the Prometheus text exposition format
+    :rtype: str
+    """
+    lines = []
+
+    def metric(name, metric_type, help, samples):
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        for labels, value in samples:
+            label_text = ",".join('%s="%s"' % (k, escape_label(v)) for k, v in labels)
+            lines.append("%s{%s} %s" % (name, label_text, prometheus_value(value)))
+
+    jobs = sorted(snapshot["jobs"].items())
+    calls = sorted(snapshot["calls"].items())
+    for field, name, metric_type, help in [
+        ("total", "items", "gauge", "Number of items in the job"),
+        ("completed", "completed_total", "counter", "Number of items completed"),
+        ("in_flight", "in_flight", "gauge", "Number of items in progress"),
+        ("errors", "errors_total", "counter", "Number of items that failed"),
+        ("items_per_second", "items_per_second", "gauge", "Items completed per second since the job started"),
+        ("eta_seconds", "eta_seconds", "gauge", "Estimated seconds until the job completes")]:
+        metric("themis_job_" + name, metric_type, help, [([("job", job_name)], job[field]) for job_name, job in jobs])
+    lines.append("# HELP themis_call_seconds Latency of calls to remote services")
+    lines.append("# TYPE themis_call_seconds histogram")
+    for name, call in calls:
+        cumulative = 0
+        for bound, n in call["buckets"]:
+            cumulative += n
+            lines.append('themis_call_seconds_bucket{call="%s",le="%s"} %d' %
+                         (escape_label(name), bound if bound == "+Inf" else repr(bound), cumulative))
+        lines.append('themis_call_seconds_sum{call="%s"} %s' % (escape_label(name), repr(call["sum_seconds"])))
+        lines.append('themis_call_seconds_count{call="%s"} %d' % (escape_label(name), call["count"]))
+    metric("themis_call_errors_total", "counter", "Number of calls to remote services that raised errors",
+           [([("call", name), ("error", error)], n)
+            for name, call in calls for error, n in sorted(call["errors"].items())])
+    metric("themis_telemetry_timestamp_seconds", "gauge", "Time at which the telemetry was written",
+           [([("pid", str(snapshot["pid"]))], snapshot["time"])])
+    return "\n".join(lines) + "\n"
+
+
+def prometheus_value(value):
+    return "NaN" if value is None else repr(float(value))
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
@@ -1,82 +1,344 @@
 """
 Extract the corpus from the TREC XML files in which XMGR stores PAU information.
 
-This is for when we have file system access to the corpus instead of needing to download it.
+This is for when we have file system access to the corpus instead of needing to download it. The TREC files may be in
+a directory or in a tar or zip archive.
 """
 import glob
+import hashlib
 import os
+import re
+import tarfile
+import zipfile
 
 from bs4 import BeautifulSoup
 
-from themis import logger, from_csv, ANSWER_ID, ANSWER, TITLE, FILENAME, DOCUMENT_ID
+from themis import logger, from_csv, to_csv, unescape, ANSWER_ID, ANSWER, TITLE, FILENAME, DOCUMENT_ID
 from themis.checkpoint import DataFrameCheckpoint, get_items
 from themis.xmgr import CorpusFileType
 
+# Key added to parsed TREC fields recording that the file had to be parsed with Beautiful Soup.
+ROBUST_PARSE = "Robust Parse"
 
-def corpus_from_trec(checkpoint_filename, trec_directory, checkpoint_frequency, max_docs):
-    trec_filenames = sorted(glob.glob(os.path.join(trec_directory, "*.xml")))[:max_docs]
+# XML tags from which the corpus fields are extracted.
+TREC_TAGS = [(ANSWER_ID, "meta:key:pautid"),
+             (ANSWER, "text"),
+             (TITLE, "title"),
+             (FILENAME, "meta:key:originalfile"),
+             (DOCUMENT_ID, "meta:documentid")]
+
+TREC_TAG_PATTERNS = [(field, re.compile(r"<%s>(.*?)</%s>" % (tag, tag), re.DOTALL | re.IGNORECASE))
+                     for field, tag in TREC_TAGS]
+
+
+def corpus_from_trec(checkpoint_filename, trec_source, checkpoint_frequency, max_docs, processes=None):
+    """
+    Extract the corpus from TREC XML files.
+
+    The TREC files may either be in a directory or members of a .tar, .tar.gz or .zip archive. Archive members are
+    streamed to the parser without being extracted to disk. TREC files are indexed in the checkpoint by their file name
+    or archive member name.
+
+    The checkpoint records the size, modification time, and content hash of every TREC file. If it is kept after a run
+    a subsequent run is incremental: only new and modified files are parsed and entries for deleted files are dropped.
+
+    :param checkpoint_filename: name of the checkpoint file to which to write intermediary results
+    :type checkpoint_filename: str
+    :param trec_source: directory or archive containing TREC XML files
+    :type trec_source: str
+    :param checkpoint_frequency: how often to write intermediary results to the checkpoint file
+    :type checkpoint_frequency: int
+    :param max_docs: maximum number of TREC files to parse, if None parse them all
+    :type max_docs: int
+    :param processes: number of processes parsing TREC files in parallel, if None use one per CPU
+    :type processes: int
+    :return: corpus
+    :rtype: pandas.DataFrame
+    """
+    if os.path.isdir(trec_source):
+        trec_files = trec_directory_files(trec_source)
+        get_trec, read_trec_files = parse_trec_file, None
+        read_contents = read_trec_directory_files
+    else:
+        archive = TrecArchive(trec_source)
+        trec_files = archive.files()
+        get_trec, read_trec_files = parse_trec, archive.read
+        read_contents = archive.read
+    trec_filenames = sorted(trec_files)[:max_docs]
+    trec_files = dict((trec_filename, trec_files[trec_filename]) for trec_filename in trec_filenames)
     checkpoint = get_items("TREC files",
                            trec_filenames,
-                           TrecFileCheckpoint(checkpoint_filename, checkpoint_frequency),
-                           parse_trec_file,
-                           checkpoint_frequency)
-    if checkpoint.invalid:
-        n = len(trec_filenames)
-        logger.warning("%d of %d TREC files are invalid (%0.3f%%)" %
-                       (checkpoint.invalid, n, 100 * checkpoint.invalid / n))
+                           TrecFileCheckpoint(checkpoint_filename, checkpoint_frequency, trec_files, read_contents),
+                           get_trec,
+                           checkpoint_frequency,
+                           processes,
+                           read_trec_files)
+    n = len(trec_filenames)
+    if checkpoint.robust:
+        logger.info("%d of %d TREC files required the robust parser (%0.3f%%)" %
+                    (checkpoint.robust, n, 100.0 * checkpoint.robust / n))
+    corpus = from_csv(checkpoint_filename)
+    invalid = corpus[ANSWER_ID].isnull()
+    m = sum(invalid)
+    if m:
+        logger.warning("%d of %d TREC files are invalid (%0.3f%%)" % (m, n, 100.0 * m / n))
     # I'm not sure why I'm getting duplicates after a restart.
-    return from_csv(checkpoint_filename).drop_duplicates().drop(TrecFileCheckpoint.TREC_FILENAME, axis="columns")
+    return corpus[~invalid][CorpusFileType.columns].drop_duplicates()
+
+
+def trec_directory_files(trec_directory):
+    """
+    Find the TREC XML files in a directory.
+
+    :param trec_directory: directory containing TREC XML files
+    :type trec_directory: str
+    :return: mapping of TREC file names to their sizes and modification times
+    :rtype: {str: (int, int)}
+    """
+    trec_files = {}
+    for trec_filename in glob.glob(os.path.join(trec_directory, "*.xml")):
+        stat = os.stat(trec_filename)
+        # Use the nanosecond modification time where available so that it survives a round trip through a CSV file.
+        modified = getattr(stat, "st_mtime_ns", int(stat.st_mtime * 1e9))
+        trec_files[trec_filename] = (stat.st_size, modified)
+    return trec_files
+
+
+def read_trec_directory_files(trec_filenames):
+    """
+    Read the contents of TREC files in a directory.
+
+    :param trec_filenames: names of TREC files
+    :type trec_filenames: list of str
+    :return: file names and their contents
+    :rtype: iterator of (str, bytes)
+    """
+    for trec_filename in trec_filenames:
+        with open(trec_filename, "rb") as trec_file:
+            yield trec_filename, trec_file.read()
 
 
 def parse_trec_file(trec_filename):
     """
     Extract corpus fields from a TREC XML file.
 
-    The TREC files may be mal-formed XML. (For instance they contain disallowed '&', '<', and '>' characters inside
-    text, so parse them with the robust Beautiful Soup package, returning None if the file cannot be successfully
-    parsed.
-
     :param trec_filename: name of TREC XML file
     :type trec_filename: str
-    :return: labeled fields extracted from the TREC file
+    :return: content hash and labeled fields extracted from the TREC file
+    :rtype: (str, dict)
+    """
+    with open(trec_filename, "rb") as trec_file:
+        return parse_trec(trec_file.read())
+
+
+def parse_trec(trec):
+    """
+    Extract corpus fields from the contents of a TREC XML file.
+
+    Most TREC files can be read by a fast regular expression extractor. The TREC files may be mal-formed XML, however.
+    (For instance they contain disallowed '&', '<', and '>' characters inside text.) Files the fast extractor cannot
+    handle are parsed with the robust Beautiful Soup package, returning None for the fields if the file cannot be
+    successfully parsed.
+
+    :param trec: contents of a TREC XML file
+    :type trec: bytes
+    :return: content hash and labeled fields extracted from the TREC file
+    :rtype: (str, dict)
+    """
+    fields = extract_trec_fields(trec)
+    if fields is None:
+        fields = parse_trec_robustly(trec)
+    return hashlib.sha1(trec).hexdigest(), fields
+
+
+def extract_trec_fields(trec):
+    """
+    Extract corpus fields from a well-formed TREC file with regular expressions.
+
+    This only handles fields that contain plain text and entity references. If a field is missing, contains markup or
+    stray angle brackets, or the file is not UTF-8, return None so that the caller can fall back to a robust parser.
+
+    :param trec: contents of a TREC XML file
+    :type trec: bytes
+    :return: labeled fields extracted from the TREC file or None
     :rtype: dict
     """
-    with open(trec_filename) as trec_file:
-        parse = BeautifulSoup(trec_file, "lxml")
-        try:
-            return {
-                ANSWER_ID: parse.find("meta:key:pautid").text,
-                ANSWER: parse.find("text").text,
-                TITLE: parse.find("title").text,
-                FILENAME: parse.find("meta:key:originalfile").text,
-                DOCUMENT_ID: parse.find("meta:documentid").text
-            }
-        except AttributeError:
-            # If a XML tag is missing, find will return None, which will not have a 'text' attribute.
+    try:
+        trec = trec.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    fields = {}
+    for field, pattern in TREC_TAG_PATTERNS:
+        match = pattern.search(trec)
+        if match is None:
             return None
+        text = match.group(1)
+        if "<" in text or ">" in text:
+            return None
+        fields[field] = unescape(text)
+    fields[ROBUST_PARSE] = False
+    return fields
+
+
+def parse_trec_robustly(trec):
+    """
+    Extract corpus fields from a possibly mal-formed TREC file with Beautiful Soup.
+
+    :param trec: contents of a TREC XML file
+    :type trec: bytes
+    :return: labeled fields extracted from the TREC file or None if a field is missing
+    :rtype: dict
+    """
+    parse = BeautifulSoup(trec, "lxml")
+    try:
+        fields = dict((field, parse.find(tag).text) for field, tag in TREC_TAGS)
+    except AttributeError:
+        # If a XML tag is missing, find will return None, which will not have a 'text' attribute.
+        return None
+    fields[ROBUST_PARSE] = True
+    return fields
+
+
+class TrecArchive(object):
+    """
+    A tar or zip archive of TREC XML files.
+
+    The archive type is determined by its contents. Compressed tar files are supported.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        if zipfile.is_zipfile(filename):
+            self.type = "zip"
+        elif tarfile.is_tarfile(filename):
+            self.type = "tar"
+        else:
+            raise ValueError("%s is not a directory or a tar or zip archive" % filename)
+
+    def __repr__(self):
+        return "TREC %s archive: %s" % (self.type, self.filename)
+
+    def files(self):
+        """
+        Find the TREC XML files in the archive.
+
+        :return: mapping of archive member names to their sizes and modification times
+        :rtype: {str: (int, int)}
+        """
+        if self.type == "zip":
+            with zipfile.ZipFile(self.filename) as archive:
+                # Zip files store modification times as date tuples with two-second resolution.
+                files = dict((info.filename, (info.file_size, int("%04d%02d%02d%02d%02d%02d" % info.date_time)))
+                             for info in archive.infolist() if not info.filename.endswith("/"))
+        else:
+            with tarfile.open(self.filename, "r|*") as archive:
+                files = dict((member.name, (member.size, int(member.mtime))) for member in archive if member.isfile())
+        return dict((name, stat) for name, stat in files.items() if name.endswith(".xml"))
+
+    def read(self, names):
+        """
+        Read the contents of archive members in a single pass in the order in which they are stored.
+
+        :param names: names of members to read
+        :type names: list of str
+        :return: member names and their contents
+        :rtype: iterator of (str, bytes)
+        """
+        names = set(names)
+        if self.type == "zip":
+            with zipfile.ZipFile(self.filename) as archive:
+                for info in archive.infolist():
+                    if info.filename in names:
+                        yield info.filename, archive.read(info)
+        else:
+            # Open the tar file as a stream so that compressed archives are not repeatedly decompressed.
+            with tarfile.open(self.filename, "r|*") as archive:
+                for member in archive:
+                    if member.name in names:
+                        yield member.name, archive.extractfile(member).read()
 
 
 class TrecFileCheckpoint(DataFrameCheckpoint):
     """
-    A checkpoint that indexes TREC file contents by their file name on the local system.
+    A checkpoint that indexes TREC file contents by their file name on the local system or their archive member name.
+
+    Each entry records the size, modification time, and content hash of the TREC file it was extracted from. When the
+    checkpoint is opened, entries for files that have since been deleted or modified are dropped so that only new and
+    modified files need to be parsed. A file whose modification time changed but whose size did not is hashed again,
+    and its entry is kept if its contents are the same. Invalid TREC files are recorded with empty corpus fields so that
+    they are not parsed again either.
 
-    It also keeps track of the number of invalid TREC files that were written to it.
+    It also keeps track of the number of invalid TREC files and the number of TREC files that required the robust
+    parser that were written to it.
     """
     TREC_FILENAME = "TREC Filename"
+    SIZE = "Size"
+    MODIFIED = "Modified"
+    HASH = "Hash"
 
-    def __init__(self, filename, interval):
+    columns = [TREC_FILENAME, SIZE, MODIFIED, HASH] + CorpusFileType.columns
+
+    def __init__(self, filename, interval, trec_files, read_contents=None):
         self.invalid = 0
-        super(self.__class__, self).__init__(filename,
-                                             [TrecFileCheckpoint.TREC_FILENAME] + CorpusFileType.columns,
-                                             interval)
+        self.robust = 0
+        self.trec_files = trec_files
+        self.remove_stale_entries(filename, trec_files, read_contents)
+        super(self.__class__, self).__init__(filename, self.__class__.columns, interval)
 
     def write(self, trec_filename, trec):
-        if trec is not None:
-            super(self.__class__, self).write(trec_filename,
-                                              trec[ANSWER_ID],
-                                              trec[ANSWER],
-                                              trec[TITLE],
-                                              trec[FILENAME],
-                                              trec[DOCUMENT_ID])
-        else:
+        digest, fields = trec
+        size, modified = self.trec_files[trec_filename]
+        if fields is None:
             self.invalid += 1
+            fields = dict.fromkeys(CorpusFileType.columns)
+        elif fields[ROBUST_PARSE]:
+            self.robust += 1
+        super(self.__class__, self).write(trec_filename, size, modified, digest,
+                                          *[fields[column] for column in CorpusFileType.columns])
+
+    @classmethod
+    def remove_stale_entries(cls, filename, trec_files, read_contents=None):
+        """
+        Rewrite a checkpoint file without the entries for deleted and modified TREC files.
+
+        A file whose modification time changed but whose size is the same is only considered modified if its content
+        hash changed. Its entry is kept with the new modification time otherwise. A checkpoint file written in a
+        different format is discarded.
+
+        :param filename: checkpoint file name
+        :type filename: str
+        :param trec_files: mapping of current TREC file names to their sizes and modification times
+        :type trec_files: {str: (int, int)}
+        :param read_contents: function that returns the contents of TREC files given their names, if None files whose
+            modification times changed are considered modified
+        :type read_contents: func
+        """
+        if not os.path.isfile(filename):
+            return
+        checkpoint = from_csv(filename, dtype={cls.TREC_FILENAME: object, cls.HASH: object})
+        if not list(checkpoint.columns) == cls.columns:
+            logger.warning("Discarding checkpoint %s written in an old format" % filename)
+            os.remove(filename)
+            return
+        checkpoint = checkpoint.drop_duplicates(cls.TREC_FILENAME, keep="last")
+        current = checkpoint[cls.TREC_FILENAME].isin(trec_files)
+        unchanged = current & [trec_files.get(trec_filename) == (size, modified) for trec_filename, size, modified in
+                               checkpoint[[cls.TREC_FILENAME, cls.SIZE, cls.MODIFIED]].itertuples(index=False)]
+        # Files that were touched without being changed have the same size, so only those need to be hashed again.
+        touched = current & ~unchanged & [trec_files.get(trec_filename, (None,))[0] == size for trec_filename, size in
+                                          checkpoint[[cls.TREC_FILENAME, cls.SIZE]].itertuples(index=False)]
+        rehashed = 0
+        if read_contents is not None and touched.any():
+            rows = dict(zip(checkpoint[cls.TREC_FILENAME][touched], checkpoint.index[touched]))
+            for trec_filename, trec in read_contents(list(rows)):
+                row = rows[trec_filename]
+                if hashlib.sha1(trec).hexdigest() == checkpoint.at[row, cls.HASH]:
+                    checkpoint.at[row, cls.MODIFIED] = trec_files[trec_filename][1]
+                    unchanged[row] = True
+                    rehashed += 1
+        deleted = len(checkpoint) - sum(current)
+        modified = sum(current) - sum(unchanged)
+        logger.info("%d unchanged (%d touched with the same contents), %d modified, %d deleted TREC files since "
+                    "previous run" % (sum(unchanged), rehashed, modified, deleted))
+        if deleted or modified or rehashed:
+            to_csv(filename, checkpoint[unchanged], index=False)
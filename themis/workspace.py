@@ -0,0 +1,284 @@
+"""
+Store the artifacts of an experiment in a single SQLite database.
+
+An experiment leaves many CSV files behind: the corpus, truth, Q&A pairs, answers from each system, judgments, collated
+results, and curves. A workspace stores them as tables in one SQLite file, indexed by question, answer ID, and system,
+so that SQL queries can join them.
+
+Each artifact type has its own table, and several artifacts of the same type are told apart by a label. For answers
+and curves the label is the name of the system and is stored in a System column. For all other artifacts it is stored
+in a Label column. Artifacts that are not one of the known types are stored with whatever columns they have.
+
+A command line file argument of the form WORKSPACE::ARTIFACT or WORKSPACE::ARTIFACT/LABEL refers to an artifact in a
+workspace. Commands read it as if it were the CSV file from which it was imported, and files written to such a name
+are stored in the workspace.
+"""
+import importlib
+import os
+import re
+import sqlite3
+import time
+from urllib.request import pathname2url
+
+import numpy
+import pandas
+
+from themis import logger, from_csv, WORKSPACE_SEPARATOR, QUESTION, ANSWER, ANSWER_ID, IN_PURVIEW, CORRECT
+
+SYSTEM = "System"
+LABEL = "Label"
+
+# Artifact types, the file types that read them, and the columns that hold their labels.
+ARTIFACTS = {"corpus": ("themis.xmgr", "CorpusFileType", LABEL),
+             "truth": ("themis.xmgr", "TruthFileType", LABEL),
+             "qa_pairs": ("themis.question", "QAPairFileType", LABEL),
+             "answers": ("themis.answer", "AnswersFileType", SYSTEM),
+             "judgments": ("themis.judge", "JudgmentFileType", LABEL),
+             "collated": ("themis.analyze", "CollatedFileType", LABEL),
+             "precision": ("themis.plot", "PrecisionCurveFileType", SYSTEM),
+             "roc": ("themis.plot", "ROCCurveFileType", SYSTEM)}
+# Columns that are indexed in every table that has them, in addition to the label column.
+INDEXED_COLUMNS = [QUESTION, ANSWER, ANSWER_ID, SYSTEM]
+BOOLEAN_COLUMNS = [IN_PURVIEW, CORRECT]
+
+# Table that lists the artifacts in a workspace.
+CATALOG = "artifacts"
+ARTIFACT_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class Workspace(object):
+    """
+    A SQLite database of experiment artifacts.
+    """
+
+    def __init__(self, filename, read_only=False):
+        self.filename = filename
+        if read_only:
+            # A read-only connection keeps ad hoc queries from modifying tables behind the catalog's back.
+            self.connection = sqlite3.connect("file:%s?mode=ro" % pathname2url(os.path.abspath(filename)), uri=True)
+        else:
+            self.connection = sqlite3.connect(filename)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS %s '
+                                    '(Artifact TEXT, Label TEXT, Source TEXT, Rows INTEGER, Stored TEXT, '
+                                    'PRIMARY KEY (Artifact, Label))' % CATALOG)
+
+    def __repr__(self):
+        return "%s: %s" % (self.__class__.__name__, self.filename)
+
+    def close(self):
+        self.connection.close()
+
+    def artifacts(self):
+        """
+        :return: the artifacts in the workspace with their labels, sources, numbers of rows, and the times they were
+            stored
+        :rtype: pandas.DataFrame
+        """
+        return pandas.read_sql_query("SELECT * FROM %s ORDER BY Artifact, Label" % CATALOG, self.connection)
+
+    def import_file(self, artifact, filename, label=""):
+        """
+        Import a CSV file as an artifact, replacing any artifact with the same type and label.
+
+        :param artifact: artifact type
+        :type artifact: str
+        :param filename: CSV file
+        :type filename: str
+        :param label: label that distinguishes this artifact from others of the same type
+        :type label: str
+        """
+        file_type = artifact_file_type(artifact)
+        frame = from_csv(filename, dtype=None if file_type is None else file_type.dtype)
+        self.store(artifact, frame, label, filename)
+
+    def store(self, artifact, frame, label="", source=None):
+        """
+        Store a data frame as an artifact, replacing any artifact with the same type and label.
+
+        :param artifact: artifact type
+        :type artifact: str
+        :param frame: data frame with the artifact type's columns
+        :type frame: pandas.DataFrame
+        :param label: label that distinguishes this artifact from others of the same type
+        :type label: str
+        :param source: file the data frame was read from
+        :type source: str
+        """
+        if not ARTIFACT_NAME.match(artifact) or artifact == CATALOG:
+            raise ValueError("Invalid artifact name %s" % artifact)
+        file_type = artifact_file_type(artifact)
+        label_column = label_column_name(artifact)
+        if file_type is not None:
+            missing = [column for column in file_type.columns if column not in frame.columns]
+            if missing:
+                raise ValueError("%s artifact is missing columns %s" % (artifact, ", ".join(missing)))
+            frame = frame[file_type.columns]
+        if label_column in frame.columns:
+            raise ValueError("%s artifact cannot have a %s column" % (artifact, label_column))
+        frame = frame.copy()
+        frame.insert(0, label_column, label)
+        with self.connection:
+            columns = self.columns(artifact)
+            if columns is not None and columns != list(frame.columns):
+                self.connection.execute('DELETE FROM "%s" WHERE "%s" = ?' % (artifact, label_column), (label,))
+                if self.connection.execute('SELECT COUNT(*) FROM "%s"' % artifact).fetchone()[0]:
+                    raise ValueError("%s artifact does not have the columns of the other %s artifacts" %
+                                     (artifact, artifact))
+                self.connection.execute('DROP TABLE "%s"' % artifact)
+                columns = None
+            if columns is None:
+                self.create_table(artifact, frame)
+            else:
+                self.connection.execute('DELETE FROM "%s" WHERE "%s" = ?' % (artifact, label_column), (label,))
+            frame.to_sql(artifact, self.connection, if_exists="append", index=False, chunksize=10000)
+            self.connection.execute("INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?)" % CATALOG,
+                                    (artifact, label, source, len(frame), time.strftime("%Y-%m-%dT%H:%M:%S")))
+        logger.info("Stored %d rows in %s artifact%s in %s" %
+                    (len(frame), artifact, " labeled %s" % label if label else "", self.filename))
+
+    def create_table(self, artifact, frame):
+        columns = ['"%s" %s' % (column, sql_type(frame[column])) for column in frame.columns]
+        self.connection.execute('CREATE TABLE "%s" (%s)' % (artifact, ", ".join(columns)))
+        label_column = label_column_name(artifact)
+        for column in [label_column] + [column for column in INDEXED_COLUMNS if column != label_column]:
+            if column in frame.columns:
+                self.connection.execute('CREATE INDEX "%s %s" ON "%s" ("%s")' % (artifact, column, artifact, column))
+
+    def columns(self, artifact):
+        """
+        :return: names of the columns of an artifact table, or None if there is no such table
+        :rtype: list of str
+        """
+        return [name for name, _ in self.column_types(artifact)] or None
+
+    def column_types(self, artifact):
+        return [(row[1], row[2]) for row in self.connection.execute('PRAGMA table_info("%s")' % artifact)]
+
+    def read(self, artifact, label="", usecols=None, dtype=None):
+        """
+        Read an artifact as pandas.read_csv would read the CSV file it came from.
+
+        :param artifact: artifact type
+        :type artifact: str
+        :param label: label of the artifact
+        :type label: str
+        :param usecols: columns to read, if None read them all
+        :type usecols: list of str
+        :param dtype: types of columns
+        :type dtype: dict
+        :return: the artifact
+        :rtype: pandas.DataFrame
+        """
+        if self.connection.execute("SELECT COUNT(*) FROM %s WHERE Artifact = ? AND Label = ?" % CATALOG,
+                                   (artifact, label)).fetchone()[0] == 0:
+            raise ValueError("No %s artifact%s in %s" % (artifact, " labeled %s" % label if label else "",
+                                                        self.filename))
+        label_column = label_column_name(artifact)
+        column_types = [(column, column_type) for column, column_type in self.column_types(artifact)
+                        if column != label_column and (usecols is None or column in usecols)]
+        if usecols is not None:
+            missing = set(usecols) - set(column for column, _ in column_types)
+            if missing:
+                raise ValueError("Usecols do not match columns, columns expected but not found: %s" % sorted(missing))
+        sql = 'SELECT %s FROM "%s" WHERE "%s" = ? ORDER BY rowid' % \
+              (", ".join('"%s"' % column for column, _ in column_types), artifact, label_column)
+        frame = pandas.read_sql_query(sql, self.connection, params=(label,))
+        dtype = dtype or {}
+        for column, column_type in column_types:
+            values = frame[column]
+            if column_type == "BOOLEAN":
+                values = values.map({1: True, 0: False})
+                if values.notnull().all():
+                    values = values.astype(bool)
+            elif dtype.get(column) is str and values.dtype != object:
+                values = values.where(values.isnull(), values.astype(str))
+            elif dtype.get(column) is float:
+                values = values.astype(float)
+            if values.dtype == object:
+                # SQLite returns None for null values where pandas.read_csv returns NaN.
+                values = values.where(values.notnull(), numpy.nan)
+            frame[column] = values
+        return frame
+
+    def query(self, sql):
+        """
+        :param sql: SQL query
+        :type sql: str
+        :return: query results
+        :rtype: pandas.DataFrame
+        """
+        cursor = self.connection.execute(sql)
+        if cursor.description is None:
+            raise ValueError("The SQL statement does not return rows")
+        return pandas.DataFrame.from_records(cursor.fetchall(), columns=[column[0] for column in cursor.description])
+
+
+def artifact_file_type(artifact):
+    """
+    :return: file type that reads an artifact type, or None if it is not a known type
+    :rtype: CsvFileType
+    """
+    if artifact not in ARTIFACTS:
+        return None
+    module, name, _ = ARTIFACTS[artifact]
+    return getattr(importlib.import_module(module), name)()
+
+
+def label_column_name(artifact):
+    return ARTIFACTS[artifact][2] if artifact in ARTIFACTS else LABEL
+
+
+def sql_type(values):
+    if values.dtype == bool or values.name in BOOLEAN_COLUMNS:
+        return "BOOLEAN"
+    if numpy.issubdtype(values.dtype, numpy.integer):
+        return "INTEGER"
+    if numpy.issubdtype(values.dtype, numpy.floating):
+        return "REAL"
+    return "TEXT"
+
+
+def parse_reference(reference):
+    """
+    :param reference: WORKSPACE::ARTIFACT or WORKSPACE::ARTIFACT/LABEL
+    :type reference: str
+    :return: workspace file name, artifact type, and label
+    :rtype: (str, str, str)
+    """
+    filename, _, artifact = reference.partition(WORKSPACE_SEPARATOR)
+    artifact, _, label = artifact.partition("/")
+    return filename, artifact, label
+
+
+def read_reference(reference, usecols=None, dtype=None):
+    filename, artifact, label = parse_reference(reference)
+    if not os.path.isfile(filename):
+        raise IOError("No workspace %s" % filename)
+    workspace = Workspace(filename)
+    try:
+        return workspace.read(artifact, label, usecols, dtype)
+    finally:
+        workspace.close()
+
+
+def write_reference(reference, frame, index=True):
+    """
+    Store a data frame that would have been written to a CSV file in a workspace.
+
+    :param reference: WORKSPACE::ARTIFACT or WORKSPACE::ARTIFACT/LABEL
+    :type reference: str
+    :param frame: data frame
+    :type frame: pandas.DataFrame
+    :param index: store the index as it would be written to a CSV file
+    :type index: bool
+    """
+    filename, artifact, label = parse_reference(reference)
+    if index and any(name is not None for name in frame.index.names):
+        frame = frame.reset_index()
+    else:
+        frame = frame.reset_index(drop=True)
+    workspace = Workspace(filename)
+    try:
+        workspace.store(artifact, frame, label)
+    finally:
+        workspace.close()
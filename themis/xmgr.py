@@ -7,9 +7,10 @@ import requests
 
 from themis import QUESTION, ANSWER_ID, ANSWER, TITLE, FILENAME, QUESTION_ID, from_csv, DOCUMENT_ID, CONFIDENCE, \
     FREQUENCY
-from themis import logger, to_csv, ensure_directory_exists, percent_complete_message, CsvFileType
+from themis import logger, to_csv, ensure_directory_exists, CsvFileType, sort_for_output
 from themis.checkpoint import DataFrameCheckpoint, get_items
 from themis.question import QAPairFileType, USER_EXPERIENCE, DATE_TIME
+from themis.telemetry import telemetry, timed
 
 
 def download_truth_from_xmgr(xmgr, output_directory):
@@ -47,33 +48,66 @@ def download_truth_from_xmgr(xmgr, output_directory):
 
 
 def get_truth_from_mapped_questions(mapped_questions):
-    def get_pau_mapping(question):
-        if "predefinedAnswerUnit" in question:
-            return question["predefinedAnswerUnit"]
-        elif "mappedQuestion" in question:
-            question_id = question["mappedQuestion"]["id"]
-            try:
-                mapped_question = questions[question_id]
-            except KeyError:
-                logger.warning("Question %s mapped to non-existent question %s" % (question["id"], question_id))
-                return None
-            return get_pau_mapping(mapped_question)
-        else:
-            return None
+    """
+    Build truth from the questions downloaded from XMGR.
+
+    A question is either mapped directly to a PAU or mapped to another question, in which case it shares that
+    question's PAU. Chains of mapped questions are resolved iteratively and every question on a resolved chain is
+    memoized, so each question is visited a constant number of times. Questions mapped to non-existent questions or
+    that are part of a mapping cycle are unmapped.
 
-    unmapped = 0
+    :param mapped_questions: questions downloaded from XMGR
+    :type mapped_questions: list of dict
+    :return: truth mapping of question Ids and question text to answer Ids
+    :rtype: pandas.DataFrame
+    """
     # Index the questions by their question id so that mapped questions can be looked up.
-    questions = dict([(question["id"], question) for question in mapped_questions])
-    for question in questions.values():
-        question[ANSWER_ID] = get_pau_mapping(question)
-        if question[ANSWER_ID] is None:
-            unmapped += 1
-    questions = [q for q in questions.values() if q[ANSWER_ID] is not None]
-    question_ids = [q["id"] for q in questions]
-    question_text = [q["text"] for q in questions]
-    answer_id = [q[ANSWER_ID] for q in questions]
+    questions = dict((question["id"], question) for question in mapped_questions)
+    answer_ids = {}
+    cycles = 0
+    for question_id in questions:
+        # Follow the chain of mapped questions until reaching one that is resolved or cannot be followed further.
+        path = []
+        on_path = set()
+        current_id = question_id
+        while current_id not in answer_ids:
+            question = questions[current_id]
+            if "predefinedAnswerUnit" in question:
+                answer_ids[current_id] = question["predefinedAnswerUnit"]
+                break
+            elif "mappedQuestion" in question:
+                path.append(current_id)
+                on_path.add(current_id)
+                mapped_id = question["mappedQuestion"]["id"]
+                if mapped_id in on_path:
+                    logger.warning("Question %s is in a mapping cycle" % current_id)
+                    cycles += 1
+                    answer_ids[current_id] = None
+                    break
+                elif mapped_id not in questions:
+                    logger.warning("Question %s mapped to non-existent question %s" % (current_id, mapped_id))
+                    answer_ids[current_id] = None
+                    break
+                current_id = mapped_id
+            else:
+                answer_ids[current_id] = None
+                break
+        # Compress the path so that every question on it points directly at the resolved answer.
+        answer_id = answer_ids[current_id]
+        for mapped_id in path:
+            answer_ids[mapped_id] = answer_id
+    question_ids = []
+    question_text = []
+    answer_id = []
+    for question_id, question in questions.items():
+        if answer_ids[question_id] is not None:
+            question_ids.append(question_id)
+            question_text.append(question["text"])
+            answer_id.append(answer_ids[question_id])
     truth = pandas.DataFrame.from_dict({QUESTION_ID: question_ids, QUESTION: question_text, ANSWER_ID: answer_id})
-    logger.info("%d mapped, %d unmapped" % (len(truth), unmapped))
+    if cycles:
+        logger.warning("%d mapping cycles" % cycles)
+    logger.info("%d mapped, %d unmapped" % (len(truth), len(questions) - len(truth)))
     return truth
 
 
@@ -113,12 +147,14 @@ def download_corpus_from_xmgr(xmgr, output_directory, checkpoint_frequency, max_
         document_ids = sorted(set(document_ids) - downloaded_document_ids.recovered)
         m = len(document_ids)
         start = len(downloaded_document_ids.recovered) + 1
+        job = telemetry.job("Get PAUs from document", n, len(downloaded_document_ids.recovered))
         if m:
             for i, document_id in enumerate(document_ids, start):
                 if i % checkpoint_frequency == 0 or i == start or i == m:
                     corpus.flush()
-                    logger.info(percent_complete_message("Get PAUs from document", i, n))
-                paus = xmgr.get_paus_from_document(document_id)
+                    logger.info(job.message())
+                with job.item():
+                    paus = xmgr.get_paus_from_document(document_id)
                 # The document id and number of PAUs are both integers. Cast them to strings, otherwise pandas will
                 # write them as floats.
                 for pau in paus:
@@ -381,6 +417,7 @@ class XmgrProject(object):
     def get_paus(self, i):
         return self.get(self.urljoin("wcea/api/GroundTruth/paus", i))["hits"]
 
+    @timed("XmgrProject.get")
     def get(self, path, params=None, headers=None):
         def debug_msg():
             if params is None:
@@ -428,16 +465,20 @@ class CorpusFileType(CsvFileType):
         # Cast integer document IDs to strings so that Pandas does not write them as real numbers.
         corpus[DOCUMENT_ID] = corpus[DOCUMENT_ID].astype("string")
         # Sort by document ID first so that answers from the same document are all grouped together.
-        corpus = corpus.sort_values([DOCUMENT_ID, ANSWER_ID]).set_index(ANSWER_ID)
+        corpus = sort_for_output(corpus, [DOCUMENT_ID, ANSWER_ID]).set_index(ANSWER_ID)
         return corpus
 
 
 class TruthFileType(CsvFileType):
-    def __init__(self):
-        super(self.__class__, self).__init__([QUESTION_ID, QUESTION, ANSWER_ID])
+    def __init__(self, columns=None):
+        """
+        :param columns: the columns a command uses, if None read them all
+        :type columns: list of str
+        """
+        super(self.__class__, self).__init__(columns or [QUESTION_ID, QUESTION, ANSWER_ID], dtype={QUESTION: str})
 
     @staticmethod
     def output_format(truth):
-        truth = truth.sort_values(QUESTION_ID)
+        truth = sort_for_output(truth, QUESTION_ID)
         truth = truth[[QUESTION_ID, QUESTION, ANSWER_ID]].set_index(QUESTION_ID)
         return truth